@@ -0,0 +1,12 @@
+"""
+Tests of the numeric kernels against slow, obvious versions of them on tiny
+inputs. Run from My-Image-Analysis-Codes:
+    python -m pytest -q Test-Drivers
+"""
+import os
+import sys
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(test_dir)
+# imageanalysis, and the phantom studies of the benchmarks.
+sys.path[:0] = [package_dir, os.path.join(package_dir, 'benchmarks')]
@@ -1,13 +1,13 @@
 import matplotlib.pyplot as plt
 import imageanalysis.core as cr
-import imageanalysis.read_data as rd
+import imageanalysis.IO as IO
 import imageanalysis.play_movie as pm
 import numpy as np
 import os
 
 
 folder_path = "/Users/hn/Documents/GitHub/Image-Analysis-Working-Group/data"
-all_images_list = rd.load_dcm_profiles(folder_path)
+volume, metadata = IO.open_volume_cache(folder_path)
 
 time_steps = 59
 image_dimension = 512
@@ -15,7 +15,7 @@ image_dimension = 512
 # depth has to be chosen by user!
 depth = -165
  
-matrix = rd.matrix_of_all_times(all_images_list, depth, time_steps, image_dimension )
+matrix = volume[metadata['slice_locations'].index(depth)]
 one_matrix = matrix[0,:,:]
 
 # concatenate and hstack works the same way.
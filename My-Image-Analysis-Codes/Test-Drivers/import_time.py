@@ -0,0 +1,53 @@
+"""
+Import-time budget of the numeric modules.
+
+Run from My-Image-Analysis-Codes (python 3.7 or newer, for -X importtime):
+    python Test-Drivers/import_time.py
+
+Each module is imported in a fresh interpreter a few times, the best
+cumulative time reported by -X importtime is compared to its budget, and
+plotting / DICOM packages must not have been imported along the way.
+
+Measured on a single core sandbox (numpy alone takes ~100 ms of it):
+    imageanalysis.core    before: ~1100 ms   after: ~100 ms
+"""
+import subprocess
+import sys
+
+# milliseconds, cumulative, including numpy.
+budgets = {"imageanalysis.core": 300,
+           "imageanalysis.stream": 300}
+not_allowed = ["matplotlib", "dicom", "pydicom", "scipy"]
+no_runs = 5
+
+
+def best_import_time(module_name):
+    best = None
+    for run in range(no_runs):
+        output = subprocess.check_output([sys.executable, "-X", "importtime", "-c",
+                                          "import " + module_name],
+                                         stderr=subprocess.STDOUT).decode()
+        for line in output.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == module_name:
+                cumulative_ms = int(fields[1]) / 1000.
+                best = cumulative_ms if best is None else min(best, cumulative_ms)
+    return best
+
+
+def loaded_modules(module_name):
+    code = ("import sys, " + module_name + "; "
+            "print(' '.join(sorted(set(m.split('.')[0] for m in sys.modules))))")
+    return subprocess.check_output([sys.executable, "-c", code]).decode().split()
+
+
+failed = False
+for module_name, budget in sorted(budgets.items()):
+    import_time = best_import_time(module_name)
+    extra = sorted(set(not_allowed) & set(loaded_modules(module_name)))
+    ok = import_time <= budget and not extra
+    failed = failed or not ok
+    print("%-22s %7.1f ms (budget %d ms) %s %s" % (module_name, import_time, budget,
+                                                 "imports " + ", ".join(extra) if extra else "",
+                                                 "OK" if ok else "FAILED"))
+sys.exit(1 if failed else 0)
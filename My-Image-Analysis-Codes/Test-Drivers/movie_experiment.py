@@ -1,4 +1,4 @@
-import imageanalysis.read_data as rd
+import imageanalysis.IO as IO
 #import core.play_movie as play
 import imageanalysis.core as cr
 import matplotlib.pyplot as plt
@@ -13,10 +13,10 @@ import os
 
 """  play movie of Yufeng  """
 path_of_data = "/Users/L22/Git_hub/Image-Analysis/Data"
-all_profiles = rd.load_dcm_profiles(path_of_data)
+volume, metadata = IO.open_volume_cache(path_of_data)
 
 
-image_matrix = rd.matrix_of_all_times(all_profiles, -165, 59, 512)
+image_matrix = volume[metadata['slice_locations'].index(-165)]
 image_matrix = (image_matrix>0) * image_matrix
 for k in range(0, 59):
     plt.imshow(image_matrix[k, :, :],cmap='Greys')
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import imageanalysis.core as cr
+
+scipy = pytest.importorskip('scipy')
+
+
+def old_someName(inputImage, sigma_x, sigma_y, Lambdas, maxIteration, epsilon):
+    """the L1-TV descent of before L1TV_solve, one lambda after the other."""
+    import scipy.ndimage
+
+    def gradient(image):
+        return np.gradient(image)
+
+    def div0(a, b):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            c = np.true_divide(a, b)
+            c[~np.isfinite(c)] = 0
+        return c
+
+    uList = []
+    for Lambda in Lambdas:
+        u = scipy.ndimage.gaussian_filter(inputImage, [sigma_x, sigma_y], mode='constant')
+        for i in range(maxIteration):
+            gx, gy = gradient(u)
+            norm = np.sqrt(gx ** 2 + gy ** 2)
+            gxx, gxy = gradient(div0(gx, norm))
+            gyx, gyy = gradient(div0(gy, norm))
+            u = u - epsilon * (-(gxx + gyy) + Lambda * np.sign(u - inputImage))
+        uList.append(u)
+    return uList
+
+
+def test_L1TV_solve_is_the_old_descent_for_every_lambda():
+    image = np.random.RandomState(0).rand(12, 15) * 100
+    Lambdas = [0.5, 1, 2]
+    expected = old_someName(image, 1, 1, Lambdas, 40, 0.1)
+    found = cr.L1TV_solve(image, Lambdas, 1, 1, 40, 0.1)
+    np.testing.assert_allclose(found, np.array(expected), rtol=1e-10, atol=1e-10)
+    # someName keeps its list of approximations.
+    for approximation, reference in zip(cr.someName(image, 1, 1, Lambdas, 40, 0.1), expected):
+        np.testing.assert_allclose(approximation, reference, rtol=1e-10, atol=1e-10)
+
+
+def test_L1TV_solve_history_and_tolerance():
+    image = np.random.RandomState(1).rand(10, 10) * 100
+    u, history = cr.L1TV_solve(image, [0.5, 2], 1, 1, 30, 0.1, history=True)
+    np.testing.assert_allclose(history['cost'][:, -1], cr.L1TV_cost(image, u, np.reshape([0.5, 2], (-1, 1, 1))))
+    # the two lambdas stop at different steps (17 and 34), before maxIteration.
+    stopped, history = cr.L1TV_solve(image, [0.5, 2], 1, 1, 100, 1, tolerance=1e-3, history=True)
+    assert history['iterations'][0] != history['iterations'][1]
+    assert history['iterations'].max() < 100
+    for k in range(2):
+        # a lambda that stopped is where the descent without tolerance is at that step.
+        steps = history['iterations'][k]
+        np.testing.assert_allclose(stopped[k], cr.L1TV_solve(image, [[0.5, 2][k]], 1, 1, steps, 1)[0])
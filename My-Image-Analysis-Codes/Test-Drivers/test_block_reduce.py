@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import imageanalysis.core as cr
+
+
+def brute_block_reduce(array, block_size, func, edge):
+    """one block at a time, over the entries it has."""
+    block_size = (1,) * (array.ndim - len(block_size)) + tuple(block_size)
+    if edge == 'crop':
+        shape = [length // size for length, size in zip(array.shape, block_size)]
+    else:
+        shape = [-(-length // size) for length, size in zip(array.shape, block_size)]
+    out = np.empty(shape)
+    for index in np.ndindex(*shape):
+        block = array[tuple(slice(i * size, (i + 1) * size) for i, size in zip(index, block_size))]
+        out[index] = getattr(np, func)(block)
+    return out
+
+
+@pytest.mark.parametrize('func', ['mean', 'sum', 'max', 'min', 'median'])
+@pytest.mark.parametrize('edge', ['crop', 'pad'])
+@pytest.mark.parametrize('shape, block_size', [((8, 12), (2, 3)), ((7, 10), (3, 4)),
+                                               ((3, 5, 9, 7), (2, 2)), ((5, 6, 7), (2, 3, 2))])
+def test_block_reduce_matches_brute_force(func, edge, shape, block_size):
+    array = np.random.RandomState(0).randint(0, 1000, size=shape).astype(np.int16)
+    expected = brute_block_reduce(array, block_size, func, edge)
+    found = cr.block_reduce(array, block_size, func, edge)
+    assert found.shape == expected.shape
+    np.testing.assert_allclose(found, expected, rtol=1e-12)
+
+
+def test_aggregate_2D_and_3D_match_the_old_loops():
+    stack = np.random.RandomState(1).rand(5, 16, 16) * 100
+    # the old aggregate_2D, frame by frame.
+    old = np.array([frame.reshape(4, 4, -1, 4).swapaxes(1, 2).reshape(-1, 4, 4)
+                    .mean(axis=1).mean(axis=1).reshape(4, 4) for frame in stack])
+    np.testing.assert_allclose(cr.aggregate_3D(stack, 4), old, rtol=1e-12)
+    np.testing.assert_allclose(cr.aggregate_2D(stack[2], 4), old[2], rtol=1e-12)
+    assert cr.aggregate_3D(stack, 4, dtype=np.float32).dtype == np.float32
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+import imageanalysis.core as cr
+
+
+def old_denoise_tv(image, weight=50, eps=2.e-4, n_iter_max=200):
+    """the denoise_tv of before the batched one, one image (of any ndim) per call."""
+    ndim = image.ndim
+    p = np.zeros((image.ndim, ) + image.shape)
+    g = np.zeros_like(p)
+    i = 0
+    while i < n_iter_max:
+        if i > 0:
+            # d will be the (negative) divergence of p
+            d = -p.sum(0)
+            for ax in range(ndim):
+                d[(slice(None),) * ax + (slice(1, None),)] += p[(ax,) + (slice(None),) * ax + (slice(0, -1),)]
+            out = image + d
+        else:
+            out = image
+        E = (out ** 2).sum()
+        for ax in range(ndim):
+            g[(ax,) + (slice(None),) * ax + (slice(0, -1),)] = np.diff(out, axis=ax)
+        norm = np.sqrt((g ** 2).sum(axis=0))[np.newaxis, ...]
+        E += weight * norm.sum()
+        tau = 1. / (2.*2.)
+        norm *= tau / weight
+        norm += 1.
+        p -= tau * g
+        p /= norm
+        E /= float(image.size)
+        if i == 0:
+            E_init = E
+            E_previous = E
+        else:
+            if np.abs(E_previous - E) < eps * E_init:
+                break
+            else:
+                E_previous = E
+        i += 1
+    return out
+
+
+@pytest.mark.parametrize('shape', [(12, 14), (3, 10, 12), (2, 3, 6, 7)])
+def test_denoise_tv_default_is_the_old_one(shape):
+    # all the axes of the image are one image, as they always were.
+    image = np.random.RandomState(0).rand(*shape) * 100
+    np.testing.assert_allclose(cr.denoise_tv(image, weight=30),
+                               old_denoise_tv(image, weight=30), atol=1e-9)
+
+
+@pytest.mark.parametrize('block_bytes', [1, 2**18])
+def test_denoise_tv_frames_are_the_old_one_on_every_frame(block_bytes):
+    # images of different noise converge after different numbers of iterations.
+    random = np.random.RandomState(1)
+    stack = random.rand(2, 5, 10, 12) * np.linspace(10, 100, 10).reshape(2, 5, 1, 1)
+    expected = np.array([[old_denoise_tv(frame, weight=30) for frame in frames]
+                         for frames in stack])
+    found = cr.denoise_tv(stack, weight=30, image_ndim=2, block_bytes=block_bytes)
+    np.testing.assert_allclose(found, expected, atol=1e-9)
+
+
+def test_denoise_tv_float32_is_close_to_float64():
+    stack = np.random.RandomState(2).rand(4, 16, 16) * 100
+    found = cr.denoise_tv(stack, weight=30, image_ndim=2, dtype=np.float32)
+    assert found.dtype == np.float32
+    np.testing.assert_allclose(found, cr.denoise_tv(stack, weight=30, image_ndim=2), atol=1e-2)
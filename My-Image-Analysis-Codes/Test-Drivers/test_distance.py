@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy')
+from scipy.spatial import distance_matrix
+import imageanalysis.core as cr
+import imageanalysis.distance as ds
+
+
+def brute_distance(a, b, metric):
+    """one pair of vectors at a time."""
+    if metric == 'cosine':
+        norms = np.linalg.norm(a) * np.linalg.norm(b)
+        return 1. if norms == 0 else 1 - np.dot(a, b) / norms
+    if metric == 'sqeuclidean':
+        return np.sum((a - b) ** 2)
+    p = {'L1': 1, 'L2': 2}.get(metric, metric)
+    return np.linalg.norm(a - b, ord=p)
+
+
+def points():
+    random = np.random.RandomState(0)
+    A, B = random.rand(13, 5) * 10, random.rand(9, 5) * 10
+    # a zero vector, for cosine.
+    A[4] = 0
+    return A, B
+
+
+@pytest.mark.parametrize('metric', ['L1', 'L2', 'sqeuclidean', 'cosine', 3, np.inf])
+def test_pairwise_distances_matches_brute_force(metric):
+    A, B = points()
+    expected = np.array([[brute_distance(a, b, metric) for b in B] for a in A])
+    # chunks of 4 rows, and all of them at once.
+    for chunk_size in (4, 1024):
+        found = ds.pairwise_distances(A, B, metric, chunk_size=chunk_size)
+        np.testing.assert_allclose(found, expected, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('num', [1, 2, 3])
+def test_distanceMatrix_matches_scipy(num):
+    A, B = points()
+    np.testing.assert_allclose(cr.distanceMatrix(A, B, num), distance_matrix(A, B, num),
+                               rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('metric', ['L1', 'L2', 'cosine'])
+@pytest.mark.parametrize('method', ['tree', 'brute'])
+def test_nearest_neighbors_matches_sorting_all_distances(metric, method):
+    data, queries = points()
+    expected = np.array([[brute_distance(q, d, metric) for d in data] for q in queries])
+    distances, indices = ds.nearest_neighbors(data, queries, k=4, metric=metric, method=method,
+                                              chunk_size=4)
+    np.testing.assert_allclose(distances, np.sort(expected, axis=1)[:, :4], rtol=1e-8, atol=1e-8)
+    np.testing.assert_allclose(np.take_along_axis(expected, indices, axis=1), distances,
+                               rtol=1e-8, atol=1e-8)
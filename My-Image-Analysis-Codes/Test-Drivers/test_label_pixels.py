@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import imageanalysis.core as cr
+
+
+def brute_labels(pixels, references, threshold, distance='L1'):
+    """pixel by pixel, through label_probability and label_criterion."""
+    probabilities = np.array([cr.label_probability(pixels, np.reshape(reference, (-1, 1)),
+                                                   distance)
+                              for reference in references])
+    probabilities /= probabilities.sum(axis=0)
+    labels = []
+    for column in probabilities.T:
+        ordered = np.sort(column)
+        labels.append(int(np.argmax(column)) if ordered[-1] - ordered[-2] >= threshold else 100)
+    return labels
+
+
+def small_study(seed, no_features, no_pixels, no_classes):
+    # distances of a few units, so that exp(-distance) does not underflow in the reference.
+    random = np.random.RandomState(seed)
+    references = random.rand(no_classes, no_features)
+    nearest = random.randint(no_classes, size=no_pixels)
+    pixels = references[nearest].T + random.normal(0, 0.15, (no_features, no_pixels))
+    return pixels, references
+
+
+def test_final_label_is_the_pixel_by_pixel_labeling():
+    pixels, references = small_study(0, 6, 500, 3)
+    expected = brute_labels(pixels, references, 0.4)
+    assert 100 in expected and len(set(expected)) == 4
+    assert cr.final_label(pixels, references[0], references[1], references[2], 0.4) == expected
+
+
+@pytest.mark.parametrize('distance', ['L1', 'L2'])
+def test_label_pixels_of_a_study_in_chunks(distance):
+    # features along the time axis of a (slice, time, rows, cols) study.
+    pixels, references = small_study(1, 5, 2 * 6 * 7, 4)
+    study = pixels.T.reshape(2, 6, 7, 5).transpose(0, 3, 1, 2)
+    expected = np.reshape(brute_labels(pixels, references, 0.2, distance), (2, 6, 7))
+    found = cr.label_pixels(study, references, 0.2, distance, chunk_size=13, feature_axis=1)
+    np.testing.assert_array_equal(found, expected)
+
+
+def test_label_pixels_far_from_every_reference():
+    # exp(-distance) is 0 for all the classes, the probabilities are still defined.
+    references = np.array([[0., 0.], [1., 1.]])
+    labels, probabilities = cr.label_pixels(np.array([[2000.], [2000.]]), references,
+                                            return_probabilities=True)
+    assert labels.tolist() == [1]
+    np.testing.assert_allclose(probabilities.sum(axis=0), 1)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+sio = pytest.importorskip('scipy.io')
+import imageanalysis.IO as IO
+
+
+def assert_file_holds(filename, expected):
+    # read back by scipy alone, the whole file (vectors come back as 1 x n).
+    everything = sio.loadmat(filename)
+    assert sorted(name for name in everything if not name.startswith('__')) == sorted(expected)
+    for name, value in expected.items():
+        np.testing.assert_array_equal(everything[name], np.atleast_2d(value))
+
+
+def test_append_new_and_replaced_variables(tmp_path):
+    filename = str(tmp_path / 'store.mat')
+    store = IO.MatrixStore()
+    values = {'a': np.arange(12.).reshape(3, 4), 'b': np.eye(3, dtype=np.int16)}
+    store.save(filename, values)
+    np.testing.assert_array_equal(store.load(filename, 'a'), values['a'])
+
+    # a new variable is appended at the end of the file.
+    values['c'] = np.ones((2, 5))
+    store.save(filename, {'c': values['c']}, mode='a')
+    assert_file_holds(filename, values)
+    assert store.variable_names(filename) == ['a', 'b', 'c']
+
+    # a variable already there: the others are copied, the new value comes last.
+    values['a'] = np.full((2, 2), 9.)
+    store.save(filename, {'a': values['a']}, mode='a')
+    assert_file_holds(filename, values)
+    assert store.variable_names(filename) == ['b', 'c', 'a']
+    for name, value in values.items():
+        np.testing.assert_array_equal(store.load(filename, name), value)
+
+
+def test_loaded_variables_follow_the_file(tmp_path):
+    filename = str(tmp_path / 'store.mat')
+    store = IO.MatrixStore()
+    sio.savemat(filename, {'x': np.zeros(3), 'y': np.arange(4.)})
+    np.testing.assert_array_equal(store.load(filename, 'y'), [np.arange(4.)])
+    # written by someone else: the cached directory and variables are dropped.
+    sio.savemat(filename, {'y': np.arange(100.), 'z': np.ones(2)})
+    np.testing.assert_array_equal(store.load(filename, 'y'), [np.arange(100.)])
+    with pytest.raises(KeyError):
+        store.load(filename, 'x')
+
+
+def test_saveMatrix_and_loadNamedMatrix(tmp_path):
+    filename = str(tmp_path / 'store.mat')
+    IO.saveMatrix(filename, {'first': np.arange(3.)})
+    IO.saveMatrix(filename, {'second': np.arange(5.)}, mode='a')
+    assert_file_holds(filename, {'first': np.arange(3.), 'second': np.arange(5.)})
+    np.testing.assert_array_equal(IO.loadNamedMatrix(filename, 'second'), [[0., 1, 2, 3, 4]])
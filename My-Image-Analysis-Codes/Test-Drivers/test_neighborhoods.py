@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+import imageanalysis.core as cr
+
+
+@pytest.mark.parametrize('radius', [1, 2])
+def test_extract_neighborhoods_matches_matrix_neighbors_loop(radius):
+    image = np.random.RandomState(1).rand(5, 6)
+    centers = [(row, col) for row in range(5) for col in range(6)]
+    found = cr.extract_neighborhoods(image, centers, radius)
+    for window, (row, col) in zip(found, centers):
+        # the old mask, NaN outside of the image.
+        expected = np.full((2 * radius + 1, 2 * radius + 1), np.nan)
+        for i in range(-radius, radius + 1):
+            for j in range(-radius, radius + 1):
+                if 0 <= row + i < 5 and 0 <= col + j < 6:
+                    expected[i + radius, j + radius] = image[row + i, col + j]
+        np.testing.assert_array_equal(window, expected)
+        np.testing.assert_array_equal(cr.matrix_neighbors(image, row, col, radius), expected)
+
+
+def test_extract_neighborhoods_in_time():
+    stack = np.random.RandomState(2).rand(4, 5, 5)
+    centers = [(0, 0, 0), (2, 2, 3), (3, 4, 4)]
+    found = cr.extract_neighborhoods(stack, centers, 1, time_radius=1, fill=-1.)
+    padded = np.pad(stack, 1, mode='constant', constant_values=-1.)
+    for window, (time, row, col) in zip(found, centers):
+        np.testing.assert_array_equal(window, padded[time:time + 3, row:row + 3, col:col + 3])
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+import imageanalysis.core as cr
+
+
+def brute_non_local_mean(stack, constant, patch_radius, search_radius, time_radius, mode, h):
+    """pixel by pixel, every candidate of the search window compared on its own."""
+    stack = np.asarray(stack, dtype=np.float64)
+    no_time, no_row, no_col = stack.shape
+    r = patch_radius
+    padded = np.pad(stack, ((0, 0), (r, r), (r, r)), mode='constant')
+    out = np.empty_like(stack)
+    for t in range(no_time):
+        for i in range(no_row):
+            for j in range(no_col):
+                patch = padded[t, i:i + 2 * r + 1, j:j + 2 * r + 1]
+                distances, values = [], []
+                for u in range(max(0, t - time_radius), min(no_time, t + time_radius + 1)):
+                    for k in range(max(0, i - search_radius), min(no_row, i + search_radius + 1)):
+                        for l in range(max(0, j - search_radius), min(no_col, j + search_radius + 1)):
+                            difference = patch - padded[u, k:k + 2 * r + 1, l:l + 2 * r + 1]
+                            if mode == 'constant':
+                                distances.append(np.abs(difference).sum())
+                            else:
+                                distances.append((difference ** 2).sum())
+                            values.append(stack[u, k, l])
+                distances, values = np.array(distances), np.array(values)
+                if mode == 'constant':
+                    out[t, i, j] = values[np.argsort(distances, kind='stable')[:constant]].mean()
+                else:
+                    weights = np.exp(-distances / (h ** 2 * (2 * r + 1) ** 2))
+                    out[t, i, j] = (weights * values).sum() / weights.sum()
+    return out
+
+
+@pytest.mark.parametrize('mode', ['constant', 'gaussian'])
+@pytest.mark.parametrize('patch_radius, search_radius', [(1, 2), (0, 3), (2, 1)])
+def test_non_local_mean_matches_brute_force(mode, patch_radius, search_radius):
+    image = np.random.RandomState(0).rand(9, 11) * 100
+    expected = brute_non_local_mean(image[np.newaxis], 4, patch_radius, search_radius, 0, mode,
+                                    10.)[0]
+    found = cr.non_local_mean(image, 4, patch_radius=patch_radius, search_radius=search_radius,
+                              mode=mode, h=10.)
+    np.testing.assert_allclose(found, expected, rtol=1e-10)
+
+
+def test_non_local_mean_search_window_larger_than_image():
+    image = np.random.RandomState(1).rand(4, 5) * 100
+    expected = brute_non_local_mean(image[np.newaxis], 30, 1, 7, 0, 'constant', None)[0]
+    np.testing.assert_allclose(cr.non_local_mean(image, 30, search_radius=7), expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize('mode', ['constant', 'gaussian'])
+@pytest.mark.parametrize('time_radius', [0, 1, 3])
+def test_non_local_mean_3D_matches_brute_force(mode, time_radius):
+    stack = np.random.RandomState(2).rand(4, 7, 8) * 100
+    expected = brute_non_local_mean(stack, 5, 1, 2, time_radius, mode, 10.)
+    found = cr.non_local_mean_3D(stack, 5, search_radius=2, time_radius=time_radius, mode=mode,
+                                 h=10.)
+    np.testing.assert_allclose(found, expected, rtol=1e-10)
+
+
+def test_non_local_mean_3D_chunks_give_the_same_result():
+    stack = np.random.RandomState(3).rand(6, 8, 8) * 100
+    # one frame per chunk, and all of them in one.
+    one = cr._non_local_mean_stack(stack, 5, np.float64, 1, 2, 2, 'gaussian', 10., chunk_bytes=1)
+    every = cr._non_local_mean_stack(stack, 5, np.float64, 1, 2, 2, 'gaussian', 10.,
+                                     chunk_bytes=2**30)
+    np.testing.assert_allclose(one, every, rtol=1e-12)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import imageanalysis.core as cr
+
+
+@pytest.mark.parametrize('margin_size', [1, 2])
+@pytest.mark.parametrize('shape', [(7, 7), (6, 9)])
+def test_vectorize_tiles_matches_the_old_loop(margin_size, shape):
+    image = np.random.RandomState(0).rand(*shape)
+    size = 2 * margin_size + 1
+    # the old loop: one column per center, along the rows.
+    columns = [image[row - margin_size:row + margin_size + 1,
+                     col - margin_size:col + margin_size + 1].ravel()
+               for row in range(margin_size, shape[0] - margin_size)
+               for col in range(margin_size, shape[1] - margin_size)]
+    found = cr.vectorize_tiles(image, margin_size)
+    assert found.shape == (size ** 2, len(columns)) and found.flags.c_contiguous
+    np.testing.assert_array_equal(found, np.transpose(columns))
+
+
+@pytest.mark.parametrize('patch_size, stride', [(3, 1), ((1, 3, 2), (1, 2, 3)), (2, 2)])
+def test_extract_patches_matches_slicing(patch_size, stride):
+    image = np.arange(4 * 7 * 8).reshape(4, 7, 8)
+    patches = cr.extract_patches(image, patch_size, stride)
+    patch_size = (patch_size,) * 3 if np.isscalar(patch_size) else patch_size
+    stride = (stride,) * 3 if np.isscalar(stride) else stride
+    for index in np.ndindex(*patches.shape[:3]):
+        expected = image[tuple(slice(i * step, i * step + size)
+                               for i, step, size in zip(index, stride, patch_size))]
+        np.testing.assert_array_equal(patches[index], expected)
+    assert not patches.flags.writeable
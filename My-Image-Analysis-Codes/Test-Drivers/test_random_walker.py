@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy')
+import imageanalysis.segmentation as segmentation
+
+
+def dense_random_walker(image, seeds, unlabeled, beta, connectivity):
+    """probabilities from the dense Laplacian, solved directly (np.linalg.solve)."""
+    first, second = segmentation.grid_edges(image.shape, connectivity)
+    weights = segmentation.edge_weights(image, first, second, beta)
+    no_pixels = image.size
+    adjacency = np.zeros((no_pixels, no_pixels))
+    adjacency[first, second] = weights
+    adjacency[second, first] = weights
+    laplacian = np.diag(adjacency.sum(axis=1)) - adjacency
+    seeds = seeds.ravel()
+    labels = np.unique(seeds[seeds != unlabeled])
+    unknown = seeds == unlabeled
+    marked = (seeds[~unknown][:, np.newaxis] == labels).astype(np.float64)
+    probabilities = np.zeros((len(labels), no_pixels))
+    probabilities[:, ~unknown] = marked.T
+    probabilities[:, unknown] = np.linalg.solve(laplacian[np.ix_(unknown, unknown)],
+                                                -laplacian[np.ix_(unknown, ~unknown)].dot(marked)).T
+    return probabilities.reshape((len(labels),) + image.shape)
+
+
+def two_regions(shape, seed):
+    random = np.random.RandomState(seed)
+    image = np.where(np.arange(shape[-1]) < shape[-1] // 2, 20., 80.) + random.normal(0, 5, shape)
+    seeds = np.full(shape, -1)
+    seeds[..., shape[-2] // 2, 1] = 3
+    seeds[..., shape[-2] // 2, -2] = 7
+    seeds[..., 0, shape[-1] // 2 + 1] = 7
+    return image, seeds
+
+
+@pytest.mark.parametrize('coarse_levels', [0, 2])
+@pytest.mark.parametrize('shape, connectivity', [((32, 36), None), ((32, 32), 8), ((2, 16, 20), 6)])
+def test_random_walker_solves_the_dense_system(shape, connectivity, coarse_levels):
+    image, seeds = two_regions(shape, 0)
+    expected = dense_random_walker(image, seeds, -1, 2., connectivity)
+    labels, probabilities = segmentation.random_walker(image, seeds, beta=2.,
+                                                       connectivity=connectivity, tol=1e-10,
+                                                       coarse_levels=coarse_levels,
+                                                       return_probabilities=True)
+    np.testing.assert_allclose(probabilities, expected, atol=1e-7)
+    np.testing.assert_array_equal(labels, np.array([3, 7])[np.argmax(expected, axis=0)])
+
+
+def test_random_walker_three_labels():
+    image, seeds = two_regions((24, 24), 1)
+    seeds[-1, -1] = 5
+    expected = dense_random_walker(image, seeds, -1, 1., None)
+    labels, probabilities = segmentation.random_walker(image, seeds, tol=1e-10,
+                                                       return_probabilities=True)
+    np.testing.assert_allclose(probabilities, expected, atol=1e-7)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import imageanalysis.core as cr
+
+
+def brute_region_growing(img, seeds, threshold, connectivity):
+    """every step looks at all the neighbors of the region for the nearest to its mean."""
+    offsets = cr.neighbor_offsets(img.ndim, connectivity)
+    region = set(map(tuple, seeds))
+    total = sum(float(img[pixel]) for pixel in region)
+    while True:
+        mean = total / len(region)
+        neighbors = set()
+        for pixel in region:
+            for offset in offsets:
+                neighbor = tuple(p + o for p, o in zip(pixel, offset))
+                if all(0 <= n < size for n, size in zip(neighbor, img.shape)) and neighbor not in region:
+                    neighbors.add(neighbor)
+        if not neighbors:
+            break
+        nearest = min(neighbors, key=lambda neighbor: abs(float(img[neighbor]) - mean))
+        if abs(float(img[nearest]) - mean) >= threshold:
+            break
+        region.add(nearest)
+        total += float(img[nearest])
+    segmented_img = np.zeros(img.shape, dtype=np.uint8)
+    for pixel in region:
+        segmented_img[pixel] = 255
+    return segmented_img
+
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+@pytest.mark.parametrize('threshold', [5, 20, 60])
+def test_region_growing_matches_brute_force(connectivity, threshold):
+    # a bright square on a ramp, plus noise without ties.
+    img = np.add.outer(np.arange(12.), np.arange(10.)) * 3
+    img[3:8, 2:6] += 80
+    img += np.random.RandomState(0).rand(12, 10)
+    for seed in [(5, 4), (0, 0), (11, 9)]:
+        expected = brute_region_growing(img, [seed], threshold, connectivity)
+        np.testing.assert_array_equal(cr.region_growing(img, seed, threshold, connectivity),
+                                      expected)
+
+
+@pytest.mark.parametrize('connectivity', [6, 26])
+def test_region_growing_3D_and_several_seeds(connectivity):
+    img = np.random.RandomState(1).rand(4, 6, 5) * 50
+    seeds = [(0, 0, 0), (3, 5, 4), (2, 3, 1)]
+    expected = brute_region_growing(img, seeds, 15, connectivity)
+    np.testing.assert_array_equal(cr.region_growing(img, seeds, 15, connectivity), expected)
+    mask = np.zeros(img.shape, dtype=bool)
+    mask[tuple(np.transpose(seeds))] = True
+    np.testing.assert_array_equal(cr.region_growing(img, mask, 15, connectivity), expected)
+
+
+def test_region_growing_rejects_seeds_outside():
+    with pytest.raises(ValueError):
+        cr.region_growing(np.zeros((4, 4)), (-1, 2))
+    with pytest.raises(ValueError):
+        cr.region_growing(np.zeros((4, 4)), [(1, 1), (4, 0)])
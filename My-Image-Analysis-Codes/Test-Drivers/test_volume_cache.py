@@ -0,0 +1,52 @@
+import os
+import time
+import numpy as np
+import pytest
+
+import imageanalysis.IO as IO
+import imageanalysis.core as cr
+
+try:
+    IO._dicom_module()
+except ImportError:
+    pytest.skip("neither dicom nor pydicom is installed", allow_module_level=True)
+import phantom as ph
+
+
+@pytest.fixture
+def study(tmp_path):
+    volume, truth = ph.phantom_volume(no_slices=3, no_time_steps=4, size=16)
+    folder = str(tmp_path / 'study')
+    ph.write_dicom_series(folder, volume, truth)
+    return folder, volume, truth
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_volume_cache_is_the_volume_of_the_files(study, workers):
+    folder, volume, truth = study
+    # the slow way: every profile, then every depth on its own.
+    profiles = IO.load_dcm_profiles(folder)
+    expected = np.array([cr.matrix_of_all_times(profiles, location, 4, 16)
+                         for location in truth['slice_locations']])
+    np.testing.assert_array_equal(expected, volume)
+    cached, metadata = IO.build_volume_cache(folder, workers=workers)
+    assert cached.dtype == volume.dtype
+    np.testing.assert_array_equal(cached, expected)
+    assert metadata['slice_locations'] == truth['slice_locations']
+    np.testing.assert_array_equal(cr.assemble_4D(profiles)[0], expected)
+
+
+def test_volume_cache_is_built_again_when_a_file_changes(study):
+    folder, volume, truth = study
+    cached, metadata = IO.open_volume_cache(folder)
+    np.testing.assert_array_equal(cached, volume)
+    del cached
+    # a file written again (a later time stamp) with other pixels.
+    changed = volume.copy()
+    changed[1, 2] = 7
+    time.sleep(0.01)
+    ph.write_dicom_series(folder, changed, truth)
+    for name in IO.list_dcm_files(folder):
+        os.utime(name, None)
+    cached, metadata = IO.open_volume_cache(folder)
+    np.testing.assert_array_equal(cached, changed)
@@ -0,0 +1,168 @@
+"""
+Synthetic dynamic studies, like a contrast-enhanced scan of our data:
+several slices, every slice imaged at several times, with shapes whose
+labels and time curves are known.
+
+    volume, truth = phantom_volume(no_slices=4, no_time_steps=8, size=128)
+    write_dicom_series('/tmp/phantom', volume, truth)
+    volume, metadata = IO.open_volume_cache('/tmp/phantom')
+
+The body is an ellipse of healthy tissue with a tumor (a ball, so its disk
+changes from slice to slice) and a vessel (a tube through all slices) in
+it, and air around. Each of them follows its own enhancement curve:
+the vessel peaks early and washes out, the tumor takes up fast and washes
+out slowly, the healthy tissue takes up slowly. The images are magnitude
+images, so the noise is Rician (the magnitude of the signal plus complex
+gaussian noise), and they are stored as int16 like the scanner does.
+"""
+
+import os
+import uuid
+import numpy as np  ##linear algebra
+import imageanalysis.IO as IO
+
+# label numbers of truth['labels'], in the order of final_label(testData, Tumor, Healthy, Vessel).
+TUMOR, HEALTHY, VESSEL, AIR = 0, 1, 2, -1
+
+
+def enhancement_curves(times):
+    """
+    Noiseless intensities of the tumor, healthy tissue and vessel at the
+    given times (seconds), a (3, no_times) matrix in the order of the labels.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    vessel = 250 + 900 * (times / 8.) ** 2 * np.exp(2 - times / 4.)
+    tumor = 350 + 450 * (1 - np.exp(-times / 6.)) * np.exp(-times / 120.)
+    healthy = 300 + 180 * (1 - np.exp(-times / 40.))
+    return np.array([tumor, healthy, vessel])
+
+
+def phantom_labels(no_slices, size):
+    """
+    Labels (no_slices, size, size) of the shapes, TUMOR, HEALTHY, VESSEL or AIR.
+    """
+    y, x = np.mgrid[-1:1:size * 1j, -1:1:size * 1j]
+    labels = np.full((no_slices, size, size), AIR, dtype=np.int8)
+    middle = (no_slices - 1) / 2.
+    for slice_count in range(no_slices):
+        # the tumor is a ball in the middle slices, the vessel drifts a little.
+        depth = (slice_count - middle) / max(middle, 1.)
+        tumor_radius = 0.28 * np.sqrt(max(1 - (depth / 0.8) ** 2, 0))
+        vessel_x = -0.35 + 0.05 * depth
+        body = (x / 0.85) ** 2 + (y / 0.7) ** 2 < 1
+        labels[slice_count][body] = HEALTHY
+        labels[slice_count][(x - 0.25) ** 2 + (y + 0.15) ** 2 < tumor_radius ** 2] = TUMOR
+        labels[slice_count][(x - vessel_x) ** 2 + (y - 0.3) ** 2 < 0.07 ** 2] = VESSEL
+    return labels
+
+
+def phantom_volume(no_slices=4, no_time_steps=8, size=128, noise=20., time_step=4.,
+                   first_location=-140., slice_spacing=5., seed=0):
+    """
+    input: no_slices, no_time_steps, size : shape of the study, the images
+                                            are size x size.
+           noise          : standard deviation of the gaussian noise of the
+                            real and imaginary parts (the signal is a few hundreds).
+           time_step      : seconds between two images of a slice.
+           first_location, slice_spacing : SliceLocation of the slices,
+                            first_location, first_location - slice_spacing, ...
+           seed           : of the random noise, the same seed gives the same study.
+
+    output: (volume, truth)
+            volume is (no_slices, no_time_steps, size, size) int16, slices
+            in the order of extract_sliceLocation_names (decreasing location).
+            truth is a dictionary of
+              'labels'          : (no_slices, size, size), TUMOR, HEALTHY, VESSEL, AIR
+              'curves'          : (3, no_time_steps) noiseless curve of each label
+              'slice_locations' : SliceLocation of every slice
+              'times'           : seconds of every time step
+              'seed'            : (slice, row, col) of a pixel in the middle of the tumor
+    """
+    random = np.random.RandomState(seed)
+    labels = phantom_labels(no_slices, size)
+    times = time_step * np.arange(no_time_steps)
+    curves = enhancement_curves(times)
+
+    volume = np.empty((no_slices, no_time_steps, size, size), dtype=np.int16)
+    for slice_count in range(no_slices):
+        signal = np.zeros((no_time_steps, size, size))
+        for label in (TUMOR, HEALTHY, VESSEL):
+            inside = labels[slice_count] == label
+            signal[:, inside] = curves[label][:, np.newaxis]
+        real = signal + random.normal(0, noise, signal.shape)
+        imaginary = random.normal(0, noise, signal.shape)
+        volume[slice_count] = np.round(np.hypot(real, imaginary))
+
+    middle = no_slices // 2
+    tumor_pixels = np.argwhere(labels[middle] == TUMOR)
+    truth = {'labels': labels,
+             'curves': curves,
+             'slice_locations': [first_location - slice_spacing * count
+                                 for count in range(no_slices)],
+             'times': times,
+             'seed': (middle,) + tuple(int(c) for c in np.round(tumor_pixels.mean(axis=0)))}
+    return volume, truth
+
+
+def _uid():
+    # UIDs under the 2.25 root are made of a UUID.
+    return '2.25.%d' % uuid.uuid4().int
+
+
+def write_dicom_series(folder_path, volume, truth, start_seconds=36000.):
+    """
+    Writes a study as the scanner folders we get: one sub-folder per time
+    step (000, 001, ...) with one .dcm file per slice (IM000.dcm, ...), each
+    with SliceLocation, AcquisitionTime and the pixels (uncompressed int16),
+    so it can be read by every loader of IO.
+
+    input: folder_path   : created if it does not exist.
+           volume, truth : output of phantom_volume.
+           start_seconds : AcquisitionTime of the first time step, in seconds
+                           after midnight.
+
+    output: list of the paths of the files written.
+    """
+    dicom = IO._dicom_module()
+    Dataset = dicom.dataset.Dataset
+    FileMetaDataset = getattr(dicom.dataset, 'FileMetaDataset', Dataset)
+    no_slices, no_time_steps, rows, cols = volume.shape
+    series_uid = _uid()
+    file_list = []
+    for time_count in range(no_time_steps):
+        time_folder = os.path.join(folder_path, '%03d' % time_count)
+        if not os.path.isdir(time_folder):
+            os.makedirs(time_folder)
+        seconds = start_seconds + truth['times'][time_count]
+        acquisition_time = '%02d%02d%09.6f' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+        for slice_count in range(no_slices):
+            instance_uid = _uid()
+            file_meta = FileMetaDataset()
+            file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'  # MR image
+            file_meta.MediaStorageSOPInstanceUID = instance_uid
+            file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'         # explicit VR little endian
+            file_name = os.path.join(time_folder, 'IM%03d.dcm' % slice_count)
+            profile = dicom.dataset.FileDataset(file_name, {}, file_meta=file_meta,
+                                                preamble=b'\0' * 128)
+            profile.is_little_endian = True
+            profile.is_implicit_VR = False
+            profile.SOPClassUID = file_meta.MediaStorageSOPClassUID
+            profile.SOPInstanceUID = instance_uid
+            profile.SeriesInstanceUID = series_uid
+            profile.Modality = 'MR'
+            profile.InstanceNumber = time_count * no_slices + slice_count + 1
+            profile.SliceLocation = truth['slice_locations'][slice_count]
+            profile.AcquisitionTime = acquisition_time
+            profile.Rows = rows
+            profile.Columns = cols
+            profile.SamplesPerPixel = 1
+            profile.PhotometricInterpretation = 'MONOCHROME2'
+            profile.BitsAllocated = 16
+            profile.BitsStored = 16
+            profile.HighBit = 15
+            profile.PixelRepresentation = 1
+            profile.PixelData = np.ascontiguousarray(volume[slice_count, time_count],
+                                                     dtype='<i2').tobytes()
+            profile.save_as(file_name)
+            file_list.append(file_name)
+    return file_list
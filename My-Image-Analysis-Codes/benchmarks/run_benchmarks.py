@@ -0,0 +1,264 @@
+"""
+Benchmarks of the hot paths, on synthetic studies (see phantom.py).
+
+Run from My-Image-Analysis-Codes:
+    python benchmarks/run_benchmarks.py                          # sizes 64 128 256
+    python benchmarks/run_benchmarks.py --sizes 128 512 --only denoise_tv non_local_mean
+    python benchmarks/run_benchmarks.py --compare benchmark-1d0cbf4.json
+
+For every image size a study of --slices slices and --times time steps is
+made, written as .dcm files (for the loading benchmarks), and every
+benchmark is run --repeat times; the best and the median time are kept.
+The results go to a JSON file named after the commit, e.g.
+benchmark-a40e656.json, with the machine, the versions and the settings,
+so that runs of two commits can be compared with --compare (a benchmark
+--tolerance times slower than before is reported, and the exit status is
+then 1) and the times of one run at several sizes give the scaling curves.
+
+The benchmarks call the functions through the names they have had for
+long (someName, final_label, ...), so that older commits can be measured
+too; a benchmark a commit cannot run is recorded with its error.
+The loading benchmarks need the DICOM package IO uses (dicom or pydicom),
+they are skipped without it and listed at the end of the output.
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import numpy as np  ##linear algebra
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(benchmark_dir)
+sys.path[:0] = [benchmark_dir, package_dir, os.path.dirname(package_dir)]
+
+import phantom as ph
+import imageanalysis.core as cr
+import imageanalysis.IO as IO
+
+
+def _middle_slice(study):
+    return study['volume'][study['truth']['seed'][0]]
+
+
+def _middle_frame(study):
+    stack = _middle_slice(study)
+    return stack[len(stack) // 2]
+
+
+def _fresh_cache(study):
+    cache_dir = os.path.join(study['folder'], '.benchmark_cache')
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    return (study['folder'], cache_dir)
+
+
+def _grid_adjacency(size):
+    from generateGridAdj import generateGridAdj
+    return generateGridAdj(size, size, sparse=True)
+
+
+# (name, needs the .dcm files, prepare, timed): prepare(study) is called
+# before every run, untimed, and returns the arguments of timed.
+benchmarks = [
+    ('index_dcm_series', True,
+     lambda study: (study['folder'],),
+     IO.index_dcm_series),
+    ('load_dcm_profiles', True,
+     lambda study: (study['folder'],),
+     IO.load_dcm_profiles),
+    # the pixels are decoded by assemble_4D, so the profiles are read again every run.
+    ('assemble_4D', True,
+     lambda study: (IO.load_dcm_profiles(study['folder']),),
+     lambda profiles: cr.assemble_4D(profiles)),
+    ('build_volume_cache', True,
+     _fresh_cache,
+     IO.build_volume_cache),
+    ('aggregate_2D', False,
+     lambda study: (_middle_frame(study), 4),
+     cr.aggregate_2D),
+    ('aggregate_3D', False,
+     lambda study: (_middle_slice(study), 4),
+     cr.aggregate_3D),
+    ('denoise_tv', False,
+     lambda study: (_middle_slice(study),),
+     lambda stack: cr.denoise_tv(stack, weight=50)),
+    # every frame on its own, batched (image_ndim is an error before it existed).
+    ('denoise_tv_frames', False,
+     lambda study: (_middle_slice(study),),
+     lambda stack: cr.denoise_tv(stack, weight=50, image_ndim=2)),
+    ('L1TV', False,
+     lambda study: (_middle_frame(study),),
+     lambda frame: cr.someName(frame, 1, 1, [0.5, 1, 2], 50, 0.1)),
+    ('non_local_mean', False,
+     lambda study: (_middle_frame(study),),
+     cr.non_local_mean),
+    # 3 times the noise, so the region is the whole tumor.
+    ('region_growing', False,
+     lambda study: (_middle_frame(study), study['truth']['seed'][1:]),
+     lambda frame, seed: cr.region_growing(frame, seed, threshold=60)),
+    ('vectorize_tiles', False,
+     lambda study: (_middle_frame(study),),
+     cr.vectorize_tiles),
+    # every pixel of the middle slice is labeled by its curve over time.
+    ('final_label', False,
+     lambda study: (_middle_slice(study).reshape(len(_middle_slice(study)), -1).astype(np.float64),
+                    study['truth']['curves']),
+     lambda pixels, curves: cr.final_label(pixels, curves[ph.TUMOR], curves[ph.HEALTHY],
+                                           curves[ph.VESSEL], 0.4)),
+    ('generateGridAdj', False,
+     lambda study: (study['size'],),
+     _grid_adjacency),
+]
+
+
+def _has_dicom():
+    # the package IO reads with, whichever name it has.
+    try:
+        IO._dicom_module()
+    except ImportError:
+        return False
+    return True
+
+
+def _commit():
+    """(commit, whether the tree has changes), or (None, None) outside of git."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=package_dir,
+                                         stderr=subprocess.STDOUT).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                         cwd=package_dir, stderr=subprocess.STDOUT).decode()
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def time_benchmark(prepare, timed, study, repeat):
+    """times of repeat runs of timed, in seconds."""
+    times = []
+    for count in range(repeat):
+        arguments = prepare(study)
+        gc.collect()
+        start = timeit.default_timer()
+        timed(*arguments)
+        times.append(timeit.default_timer() - start)
+    return times
+
+
+def run(sizes, no_slices, no_time_steps, repeat, only=None, data_dir=None):
+    """list of the results of all benchmarks at all sizes."""
+    has_dicom = _has_dicom()
+    results = []
+    for size in sizes:
+        volume, truth = ph.phantom_volume(no_slices, no_time_steps, size)
+        folder = os.path.join(data_dir or tempfile.mkdtemp(prefix='phantom-'),
+                              'phantom-%dx%dx%d' % (no_slices, no_time_steps, size))
+        if has_dicom and not os.path.isdir(folder):
+            ph.write_dicom_series(folder, volume, truth)
+        study = {'size': size, 'volume': volume, 'truth': truth, 'folder': folder}
+        for name, needs_files, prepare, timed in benchmarks:
+            if only and name not in only:
+                continue
+            result = {'name': name, 'size': size, 'shape': list(volume.shape)}
+            if needs_files and not has_dicom:
+                result['skipped'] = "neither dicom nor pydicom is installed"
+            else:
+                try:
+                    times = time_benchmark(prepare, timed, study, repeat)
+                    result.update(times=times, best=min(times), median=float(np.median(times)))
+                except Exception as error:
+                    result['error'] = "%s: %s" % (type(error).__name__, error)
+            results.append(result)
+            print("%-18s %5d  %s" % (name, size, _describe(result)))
+            sys.stdout.flush()
+        if data_dir is None:
+            shutil.rmtree(os.path.dirname(folder), ignore_errors=True)
+    return results
+
+
+def _describe(result):
+    if 'best' in result:
+        return "%9.4f s (median %.4f s)" % (result['best'], result['median'])
+    return result.get('skipped') or result.get('error')
+
+
+def compare(old_report, new_report, tolerance):
+    """prints the ratio of the best times, returns the benchmarks slower than tolerance."""
+    old_results = dict(((result['name'], result['size']), result)
+                       for result in old_report['results'] if 'best' in result)
+    print("\n%s -> %s" % (old_report.get('commit'), new_report.get('commit')))
+    slower = []
+    for result in new_report['results']:
+        old = old_results.get((result['name'], result['size']))
+        if old is None or 'best' not in result:
+            continue
+        ratio = result['best'] / old['best']
+        if ratio > tolerance:
+            slower.append(result)
+            verdict = "SLOWER"
+        elif ratio < 1. / tolerance:
+            verdict = "faster"
+        else:
+            verdict = ""
+        print("%-18s %5d  %9.4f s -> %9.4f s  x%.2f %s" % (result['name'], result['size'],
+                                                          old['best'], result['best'],
+                                                          ratio, verdict))
+    return slower
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the hot paths on synthetic studies.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256],
+                        help="rows (and cols) of the images")
+    parser.add_argument('--slices', type=int, default=4)
+    parser.add_argument('--times', type=int, default=8, help="time steps of every slice")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=[benchmark[0] for benchmark in benchmarks])
+    parser.add_argument('--output', help="JSON file, benchmark-<commit>.json by default")
+    parser.add_argument('--data-dir', help="where the .dcm files are kept between runs "
+                                           "(a temporary folder removed at the end by default)")
+    parser.add_argument('--compare', help="JSON file of an earlier run")
+    parser.add_argument('--tolerance', type=float, default=1.2)
+    arguments = parser.parse_args(arguments)
+
+    commit, dirty = _commit()
+    report = {'commit': commit,
+              'dirty': dirty,
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.platform(),
+              'processor': platform.processor(),
+              'cpu_count': multiprocessing.cpu_count(),
+              'settings': {'sizes': arguments.sizes, 'slices': arguments.slices,
+                           'times': arguments.times, 'repeat': arguments.repeat}}
+    report['results'] = run(arguments.sizes, arguments.slices, arguments.times,
+                            arguments.repeat, arguments.only, arguments.data_dir)
+
+    skipped = [result for result in report['results'] if 'skipped' in result]
+    if skipped:
+        print("\nskipped %d of %d benchmarks:" % (len(skipped), len(report['results'])))
+        for result in skipped:
+            print("  %-18s %5d  %s" % (result['name'], result['size'], result['skipped']))
+
+    output = arguments.output or 'benchmark-%s.json' % (commit or 'unknown')
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=1)
+    print("results written to " + output)
+
+    if arguments.compare:
+        with open(arguments.compare) as old_file:
+            slower = compare(json.load(old_file), report, arguments.tolerance)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
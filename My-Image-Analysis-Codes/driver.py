@@ -1,5 +1,5 @@
 import imageanalysis.core as cr
-import imageanalysis.read_data as rd
+import imageanalysis.IO as IO
 import imageanalysis.play_movie as pm
 import numpy as np
 import os
@@ -7,12 +7,13 @@ import os
 # get the path of all folders
 folder_path = "/Users/hn/Documents/GitHub/Image-Analysis-Working-Group/data"
 
-# obtain the information of all images (590)
-all_images_list = rd.load_images(folder_path)
-print "np.size(all_images_list) from driver", np.size(all_images_list)
+# obtain all images (590) as a 4D matrix (slices, times, rows, cols).
+# the first run converts the data into a cache, next runs only map it.
+volume, metadata = IO.open_volume_cache(folder_path)
+print("np.shape(volume) from driver", np.shape(volume))
 
 # count the images
-num_of_images = len(all_images_list)  
+num_of_images = volume.shape[0] * volume.shape[1]
 
 
 time_steps = 59
@@ -21,8 +22,8 @@ image_dimension = 512
 # depth has to be chosen by user!
 depth = -165
 
-matrix = rd.matrix_of_all_times(all_images_list, depth, time_steps, image_dimension )
+matrix = volume[metadata['slice_locations'].index(depth)]
 
-print "matrix shape = ", np.shape(matrix)
-print "matrix type is", type(matrix)
-print matrix[10,10,10]
\ No newline at end of file
+print("matrix shape = ", np.shape(matrix))
+print("matrix type is", type(matrix))
+print(matrix[10,10,10])
@@ -1,58 +1,558 @@
-import scipy.io as sio
 import numpy as np  ##linear algebra
 import os           ## manipulate files and directories
-import dicom        ## communicating medical images and related information
+import multiprocessing
+import hashlib
+import json
+import struct
+import sys
+import io
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import imageanalysis.instrument as instrument
 
+# dicom and scipy.io are imported inside the functions that use them, so
+# that importing IO (e.g. through imageanalysis.stream) stays cheap.
 
-def load_dcm_profiles(folder_path):
+
+def _dicom_module():
+    """
+    The DICOM package: dicom, its old name, or pydicom (>= 1.0) where dicom
+    is not installed. ImportError without either.
+    """
+    try:
+        import dicom  ## communicating medical images and related information
+    except ImportError:
+        import pydicom as dicom
+    return dicom
+
+
+def _read_file(file_name, **kwargs):
+    dicom = _dicom_module()
+    # read_file is the only name in dicom, and is gone from pydicom 3.
+    read = getattr(dicom, 'dcmread', None) or dicom.read_file
+    return read(file_name, **kwargs)
+
+
+def list_dcm_files(folder_path):
+    """
+    Returns the paths of all files with .dcm extension that live in the
+    sub-folders of folder_path (one folder per time step).
+
+    Folders and files are visited in sorted order, so the list (and
+    everything read from it) is the same on every machine and every run.
+    """
+    folder_list = np.sort(os.listdir(folder_path))
+    file_list = []
+    for folder_name in folder_list:
+        file_path = os.path.join(folder_path, folder_name)
+        if os.path.isdir(file_path):
+            for file_name in sorted(os.listdir(file_path)):
+                if file_name.endswith('.dcm'):
+                    file_list.append(os.path.join(file_path, file_name))
+    return file_list
+
+
+def _map_files(function, file_list, workers=1, use_processes=False):
+    """
+    Applies function to every file of file_list and returns the results
+    in the order of file_list.
+
+    workers = 1 runs in the calling thread, workers = None uses one
+    worker per core. Threads are the default since reading is mostly
+    waiting on the disk, use_processes=True moves the decoding out of
+    the GIL as well (function has to be picklable then).
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(file_list))
+    if workers <= 1:
+        return [function(file_name) for file_name in file_list]
+
+    if use_processes:
+        pool = multiprocessing.Pool(workers)
+        # few big chunks, so we do not pay the pickling per file.
+        chunk_size = max(1, len(file_list) // (4 * workers))
+    else:
+        pool = ThreadPool(workers)
+        chunk_size = 1
+    try:
+        # map keeps the order of its input, whoever finishes first.
+        results = pool.map(function, file_list, chunk_size)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def _read_profile(file_name):
+    """
+    Reads one profile and decodes its pixels, so that the decoding
+    also happens inside the worker and not later in the caller.
+    """
+    patient_profile = _read_file(file_name)
+    if patient_profile is not None:
+        patient_profile.pixel_array
+    return patient_profile
+
+
+@instrument.instrumented
+def load_dcm_profiles(folder_path, workers=1, use_processes=False):
     """
     Reads all profiles with .dcm extension off the disk.
-    
+
+    input: folder_path   : directory with one sub-folder per time step.
+           workers       : number of files read at the same time.
+                           None means one per core.
+           use_processes : read in a process pool instead of a thread pool.
+
+    output: list of profiles, in sorted (folder, file) order
+            regardless of the number of workers.
+
     Cao
     """
-    # obtain the list of folders.
-    folder_list = os.listdir(folder_path)
-    folder_list = np.sort(folder_list)
-    all_profiles=[]
-    for k in range(0, np.size(folder_list)):
-        # Return a list, containing the names of 
-        # the entries in the directory given by path
-        if os.path.isdir(os.path.join(folder_path, folder_list[k])):
-            file_path = os.path.join(folder_path, folder_list[k])
-            # obtain list of folder names in a folder.
-            list_file = os.listdir(file_path)
-            for file_name in list_file:
-                if file_name.endswith('.dcm'):
-                    patient_profile = dicom.read_file(os.path.join(file_path, file_name))
-                    if patient_profile is not None:
-                        all_profiles.append(patient_profile)
-    return all_profiles
+    file_list = list_dcm_files(folder_path)
+    all_profiles = _map_files(_read_profile, file_list, workers, use_processes)
+    return [profile for profile in all_profiles if profile is not None]
+
+
+def _read_header(file_name):
+    """
+    Reads one profile without its pixels: parsing stops before PixelData.
+    """
+    return _read_file(file_name, stop_before_pixels=True)
+
+
+def _acquisition_seconds(acquisition_time):
+    """
+    Converts a DICOM time string, HHMMSS.FFFFFF, into seconds after midnight.
+    Missing or broken values become NaN.
+    """
+    try:
+        acquisition_time = str(acquisition_time).strip()
+        return (3600 * int(acquisition_time[0:2]) + 60 * int(acquisition_time[2:4]) +
+                float(acquisition_time[4:]))
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _pixel_dtype(header):
+    """
+    Numpy dtype name of the pixel data described by a header, e.g. 'int16'.
+    """
+    signed = getattr(header, 'PixelRepresentation', 0) == 1
+    return ('int' if signed else 'uint') + str(getattr(header, 'BitsAllocated', 16))
+
+
+@instrument.instrumented
+def index_dcm_series(folder_path, workers=1):
+    """
+    Reads only the headers of all profiles with .dcm extension and
+    returns a compact table of them, without touching any pixel data.
+
+    input: folder_path : same as load_dcm_profiles.
+           workers     : number of headers read at the same time.
+
+    output: numpy structured array with one row per file, in the order
+            load_dcm_profiles would return the profiles, and fields
+              file             : path of the file
+              SliceLocation    : depth of the image, e.g. -165
+              acquisition_time : seconds after midnight (NaN if missing)
+              time_index       : position of the image among the images
+                                 of the same SliceLocation (0, 1, 2, ...)
+              rows, cols       : size of the image
+              dtype            : numpy dtype of the pixels, e.g. 'int16'
+    """
+    file_list = list_dcm_files(folder_path)
+    headers = _map_files(_read_header, file_list, workers)
+    max_path = max([len(file_name) for file_name in file_list] + [1])
+    index = np.zeros(len(file_list), dtype=[('file', 'U%d' % max_path),
+                                            ('SliceLocation', np.float64),
+                                            ('acquisition_time', np.float64),
+                                            ('time_index', np.int32),
+                                            ('rows', np.int32),
+                                            ('cols', np.int32),
+                                            ('dtype', 'U8')])
+    for row, (file_name, header) in enumerate(zip(file_list, headers)):
+        index[row] = (file_name,
+                      header.SliceLocation,
+                      _acquisition_seconds(getattr(header, 'AcquisitionTime', None)),
+                      0,
+                      header.Rows,
+                      header.Columns,
+                      _pixel_dtype(header))
+
+    # count the images of each depth in reading order, like matrix_of_all_times does.
+    _, depth_ids = np.unique(index['SliceLocation'], return_inverse=True)
+    depth_ids = depth_ids.ravel()
+    order = np.argsort(depth_ids, kind='mergesort')
+    group_start = np.searchsorted(depth_ids[order], depth_ids[order])
+    index['time_index'][order] = np.arange(len(order)) - group_start
+    return index
+
+
+def select_frames(index, depth_id):
+    """
+    Rows of the index (output of index_dcm_series) that belong to
+    the depth depth_id, ordered by time_index.
+    """
+    rows = index[index['SliceLocation'] == depth_id]
+    return rows[np.argsort(rows['time_index'], kind='mergesort')]
+
+
+def _read_pixels(file_name):
+    return _read_file(file_name).pixel_array
+
+
+@instrument.instrumented
+def load_frames(index, workers=1):
+    """
+    Decodes the pixels of the rows of index (whole index or
+    the output of select_frames) and returns them as a 3D matrix
+    of size (no_rows_of_index, rows, cols) in the native dtype.
+    """
+    if len(index) == 0:
+        raise ValueError("No frames are selected!")
+    frames = np.empty((len(index), index['rows'][0], index['cols'][0]), dtype=index['dtype'][0])
+    file_list = list(index['file'])
+
+    # every frame goes straight to its place, so at most
+    # one decoded image per worker is alive besides frames.
+    def read_into(count):
+        frames[count] = _read_pixels(file_list[count])
+    _map_files(read_into, list(range(len(file_list))), workers)
+    return frames
+
+
+class LazyProfile(object):
+    """
+    Stands in for a profile of load_dcm_profiles in the functions of core.
+    SliceLocation comes from the index, and pixel_array is read off the
+    disk every time it is asked for and is not kept, so that only
+    the frames a function really uses are ever decoded.
+    """
+    def __init__(self, file_name, SliceLocation):
+        self.file_name = file_name
+        self.SliceLocation = SliceLocation
+
+    @property
+    def pixel_array(self):
+        return _read_pixels(self.file_name)
+
+
+def lazy_dcm_profiles(index):
+    """
+    Turns the index (output of index_dcm_series) into a list of
+    LazyProfile that can be given to extract_sliceLocation_names,
+    matrix_of_all_times, etc. instead of the output of load_dcm_profiles.
+    """
+    return [LazyProfile(str(row['file']), float(row['SliceLocation'])) for row in index]
+
+
+def _folder_fingerprint(folder_path, file_list):
+    """
+    Hash of the names, sizes and modification times of the files,
+    which changes whenever a file is added, removed or rewritten.
+    """
+    fingerprint = hashlib.sha1()
+    for file_name in file_list:
+        status = os.stat(file_name)
+        fingerprint.update(("%s|%d|%r\n" % (os.path.relpath(file_name, folder_path),
+                                             status.st_size,
+                                             status.st_mtime)).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def _volume_cache_paths(folder_path, cache_dir):
+    if cache_dir is None:
+        cache_dir = os.path.join(folder_path, '.volume_cache')
+    return (cache_dir,
+            os.path.join(cache_dir, 'volume.npy'),
+            os.path.join(cache_dir, 'metadata.json'))
+
+
+@instrument.instrumented
+def build_volume_cache(folder_path, cache_dir=None, workers=1):
+    """
+    Converts the study in folder_path into a 4D matrix of size
+    (no_slices, no_time_steps, rows, cols), in the dtype of the files,
+    stored on the disk as cache_dir/volume.npy, next to a small
+    cache_dir/metadata.json describing it.
+
+    The default cache_dir is folder_path/.volume_cache.
+    Slices are sorted like extract_sliceLocation_names does (decreasing).
+
+    output: (volume, metadata), where volume is the memory-mapped matrix.
+    """
+    cache_dir, volume_path, metadata_path = _volume_cache_paths(folder_path, cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    file_list = list_dcm_files(folder_path)
+    fingerprint = _folder_fingerprint(folder_path, file_list)
+    index = index_dcm_series(folder_path, workers)
+    if len(index) == 0:
+        raise ValueError("There is no .dcm file in " + folder_path)
+
+    slice_locations = sorted(np.unique(index['SliceLocation']).tolist(), reverse=True)
+    no_time_steps = int(index['time_index'].max()) + 1
+    if len(index) != len(slice_locations) * no_time_steps:
+        raise ValueError("Slices do not have the same number of time steps, "
+                         "%d images for %d slices and %d time steps."
+                         % (len(index), len(slice_locations), no_time_steps))
+    shape = (len(slice_locations), no_time_steps, int(index['rows'][0]), int(index['cols'][0]))
+    slice_ids = len(slice_locations) - 1 - np.searchsorted(slice_locations[::-1],
+                                                          index['SliceLocation'])
+
+    # write everything under a temporary name, so that a crash
+    # half way never leaves a volume that looks complete.
+    temporary_path = volume_path + '.part'
+    volume = np.lib.format.open_memmap(temporary_path, mode='w+',
+                                       dtype=index['dtype'][0], shape=shape)
+
+    # the memmap is given to read_into, not taken from this scope, so that
+    # dropping both below closes the file before it is renamed.
+    def read_into(row, volume=volume):
+        volume[slice_ids[row], index['time_index'][row]] = _read_pixels(index['file'][row])
+    _map_files(read_into, list(range(len(index))), workers)
+    volume.flush()
+    del read_into, volume
+
+    acquisition_times = np.full(shape[:2], np.nan)
+    acquisition_times[slice_ids, index['time_index']] = index['acquisition_time']
+    metadata = {'source': os.path.abspath(folder_path),
+                'fingerprint': fingerprint,
+                'shape': list(shape),
+                'dtype': str(index['dtype'][0]),
+                'slice_locations': slice_locations,
+                'acquisition_times': [[None if np.isnan(t) else t for t in times]
+                                      for times in acquisition_times.tolist()]}
+    os.rename(temporary_path, volume_path)
+    with open(metadata_path, 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=1)
+    return np.load(volume_path, mmap_mode='r'), metadata
+
+
+def open_volume_cache(folder_path, cache_dir=None, workers=1):
+    """
+    Opens the 4D matrix written by build_volume_cache with numpy.memmap,
+    so that pages of it are read off the disk only when they are used.
+    If there is no cache yet, or the .dcm files have changed since it
+    was written, the cache is built (again) first.
+
+    output: (volume, metadata). Images of a given depth at all times are
+            volume[metadata['slice_locations'].index(depth)]
+    """
+    _, volume_path, metadata_path = _volume_cache_paths(folder_path, cache_dir)
+    if os.path.isfile(volume_path) and os.path.isfile(metadata_path):
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+        fingerprint = _folder_fingerprint(folder_path, list_dcm_files(folder_path))
+        if metadata.get('fingerprint') == fingerprint:
+            return np.load(volume_path, mmap_mode='r'), metadata
+    return build_volume_cache(folder_path, cache_dir, workers)
+
+
+def _mat5_writer(file_stream):
+    try:
+        from scipy.io.matlab._mio5 import MatFile5Writer
+    except ImportError:
+        from scipy.io.matlab.mio5 import MatFile5Writer
+    return MatFile5Writer(file_stream)
+
+
+class MatrixStore(object):
+    """
+    Reads and writes variables of MATLAB-formatted matrix files.
+
+    The first time a (version 5) file is used, its directory, i.e. name,
+    offset and size of every variable, is read once. After that only the
+    bytes of the variables asked for are read and parsed. Variables read
+    recently are kept in a cache of at most max_bytes bytes, the least
+    recently used ones are dropped first. When the modification time or
+    size of a file changes, its directory and cached variables are dropped.
+
+    Cached matrices are shared between calls, so they are read-only.
+    Copy them (np.array(m)) if you want to change them.
+    """
+    _HEADER_SIZE = 128
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self._directories = {}
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
+    def _stamp(self, filename):
+        status = os.stat(filename)
+        return (status.st_mtime, status.st_size)
+
+    def _read_directory(self, filename):
+        """
+        Returns (header, entries) where entries is an OrderedDict
+        name -> (offset, length) of the variables, and header is the
+        first 128 bytes of the file. entries is None if the file is not a
+        MATLAB 5 file (version 4 and 7.3 files are read as a whole).
+        """
+        import scipy.io as sio
+        with open(filename, 'rb') as mat_file:
+            header = mat_file.read(self._HEADER_SIZE)
+            if len(header) < self._HEADER_SIZE or header[126:128] not in (b'IM', b'MI'):
+                return header, None
+            byte_order = '<' if header[126:128] == b'IM' else '>'
+            offsets = []
+            position = self._HEADER_SIZE
+            while True:
+                tag = mat_file.read(8)
+                if len(tag) < 8:
+                    break
+                data_type, no_bytes = struct.unpack(byte_order + 'II', tag)
+                offsets.append((position, 8 + no_bytes))
+                position += 8 + no_bytes
+                mat_file.seek(position)
+        names = [variable[0] for variable in sio.whosmat(filename)]
+        if len(names) != len(offsets):
+            return header, None
+        return header, OrderedDict(zip(names, offsets))
+
+    def _directory(self, filename):
+        stamp = self._stamp(filename)
+        known = self._directories.get(filename)
+        if known is None or known[0] != stamp:
+            self.invalidate(filename)
+            known = (stamp,) + self._read_directory(filename)
+            self._directories[filename] = known
+        return known[1], known[2]
+
+    def variable_names(self, filename):
+        """
+        Names of the variables stored in filename, in the order of the file.
+        """
+        import scipy.io as sio
+        header, entries = self._directory(filename)
+        if entries is None:
+            return [variable[0] for variable in sio.whosmat(filename)]
+        return list(entries)
+
+    def load(self, filename, name):
+        """
+        Returns the value of the variable name of the file filename.
+        Raises KeyError if there is no such variable.
+        """
+        import scipy.io as sio
+        header, entries = self._directory(filename)
+        key = (filename, name)
+        if key in self._cache:
+            value = self._cache.pop(key)
+            self._cache[key] = value
+            return value
+
+        if entries is None:
+            value = sio.loadmat(filename, variable_names=[name])[name]
+        else:
+            offset, length = entries[name]
+            with open(filename, 'rb') as mat_file:
+                mat_file.seek(offset)
+                element = mat_file.read(length)
+            value = sio.loadmat(io.BytesIO(header + element))[name]
+        self._remember(key, value)
+        return value
+
+    def _remember(self, key, value):
+        size = getattr(value, 'nbytes', 0)
+        if size > self.max_bytes:
+            return
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+        self._cache[key] = value
+        self._cached_bytes += size
+        while self._cached_bytes > self.max_bytes:
+            old_key, old_value = self._cache.popitem(last=False)
+            self._cached_bytes -= getattr(old_value, 'nbytes', 0)
+
+    def invalidate(self, filename=None):
+        """
+        Forgets the directory and cached variables of filename (of all files if None).
+        """
+        for key in list(self._cache):
+            if filename is None or key[0] == filename:
+                self._cached_bytes -= getattr(self._cache.pop(key), 'nbytes', 0)
+        if filename is None:
+            self._directories.clear()
+        else:
+            self._directories.pop(filename, None)
+
+    def save(self, filename, matDict, mode='w'):
+        """
+        Writes the variables of the dictionary matDict into filename.
+
+        mode = 'w' writes a new file.
+        mode = 'a' keeps the variables already in the file. New variables
+               are appended at the end of the file, and if some of them are
+               already there, the bytes of the other variables are copied as
+               they are (not decoded and encoded again) to a new file,
+               followed by the new values.
+        """
+        import scipy.io as sio
+        if mode == 'w' or not os.path.isfile(filename):
+            sio.savemat(filename, matDict)
+            self.invalidate(filename)
+            return
+        if mode != 'a':
+            raise ValueError("mode has to be 'w' or 'a', not %r" % (mode,))
+
+        header, entries = self._directory(filename)
+        if entries is None or header[126:128] != (b'IM' if sys.byteorder == 'little' else b'MI'):
+            # not a file we can append to, read it all and write it again.
+            everything = dict((name, value) for name, value in sio.loadmat(filename).items()
+                              if not name.startswith('__'))
+            everything.update(matDict)
+            sio.savemat(filename, everything)
+        elif any(name in entries for name in matDict):
+            temporary_name = filename + '.part'
+            with open(filename, 'rb') as old_file:
+                with open(temporary_name, 'wb') as new_file:
+                    new_file.write(header)
+                    for name, (offset, length) in entries.items():
+                        if name not in matDict:
+                            old_file.seek(offset)
+                            new_file.write(old_file.read(length))
+                    _mat5_writer(new_file).put_variables(matDict, write_header=False)
+            os.rename(temporary_name, filename)
+        else:
+            # not 'ab': the writer goes back to fill in the sizes of what it wrote.
+            with open(filename, 'r+b') as mat_file:
+                mat_file.seek(0, os.SEEK_END)
+                _mat5_writer(mat_file).put_variables(matDict, write_header=False)
+        self.invalidate(filename)
+
+
+# store shared by loadNamedMatrix and saveMatrix.
+matrix_store = MatrixStore()
 
 
 def loadNamedMatrix(filename, name):
     """
     Read a MATLAB-formatted matrix from a file, and extract the
     given named variable and return its value.
+
+    Only the variable asked for is read, and it is kept in the cache of
+    matrix_store for the next calls (so the returned matrix is read-only).
     """
     try:
-        mat = sio.loadmat(filename)
-        m = mat[name]
+        m = matrix_store.load(filename, name)
     except:
         print("ERROR: could not load matrix "+filename)
         m = None
     return m
 
 
-def saveMatrix(filename, matDict):
+def saveMatrix(filename, matDict, mode='w'):
     """
     Write a MATLAB-formatted matrix file given a dictionary of
-    variables.
+    variables. mode = 'a' adds (or replaces) the variables of matDict
+    and keeps the others of the file, see MatrixStore.save.
     """
     try:
-        sio.savemat(filename, matDict)
+        matrix_store.save(filename, matDict, mode)
     except:
         print("ERROR: could not write matrix file "+filename)
-
-
-
-
@@ -1,17 +1,15 @@
 import numpy as np  ##linear algebra
-import os     ## manipulate files and directories
-import dicom  ## communicating medical images and related information
-import matplotlib.pyplot as plt  ## display the image
-import cProfile
-import timeit
-import scipy as sp 
-import scipy.ndimage as nd
-import scipy.ndimage
-import matplotlib.animation as animation
-import matplotlib.image as mpimg
-from time import sleep
-import glob
 import math
+import heapq
+import itertools
+import imageanalysis.distance as ds
+import imageanalysis.instrument as instrument
+
+# Only numpy is imported here, so that the numeric functions load fast
+# (process-pool workers, short scripts). scipy and matplotlib are imported
+# inside the few functions that need them, on their first call.
+# Keep it that way: Test-Drivers/import_time.py checks the import time.
+
 
 def extract_sliceLocation_names(all_profile, no_slices=10):
     """
@@ -27,7 +25,7 @@ def extract_sliceLocation_names(all_profile, no_slices=10):
 
     # counter of number of new slice names.
     count_slicelocation_found = 0
-    for ii in xrange(len(all_profile)):
+    for ii in range(len(all_profile)):
         if count_slicelocation_found == 0:
             sliceLocation_names[count_slicelocation_found] = all_profile[ii].SliceLocation
             count_slicelocation_found += 1
@@ -38,7 +36,7 @@ def extract_sliceLocation_names(all_profile, no_slices=10):
     return sorted(sliceLocation_names, reverse=True)
 
 
-def matrix_of_all_times(all_profiles, depth_id, no_time_steps, image_dimension):
+def matrix_of_all_times(all_profiles, depth_id, no_time_steps, image_dimension, dtype=None):
     """
     input: all_profiles is list of all images, for example here we have
            imges taken at 10 different depths, over 59 time_steps, so, 
@@ -46,23 +44,31 @@ def matrix_of_all_times(all_profiles, depth_id, no_time_steps, image_dimension):
            
            no_time_steps is the number of times an image is taken.
            image_dimension is the dimension of image (assumed to be square).
+           dtype is the dtype of the output. By default it is the dtype of the
+           pixels (int16 for our data), which takes 1/4 of the memory of float64.
            
     output: a 3D-matrix containing the images taken over time of the same layer.
+            ValueError if no image has that depth.
     
     Takes all the data available, 
     goes through all depths and all time steps, and returns a matrix corresponding to
     a given depth (as an input) at all times!
     """
-    image_matrix = np.zeros((no_time_steps, image_dimension, image_dimension))
-    count_found = 0
     if len(all_profiles)==0:
         raise ValueError("Profiles are empty, you might see a fully white movie!")
+    image_matrix = None
+    count_found = 0
     for j in range(0, len(all_profiles)):
         loc = all_profiles[j].SliceLocation
         if loc == depth_id:
             imgg = all_profiles[j].pixel_array
+            if image_matrix is None:
+                image_matrix = np.zeros((no_time_steps, image_dimension, image_dimension),
+                                        dtype=imgg.dtype if dtype is None else dtype)
             image_matrix[count_found, :, :] = imgg
             count_found += 1
+    if image_matrix is None:
+        raise ValueError("There is no image of depth %r in the profiles." % (depth_id,))
     return image_matrix
 
 def extract_2D_submatrix_center(image_matrix, center_coor, margin_size=1):
@@ -143,7 +149,77 @@ def extract_3D_submatrix_upper(image_matrices, upper_left, sub_size):
     return image_matrices[:, start_row:end_row, start_col:end_col]
 
 
-def aggregate_2D(matrix_2D, sub_matrix_dim):
+_block_functions = {'mean': (np.mean, np.nanmean),
+                    'sum': (np.sum, np.nansum),
+                    'max': (np.max, np.nanmax),
+                    'min': (np.min, np.nanmin),
+                    'median': (np.median, np.nanmedian)}
+
+
+@instrument.instrumented
+def block_reduce(array, block_size, func='mean', edge='crop', dtype=None):
+    """
+    Reduces every block of an array to one number, in one call for the
+    whole array (e.g. all slices and times of a (slice, time, rows, cols) volume).
+
+    input: array      : matrix of any dimension.
+           block_size : size of the blocks, an int (same size along every axis)
+                        or a tuple of sizes for the last len(block_size) axes;
+                        the other axes are not reduced. For example (2, 2) on a
+                        (slice, time, rows, cols) volume averages 2 x 2 pixels
+                        of every image.
+           func       : 'mean', 'sum', 'max', 'min' or 'median'.
+           edge       : what to do when a size is not a multiple of the block size.
+                        'crop': the last incomplete blocks are dropped.
+                        'pad' : they are kept and reduced over the entries they
+                                have (the array is padded with NaN, so the output
+                                is a float).
+           dtype      : dtype of the output. By default float64 for 'mean' and
+                        'median' and the dtype of array for the others
+                        ('sum' follows np.sum).
+
+    output: matrix of shape array.shape // block_size ('crop') or
+            ceil(array.shape / block_size) ('pad').
+    """
+    array = np.asarray(array)
+    if func not in _block_functions:
+        raise ValueError("func has to be one of " + ", ".join(sorted(_block_functions)) + ".")
+    if edge not in ('crop', 'pad'):
+        raise ValueError("edge has to be 'crop' or 'pad'.")
+    if np.isscalar(block_size):
+        block_size = (block_size,) * array.ndim
+    block_size = (1,) * (array.ndim - len(block_size)) + tuple(block_size)
+    if len(block_size) != array.ndim or min(block_size) < 1:
+        raise ValueError("block_size has to be positive, with at most one entry per axis.")
+
+    reduce_function, nan_function = _block_functions[func]
+    if edge == 'crop':
+        no_blocks = [length // size for length, size in zip(array.shape, block_size)]
+        array = array[tuple(slice(0, n * size) for n, size in zip(no_blocks, block_size))]
+    else:
+        no_blocks = [-(-length // size) for length, size in zip(array.shape, block_size)]
+        padding = [(0, n * size - length)
+                   for n, size, length in zip(no_blocks, block_size, array.shape)]
+        if any(after for before, after in padding):
+            float_dtype = dtype if dtype is not None and np.issubdtype(dtype, np.floating) else np.float64
+            array = np.pad(array.astype(float_dtype, copy=False), padding,
+                           mode='constant', constant_values=np.nan)
+            reduce_function = nan_function
+
+    # (n0, b0, n1, b1, ...): the blocks are along the odd axes.
+    blocks = array.reshape([value for pair in zip(no_blocks, block_size) for value in pair])
+    axes = tuple(range(1, blocks.ndim, 2))
+    if func in ('mean', 'sum'):
+        if dtype is None and func == 'mean':
+            dtype = np.float64
+        return reduce_function(blocks, axis=axes, dtype=dtype)
+    reduced = reduce_function(blocks, axis=axes)
+    if dtype is None and func == 'median':
+        dtype = np.float64
+    return reduced if dtype is None else reduced.astype(dtype, copy=False)
+
+
+def aggregate_2D(matrix_2D, sub_matrix_dim, dtype=np.float64):
     """
     input : matrix_2D is the matrix of an image.
             sub_matrix_dim is dimension of the tiles or submatrices we want.
@@ -151,39 +227,92 @@ def aggregate_2D(matrix_2D, sub_matrix_dim):
             and we want to produce a smaller matrix
             by averaging over entries of submatrices of size 2 x 2 to get 
             a matrix of size 128 x 128
+            dtype is the precision the means are computed in (np.float32 or np.float64).
             
-    output: a matrix of size m x m where m = np.shape(matrix)[0] / sub_matrix_dim
+    output: a matrix of size (no_rows // sub_matrix_dim) x (no_cols // sub_matrix_dim),
+            the image does not have to be square. See block_reduce.
     
     Hossein
     """
-    h, w = matrix_2D.shape
-    n = matrix_2D.size / (sub_matrix_dim ** 2)
-    block_matrix = (matrix_2D.reshape(h//sub_matrix_dim, sub_matrix_dim, -1, sub_matrix_dim)
-                    .swapaxes(1,2)
-                    .reshape(-1, sub_matrix_dim, sub_matrix_dim))
-    reduced_matrix = np.mean(np.mean(block_matrix, axis = 1), axis = 1)
-    reduced_matrix = reduced_matrix.reshape(int(sqrt(n)), int(sqrt(n)))
-    return reduced_matrix
+    return block_reduce(matrix_2D, (sub_matrix_dim, sub_matrix_dim), 'mean', dtype=dtype)
 
 
-def aggregate_3D(matrix_3D, sub_matrix_dim):
+def aggregate_3D(matrix_3D, sub_matrix_dim, dtype=np.float64):
     """
     input:   matrix_3D is the matrix of the same depth at different times.
              matrix_3D.shape = time_size, image_dimension. 
              In our example time = 59, and image_dimension = 512.
            
              sub_matrix_dim is the dimension of the submatrices we want to extract.
-    output:  the aggregated matrix. 
+             dtype is the precision of the output (np.float32 or np.float64).
+    output:  the aggregated matrix, all times in one call (see block_reduce).
     
     Hossein
     """
-    (time_size, no_rows, no_col) = matrix_3D.shape
-    reduced_mat_size = no_rows / sub_matrix_dim
-    reduced_matrix = np.zeros((time_size, reduced_mat_size, reduced_mat_size))
-    
-    for time in xrange(time_size):
-        reduced_matrix[time, :, :] = aggregate_2D(matrix_3D[time, :,:], sub_matrix_dim)
-    return reduced_matrix
+    return block_reduce(matrix_3D, (sub_matrix_dim, sub_matrix_dim), 'mean', dtype=dtype)
+
+
+@instrument.instrumented
+def assemble_4D(all_profiles, sliceLocation_names=None, no_time_steps=None, dtype=None):
+    """
+    input: all_profiles        : list of all profiles (all layers, all times),
+                                 output of load_dcm_profiles.
+           sliceLocation_names : names of slices, like -145, -150, etc.
+                                 (output of extract_sliceLocation_names).
+                                 If not given, all slices of all_profiles are used.
+           no_time_steps       : number of times an image is taken. If not
+                                 given, it is counted from the profiles.
+           dtype               : dtype of the output. By default the dtype of
+                                 the pixels (int16 for our data).
+
+    output: (volume, slices_evolutions)
+            volume is a 4D matrix of size (no_slices, no_time_steps, rows, cols),
+            slices in the order of sliceLocation_names.
+            slices_evolutions is a dictionary like find_evolution_of_all_slices
+            returns, whose values are views into volume (no copies).
+
+    Each profile is visited once: its slice comes from SliceLocation and
+    its time from the number of images of that slice seen before it
+    (like matrix_of_all_times does), and its pixels are written directly
+    to their place in volume. Profiles of other slices are skipped.
+    It is checked that every slice has exactly no_time_steps images.
+    """
+    if len(all_profiles) == 0:
+        raise ValueError("Profiles are empty, there is nothing to assemble!")
+    if sliceLocation_names is None:
+        sliceLocation_names = sorted(set(profile.SliceLocation for profile in all_profiles),
+                                     reverse=True)
+    slice_position = dict((name, count) for count, name in enumerate(sliceLocation_names))
+
+    # bucket the profiles: (slice, time) of every profile we want.
+    no_found = [0] * len(sliceLocation_names)
+    buckets = []
+    for profile in all_profiles:
+        slice_count = slice_position.get(profile.SliceLocation)
+        if slice_count is not None:
+            buckets.append((slice_count, no_found[slice_count], profile))
+            no_found[slice_count] += 1
+
+    if no_time_steps is None:
+        no_time_steps = max(no_found)
+    incomplete = [(name, found) for name, found in zip(sliceLocation_names, no_found)
+                  if found != no_time_steps]
+    if incomplete:
+        raise ValueError("Expected %d time steps for each slice, found (slice, time steps): %s"
+                         % (no_time_steps, incomplete))
+
+    first_image = buckets[0][2].pixel_array
+    if dtype is None:
+        dtype = first_image.dtype
+    volume = np.empty((len(sliceLocation_names), no_time_steps) + first_image.shape, dtype=dtype)
+    volume[buckets[0][0], buckets[0][1]] = first_image
+    for slice_count, time_count, profile in buckets[1:]:
+        volume[slice_count, time_count] = profile.pixel_array
+
+    slices_evolutions = {}
+    for slice_count, name in enumerate(sliceLocation_names):
+        slices_evolutions["slice" + str(int(np.abs(name)))] = volume[slice_count]
+    return volume, slices_evolutions
 
 
 def find_evolution_of_all_slices(all_profile_list, sliceLocation_names, no_time_steps=59, image_dimensions=[512, 512]):
@@ -193,24 +322,18 @@ def find_evolution_of_all_slices(all_profile_list, sliceLocation_names, no_time_
      2- sliceLocation_names which are names of slices, like -145, -150, etc.
      3- no_time_steps: in our project there are 59 of them.
      4- dimension of images: in our project 512-by-512
+        (not needed anymore, the size is read off the images)
     
     output:
      a dictionary with keys equal to "slice" + "sliceName", eg. slice185, slice165, etc.
        (except that slices have negative names like -185, this name is positive)
-     whose values are 3D matrices (firsrt two dimensions are image, last dimension is time) 
+     whose values are 3D matrices (first dimension is time, last two dimensions are image) 
      corresponding to a given layer at all time shots.
+     All of them are views into one 4D matrix, see assemble_4D.
      
      Hossein
     """
-    slices_evolutions = {}
-    for sliceCount in xrange(len(sliceLocation_names)):
-        key_name = "slice" + str(int(np.abs(sliceLocation_names[0])))
-        for profile_count in xrange(len(all_profile_list)):
-            evolution_matrix = matrix_of_all_times(all_profile_list, 
-                                                   sliceLocation_names[sliceCount], 
-                                                   no_time_steps, 
-                                                   image_dimensions)
-            slices_evolutions[key_name] = evolution_matrix
+    volume, slices_evolutions = assemble_4D(all_profile_list, sliceLocation_names, no_time_steps)
     return slices_evolutions
 
 def rgb2gray(rgb):
@@ -219,9 +342,51 @@ def rgb2gray(rgb):
     """
     return np.dot(rgb[...,:3], [0.2989, 0.5870, 0.114])
 
-def vectorize_tiles(image_matrix, margin_size=1):
+def extract_patches(image, patch_size, stride=1, copy=False):
+    """
+    All the patches of an image, without copying it.
+
+    input: image      : matrix of any dimension, e.g. an image (rows, cols)
+                        or a stack (time, rows, cols).
+           patch_size : size of the patches, an int (same size along every axis)
+                        or one size per axis, e.g. (3, 5, 5) for patches of
+                        3 times and 5 x 5 pixels, or (1, 5, 5) for 5 x 5 patches
+                        of every frame on its own.
+           stride     : step between two patches, an int or one per axis.
+           copy       : by default the output is a read-only view of image
+                        (its entries overlap in memory, so it must not be written).
+                        copy=True gives a contiguous copy instead.
+
+    output: matrix of shape grid + patch_size, where grid is the number of
+            patches along each axis, so for an image
+            output[i, j] = image[i*stride : i*stride + patch_size,
+                                 j*stride : j*stride + patch_size]
+            and output[i, j] is the patch centered at (i*stride + m, j*stride + m)
+            when patch_size = 2m + 1.
     """
-    This function takes a 3D matrix and the 
+    image = np.asarray(image)
+    ndim = image.ndim
+    patch_size = (patch_size,) * ndim if np.isscalar(patch_size) else tuple(patch_size)
+    stride = (stride,) * ndim if np.isscalar(stride) else tuple(stride)
+    if len(patch_size) != ndim or len(stride) != ndim:
+        raise ValueError("patch_size and stride need one entry per axis of image.")
+    if any(size < 1 or size > length for size, length in zip(patch_size, image.shape)):
+        raise ValueError("patch_size has to be between 1 and the size of image.")
+    grid = tuple((length - size) // step + 1
+                 for length, size, step in zip(image.shape, patch_size, stride))
+    strides = tuple(step * byte_step for step, byte_step in zip(stride, image.strides))
+    patches = np.lib.stride_tricks.as_strided(image, shape=grid + patch_size,
+                                              strides=strides + image.strides,
+                                              writeable=False)
+    if copy:
+        return np.ascontiguousarray(patches)
+    return patches
+
+
+@instrument.instrumented
+def vectorize_tiles(image_matrix, margin_size=1, dtype=np.float64):
+    """
+    This function takes a 2D matrix and the 
     size of the margin about the center pixel 
     as an input, and generates a matrix whose 
     columns are entries of the submatrices with 
@@ -231,24 +396,23 @@ def vectorize_tiles(image_matrix, margin_size=1):
     would be A_{2,2}, A_{2,3}, ..., A_{2,n-1},
              A_{3,2}, A_{3,3}, ..., A_{3,n-1},
 
-    It is assumed that image_matrix is a square matrix!
+    output: contiguous matrix of size (k**2, (no_row - 2m) * (no_col - 2m)),
+            k = 2m + 1 and m = margin_size. Each column is a submatrix read
+            along its rows. image_matrix does not need to be square.
+    See extract_patches for the patches without a copy.
     
     Hossein
     """
     # make sure image_matrix is a numpy array. (Yufeng tends to create lists! :D)
     image_matrix = np.asarray(image_matrix)
-    (no_row, no_col) = image_matrix.shape
-    no_submatrices = (no_row - (2 * margin_size)) ** 2
     sub_matrix_size = 1 + (2 * margin_size)
-    vectorized_subs = np.zeros((sub_matrix_size**2, no_submatrices))
-    count = 0
-    for row_count in xrange(margin_size, no_row - margin_size):
-        for col_count in xrange(margin_size, no_row - margin_size):
-            vectorized_subs[:,count] = np.concatenate(extract_2Dsubmatrix_center(image_matrix, 
-                                                         [row_count, col_count], 
-                                                         margin_size))
-            count += 1
-    return vectorized_subs
+    patches = extract_patches(image_matrix, sub_matrix_size)
+    (no_row, no_col) = patches.shape[:2]
+    # one copy, from (row, col, k, k) to (k, k, row, col).
+    vectorized_subs = np.empty((sub_matrix_size, sub_matrix_size, no_row, no_col), dtype=dtype)
+    vectorized_subs[...] = patches.transpose(2, 3, 0, 1)
+    return vectorized_subs.reshape(sub_matrix_size**2, no_row * no_col)
+
 """
 ############################################################ Cao
 """
@@ -256,36 +420,256 @@ def vectorize_tiles(image_matrix, margin_size=1):
 ##################################
 #########  Non_Local_Means
 ##################################
-def non_local_mean(image, constant):
+def _box_sum(matrix, radius, integral=None):
     """
+    Sums of matrix over all (2 radius + 1) x (2 radius + 1) windows of its last
+    two axes, computed with an integral image. The output is smaller than
+    matrix by 2 radius along those axes (only full windows).
+    integral is an optional work matrix, one larger than matrix along those axes.
+    """
+    size = 2 * radius + 1
+    if integral is None:
+        integral = np.empty(matrix.shape[:-2] + (matrix.shape[-2] + 1, matrix.shape[-1] + 1),
+                            dtype=matrix.dtype)
+    integral[..., 0, :] = 0
+    integral[..., :, 0] = 0
+    np.cumsum(matrix, axis=-2, out=integral[..., 1:, 1:])
+    np.cumsum(integral[..., 1:, 1:], axis=-1, out=integral[..., 1:, 1:])
+    return (integral[..., size:, size:] - integral[..., :-size, size:]
+            - integral[..., size:, :-size] + integral[..., :-size, :-size])
+
+
+def estimate_noise(image):
+    """
+    Standard deviation of the noise of an image, estimated from the median
+    absolute deviation of the differences of horizontal neighbors.
+    """
+    differences = np.diff(np.asarray(image, dtype=np.float64), axis=-1)
+    deviation = np.median(np.abs(differences - np.median(differences)))
+    return deviation / 0.6745 / math.sqrt(2)
+
+
+def _non_local_mean_stack(stack, constant, dtype, patch_radius, search_radius, time_radius,
+                          mode, h, guide=None, chunk_bytes=2**19):
+    """
+    Non-local means of a 3D matrix (time, rows, cols), see non_local_mean_3D.
+    With a guide (same size as stack), the patches are compared on the guide
+    and the values averaged are the ones of stack.
+
+    The distance between the patches of two pixels is the same seen from
+    either of them, so only half of the offsets (dt, dy, dx) of the search
+    window are computed: the distances of an offset give the candidates
+    pixel + offset of the pixels, and the candidates pixel - offset of the
+    pixels + offset. The frames are done in chunks of about chunk_bytes, every
+    offset for a chunk before the next one, so that the work matrices stay
+    in the cache.
+    """
+    stack = np.asarray(stack, dtype=dtype)
+    (no_time, no_row, no_col) = stack.shape
+    r = patch_radius
+    s = search_radius
+    # offsets that leave the image have no candidates.
+    row_search = min(search_radius, no_row - 1)
+    col_search = min(search_radius, no_col - 1)
+    time_search = min(time_radius, no_time - 1)
+
+    if guide is None:
+        guide = stack
+    elif np.shape(guide) != stack.shape:
+        raise ValueError("guide has to be the size of the image.")
+    padded = np.zeros((no_time, no_row + 2 * (r + s), no_col + 2 * (r + s)), dtype=dtype)
+    padded[:, r + s:r + s + no_row, r + s:r + s + no_col] = guide
+    chunk = int(max(1, min(no_time, chunk_bytes // padded[0].nbytes)))
+    difference = np.empty((chunk, no_row + 2 * r, no_col + 2 * r), dtype=dtype)
+    integral = np.empty((chunk, no_row + 2 * r + 1, no_col + 2 * r + 1), dtype=dtype)
+
+    if mode == 'constant':
+        # the pixel itself is the first of its nearest patches.
+        nearest_distances = np.full((constant, stack.size), np.inf, dtype=dtype)
+        nearest_values = np.zeros((constant, stack.size), dtype=dtype)
+        nearest_distances[0] = 0
+        nearest_values[0] = stack.ravel()
+        # slot of the farthest of the nearest patches found so far, and its distance.
+        farthest = np.full(stack.size, min(1, constant - 1), dtype=np.intp)
+        threshold = np.full(stack.size, np.inf if constant > 1 else 0, dtype=dtype)
+
+        def offer(start, distance, values):
+            # where closer, replace the farthest of the nearest found so far.
+            box = tuple(slice(begin, begin + size) for begin, size in zip(start, distance.shape))
+            closer = np.nonzero(distance < threshold.reshape(stack.shape)[box])
+            pixels = np.ravel_multi_index(tuple(c + begin for c, begin in zip(closer, start)),
+                                          stack.shape)
+            slot = farthest[pixels]
+            nearest_distances[slot, pixels] = distance[closer]
+            nearest_values[slot, pixels] = values[closer]
+            farthest[pixels] = np.argmax(nearest_distances[:, pixels], axis=0)
+            threshold[pixels] = nearest_distances[farthest[pixels], pixels]
+    elif mode == 'gaussian':
+        if h is None:
+            h = estimate_noise(guide)
+        h2 = max(h, np.finfo(dtype).eps) ** 2 * (2 * r + 1) ** 2
+        weighted_sum = stack.copy()
+        weight_sum = np.ones_like(stack)
+    else:
+        raise ValueError("mode has to be 'constant' or 'gaussian', not %r" % (mode,))
+
+    # frames first:stop are compared with frames first + time_shift:stop + time_shift.
+    for first in range(0, no_time, chunk):
+        for time_shift in range(0, time_search + 1):
+            stop = min(first + chunk, no_time - time_shift)
+            no_pairs = stop - first
+            if no_pairs <= 0:
+                continue
+            for row_shift in range(-row_search, row_search + 1):
+                for col_shift in range(-col_search, col_search + 1):
+                    if (time_shift, row_shift, col_shift) <= (0, 0, 0):
+                        continue
+                    reference = padded[first:stop, s:s + no_row + 2 * r, s:s + no_col + 2 * r]
+                    shifted = padded[first + time_shift:stop + time_shift,
+                                     s + row_shift:s + row_shift + no_row + 2 * r,
+                                     s + col_shift:s + col_shift + no_col + 2 * r]
+                    np.subtract(reference, shifted, out=difference[:no_pairs])
+                    if mode == 'constant':
+                        np.abs(difference[:no_pairs], out=difference[:no_pairs])
+                    else:
+                        np.square(difference[:no_pairs], out=difference[:no_pairs])
+                    distance = _box_sum(difference[:no_pairs], r, integral[:no_pairs])
+
+                    # pixels (rows_a, cols_a) whose candidates (rows_b, cols_b) are in the image.
+                    rows_a = slice(max(0, -row_shift), no_row - max(0, row_shift))
+                    cols_a = slice(max(0, -col_shift), no_col - max(0, col_shift))
+                    rows_b = slice(rows_a.start + row_shift, rows_a.stop + row_shift)
+                    cols_b = slice(cols_a.start + col_shift, cols_a.stop + col_shift)
+                    times_a = slice(first, stop)
+                    times_b = slice(first + time_shift, stop + time_shift)
+                    distance = distance[:, rows_a, cols_a]
+                    values_a = stack[times_a, rows_a, cols_a]
+                    values_b = stack[times_b, rows_b, cols_b]
+
+                    if mode == 'constant':
+                        offer((times_a.start, rows_a.start, cols_a.start), distance, values_b)
+                        offer((times_b.start, rows_b.start, cols_b.start), distance, values_a)
+                    else:
+                        weight = np.exp(-distance / h2)
+                        weighted_sum[times_a, rows_a, cols_a] += weight * values_b
+                        weight_sum[times_a, rows_a, cols_a] += weight
+                        weighted_sum[times_b, rows_b, cols_b] += weight * values_a
+                        weight_sum[times_b, rows_b, cols_b] += weight
+
+    if mode == 'constant':
+        found = np.isfinite(nearest_distances)
+        no_found = found.sum(axis=0).astype(dtype)
+        return ((nearest_values * found).sum(axis=0) / no_found).reshape(stack.shape)
+    return weighted_sum / weight_sum
+
+
+@instrument.instrumented
+def non_local_mean(image, constant=10, dtype=np.float64, patch_radius=1, search_radius=7,
+                   mode='constant', h=None, guide=None):
+    """
+    input: image         : 2D matrix of an image.
+           constant      : number of nearest patches averaged in mode 'constant'.
+           dtype         : precision of the computation and of the output.
+           patch_radius  : patches are (2 patch_radius + 1) x (2 patch_radius + 1),
+                           the image is padded with zeros for the patches at the border.
+           search_radius : similar patches are looked for only among the pixels
+                           at most search_radius rows and columns away.
+           mode          : 'constant' : every pixel becomes the mean of the centers of
+                                        the `constant` patches nearest to its own
+                                        patch (L1 distance), itself included.
+                           'gaussian' : every pixel becomes the mean of all the pixels of
+                                        the search window, weighted by
+                                        exp(-mean squared patch difference / h^2).
+           h             : filtering strength of mode 'gaussian',
+                           the estimated noise of the image (estimate_noise) by default.
+           guide         : image of the same size whose patches are compared instead
+                           of the ones of image, e.g. a denoised coarse level
+                           upsampled (see pyramid.coarse_to_fine_non_local_mean).
+                           The pixels averaged are still the ones of image.
+
+    output: denoised image, same size as image.
+
+    There is no distance matrix of all pairs of pixels. The search window is
+    walked one offset at a time: the whole image is compared with the image
+    shifted by that offset, and the patch distances of all pixels at once are
+    the window sums (_box_sum) of that difference. So the work is
+    (no. of pixels) x (no. of offsets), and the memory a few images.
+
     Yufeng Cao
     """
-    [m,n] = np.shape(image)
-    Apadded = np.row_stack((np.zeros([1,2*1+n]), np.column_stack((np.zeros([m,1]), 
-                            image, np.zeros([m,1]))), np.zeros([1,2*1+n])))
-    # obtain neighborhood of each pixel
-    neighbordim=[]
-    for i in xrange(1,m+1):
-        for j in xrange(1,n+1):
-            neighbor = Apadded[i-1*1:i+2,j-1*1:j+2]
-        neighbordim.append(neighbor)
-    new_image=np.reshape(neighbordim,[m*n,9]) # get the big neighborhood matrix
-    dist=[]
-    for k in xrange(0,m*n):
-        for l in xrange(0,m*n):
-            d = sum(abs(new_image[k,:] - new_image[l,:]))
-            dist.append(d)
-    # obtain distint matrix
-    new_dist=np.reshape(dist,[m*n,m*n])
-    idx=np.argsort(new_dist)
-    new_idx=idx[:, 0:constant]  # choose nearest constant col
-    new_dist_image=new_image[new_idx]
-    # choose the middle point from big neighborhood matrix
-    new_mean = np.mean(new_dist_image[:,:,4],1) 
-    final_image = np.reshape(new_mean,[m,n])
-    return final_image
-
-def region_growing(img, seed):
+    image = np.asarray(image)
+    if guide is not None:
+        guide = np.asarray(guide)[np.newaxis]
+    return _non_local_mean_stack(image[np.newaxis], constant, dtype, patch_radius,
+                                 search_radius, 0, mode, h, guide)[0]
+
+
+@instrument.instrumented
+def non_local_mean_3D(image_matrix, constant=10, dtype=np.float64, patch_radius=1,
+                      search_radius=7, time_radius=1, mode='constant', h=None, guide=None):
+    """
+    input: image_matrix : 3D matrix (time, rows, cols), e.g. output of matrix_of_all_times.
+           time_radius  : similar patches are also looked for in the frames at
+                          most time_radius time steps before and after.
+           guide        : 3D matrix of the size of image_matrix, see non_local_mean.
+           the other inputs are the ones of non_local_mean.
+
+    output: denoised 3D matrix, same size as image_matrix.
+
+    Patches stay 2D (in one frame), but the search window goes through
+    time as well, so the redundancy between neighboring time points is used.
+    The window has 2 time_radius + 1 times the offsets of the 2D one, and
+    every patch distance is computed once for the two pixels it compares.
+    On one core, 8 frames 256 x 256: non_local_mean on every frame takes
+    1.6 s (gaussian) / 6.3 s (constant), time_radius=0 1.6 s / 5.0 s,
+    time_radius=1 4.6 s / 11.5 s.
+    The memory is a few times the size of image_matrix (use float32 for big stacks).
+    """
+    return _non_local_mean_stack(image_matrix, constant, dtype, patch_radius, search_radius,
+                                 time_radius, mode, h, guide)
+
+def neighbor_offsets(ndim, connectivity=None):
+    """
+    Offsets of the neighbors of a pixel in an ndim-dimensional matrix.
+
+    connectivity: 2 ndim (only neighbors sharing a face: 4 in 2D, 6 in 3D),
+                  or 3^ndim - 1 (all touching neighbors: 8 in 2D, 26 in 3D).
+                  None means 2 ndim.
+    output: list of tuples, e.g. [(-1, 0), (0, -1), (0, 1), (1, 0)]
+    """
+    offsets = [offset for offset in itertools.product((-1, 0, 1), repeat=ndim) if any(offset)]
+    if connectivity is None or connectivity == 2 * ndim:
+        return [offset for offset in offsets if sum(map(abs, offset)) == 1]
+    if connectivity == 3 ** ndim - 1:
+        return offsets
+    raise ValueError("connectivity of a %dD matrix has to be %d or %d, not %r"
+                     % (ndim, 2 * ndim, 3 ** ndim - 1, connectivity))
+
+
+def _seed_coordinates(seed, shape):
+    """
+    Seeds given as one coordinate (i, j), a list of coordinates, an
+    (no_seeds, ndim) matrix or a boolean matrix of the size of the image,
+    as an (no_seeds, ndim) matrix. ValueError for a seed outside the image.
+    """
+    seed = np.asarray(seed)
+    if seed.dtype == bool and seed.shape == tuple(shape):
+        return np.argwhere(seed)
+    if seed.ndim == 1:
+        seed = seed[np.newaxis]
+    if seed.ndim != 2 or seed.shape[1] != len(shape):
+        raise ValueError("seeds have to be coordinates of a %dD matrix" % len(shape))
+    seed = seed.astype(np.intp)
+    # a negative coordinate would count from the end, and grow from another pixel.
+    outside = ((seed < 0) | (seed >= np.array(shape))).any(axis=1)
+    if outside.any():
+        raise ValueError("seed %r is outside of the matrix of shape %r"
+                         % (tuple(seed[outside][0].tolist()), tuple(shape)))
+    return seed
+
+
+@instrument.instrumented
+def region_growing(img, seed, threshold=20, connectivity=None):
     """
     The region is iteratively grown by 
     comparing all unallocated neighborhood 
@@ -295,130 +679,256 @@ def region_growing(img, seed):
     value and the region's mean, is used as a 
     measure of similarity. 
     The pixel with the smallest difference 
-    measured this way is allocated to the 
-    respective region. This process stops
+    measured this way (to the current mean) is
+    allocated to the respective region. This process stops
     when the intensity difference between 
-    region mean and new pixel become larger 
-    than a certain treshold.
-
-    The input function is img and seed, where 
-    img is the image you wanna segment.
-    Note, seed is the interesting point you 
-    wanna choose.
+    region mean and every neighbor pixel is
+    larger than a certain treshold.
+
+    input: img          : the image you wanna segment, 2D, or a 3D / 4D volume
+                          like (time, rows, cols) or (slice, time, rows, cols),
+                          then the region grows through all of them.
+           seed         : the interesting point(s) you wanna choose: one
+                          coordinate like (i, j), a list of them, or a boolean
+                          matrix of the size of img. All seeds start one region,
+                          and have to be inside img (ValueError).
+           threshold    : largest intensity difference to the region mean.
+           connectivity : 4 or 8 in 2D, 6 or 26 in 3D (see neighbor_offsets).
 
     Output is the same size of input, and 
-    white part is the area that grow from 
+    white part (255) is the area that grow from 
     the seed.
+
+    The neighbors are kept in two heaps split at the region mean (the ones
+    below it and the ones above it), so the nearest one is the top of one
+    of them. When the mean moves past a neighbor, it changes heaps. Every
+    step costs log(no. of neighbors) and not a pass over all of them.
     """
-    #Parameters for region growing
-    neighbors = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-    region_threshold = 20
-    region_size = 1
-    intensity_difference = 0
-    neighbor_points_list = []
-    neighbor_intensity_list = []
-
-    #Mean of the segmented region
-    region_mean = img[seed]
-
-    #Input image parameters
-    height, width = img.shape
-    image_size = height * width
-
-    #Initialize segmented output image
-    segmented_img = np.zeros([height, width])
-
-    #Region growing until intensity difference becomes greater than certain threshold
-    while (intensity_difference < region_threshold) & (region_size < image_size):
-        #Loop through neighbor pixels
-        for i in range(4):
-            #Compute the neighbor pixel position
-            x_new = seed[0] + neighbors[i][0]
-            y_new = seed[1] + neighbors[i][1]
-
-            #Boundary Condition - check if the coordinates are inside the image
-            check_inside = (x_new >= 0) & (y_new >= 0) & (x_new < height) & (y_new < width)
-
-            #Add neighbor if inside and not already in segmented_img
-            if check_inside:
-                if segmented_img[x_new, y_new] == 0:
-                    neighbor_points_list.append([x_new, y_new])
-                    neighbor_intensity_list.append(img[x_new, y_new])
-                    segmented_img[x_new, y_new] = 255
-
-        #Add pixel with intensity nearest to the mean to the region
-        distance = abs(neighbor_intensity_list-region_mean)
-        pixel_distance = min(distance)
-        index = np.where(distance == pixel_distance)[0][0]
-        segmented_img[seed[0], seed[1]] = 255
+    img = np.asarray(img)
+    seeds = _seed_coordinates(seed, img.shape)
+
+    # one pixel of border around the image, marked as taken, so that
+    # neighbors never have to be checked against the edges.
+    padded_shape = tuple(size + 2 for size in img.shape)
+    values = np.zeros(padded_shape, dtype=img.dtype)
+    values[(slice(1, -1),) * img.ndim] = img
+    values = values.ravel()
+    # 0: free, 1: in the heap, 2: in the region, 3: border
+    state = np.full(padded_shape, 3, dtype=np.uint8)
+    state[(slice(1, -1),) * img.ndim] = 0
+    state = state.ravel()
+    strides = np.cumprod((1,) + padded_shape[:0:-1])[::-1]
+    offsets = [int(np.dot(offset, strides)) for offset in neighbor_offsets(img.ndim, connectivity)]
+
+    seed_indices = np.unique(np.dot(seeds + 1, strides))
+    state[seed_indices] = 2
+    region_sum = float(values[seed_indices].sum(dtype=np.float64))
+    region_size = len(seed_indices)
+    region_mean = region_sum / region_size
+
+    # the neighbors are split at the region mean: lower holds those at or
+    # below it (largest first), upper those above it (smallest first), so
+    # the nearest to the mean is the top of one of them.
+    lower, upper = [], []
+
+    def add(index):
+        value = float(values[index])
+        if value <= region_mean:
+            heapq.heappush(lower, (-value, index))
+        else:
+            heapq.heappush(upper, (value, index))
+
+    neighbors = np.unique((seed_indices[:, np.newaxis] + np.array(offsets)).ravel())
+    neighbors = neighbors[state[neighbors] == 0]
+    state[neighbors] = 1
+    for index in neighbors.tolist():
+        add(index)
+
+    while lower or upper:
+        # the mean has moved: neighbors it went past change sides.
+        while upper and upper[0][0] <= region_mean:
+            value, index = heapq.heappop(upper)
+            heapq.heappush(lower, (-value, index))
+        while lower and -lower[0][0] > region_mean:
+            value, index = heapq.heappop(lower)
+            heapq.heappush(upper, (-value, index))
+        below = region_mean + lower[0][0] if lower else np.inf
+        above = upper[0][0] - region_mean if upper else np.inf
+        if min(below, above) >= threshold:
+            # the nearest neighbor is too far, so all of them are.
+            break
+        if below <= above:
+            value, index = heapq.heappop(lower)
+            value = -value
+        else:
+            value, index = heapq.heappop(upper)
+        state[index] = 2
+        region_sum += value
         region_size += 1
+        region_mean = region_sum / region_size
+        for offset in offsets:
+            neighbor = index + offset
+            if state[neighbor] == 0:
+                state[neighbor] = 1
+                add(neighbor)
 
-        #New region mean
-        region_mean = (region_mean*region_size + neighbor_intensity_list[index])/(region_size+1)
-
-        #Update the seed value
-        seed = neighbor_points_list[index]
-        #Remove the value from the neighborhood lists
-        neighbor_intensity_list[index] = neighbor_intensity_list[-1]
-        neighbor_points_list[index] = neighbor_points_list[-1]
-    return segmented_img
+    segmented_img = (state.reshape(padded_shape) == 2).astype(np.uint8) * 255
+    return segmented_img[(slice(1, -1),) * img.ndim]
 
 ##################################
 #########  TV Denoising
 ##################################
 
-def denoise_tv(image, weight=50, eps=2.e-4, n_iter_max=200):
-    ndim = image.ndim
-    p = np.zeros((image.ndim, ) + image.shape)
-    g = np.zeros_like(p)
-    d = np.zeros_like(image)
+def _denoise_tv_block(source, result, buffers, weight, eps, n_iter_max, tau,
+                      dual=None, dual_result=None):
+    """
+    Denoises the images source (no_frames, ...) into result, see denoise_tv.
+    buffers are work matrices (p, g, norm, work) with room for no_frames
+    images, shared by all the blocks of a stack.
+    dual (ndim, no_frames, ...) is the starting p (0 if None), and the last p
+    of every image is written into dual_result if given.
+    Returns the number of iterations and of images that did not converge.
+    """
+    ndim = source.ndim - 1
+    no_active = len(source)
+    frame_size = float(source[0].size)
+    # the images still iterating are the first no_active ones of the work matrices.
+    active = np.arange(no_active)
+    p, g, norm, work = (buffers[0][:, :no_active], buffers[1][:, :no_active],
+                        buffers[2][:no_active], buffers[3][:no_active])
+    p[...] = 0 if dual is None else dual
+    g[...] = 0
+
+    def along(ax, part):
+        # slice of the images along their axis ax.
+        return (slice(None),) * (ax + 1) + (part,)
+
+    def per_image(matrix):
+        return matrix.reshape(len(matrix), -1)
+
     i = 0
-    while i < n_iter_max:
-        if i > 0:
-            # d will be the (negative) divergence of p
-            ## and the use of slice just make image matrix the same size with gradient matrix.
-            d = -p.sum(0)
-            slices_d = [slice(None), ] * ndim
-            slices_p = [slice(None), ] * (ndim + 1)
+    while i < n_iter_max and no_active > 0:
+        P, G, N, O = p[:, :no_active], g[:, :no_active], norm[:no_active], work[:no_active]
+        # out = image + d, where d is the (negative) divergence of p
+        O[...] = source
+        if i > 0 or dual is not None:
             for ax in range(ndim):
-                slices_d[ax] = slice(1, None)
-                slices_p[ax+1] = slice(0, -1)
-                slices_p[0] = ax
-                d[slices_d] += p[slices_p]
-                slices_d[ax] = slice(None)
-                slices_p[ax+1] = slice(None)
-            out = image + d
-        else:
-            out = image
-        E = (out ** 2).sum()
+                O -= P[ax]
+                O[along(ax, slice(1, None))] += P[ax][along(ax, slice(0, -1))]
+        E = np.einsum('ij,ij->i', per_image(O), per_image(O))
 
         # g stores the gradients of out along each axis
         # e.g. g[0] is the first order finite difference along axis 0
-        slices_g = [slice(None), ] * (ndim + 1)
+        # (the last row of each g[ax] stays 0).
         for ax in range(ndim):
-            slices_g[ax+1] = slice(0, -1)
-            slices_g[0] = ax
-            g[slices_g] = np.diff(out, axis=ax)
-            slices_g[ax+1] = slice(None)
-
-        norm = np.sqrt((g ** 2).sum(axis=0))[np.newaxis, ...]
-        E += weight * norm.sum()
-        tau = 1. / (2.*2.)
-        norm *= tau / weight
-        norm += 1.
-        p -= tau * g
-        p /= norm
-        E /= float(image.size)
+            np.subtract(O[along(ax, slice(1, None))], O[along(ax, slice(0, -1))],
+                        out=G[ax][along(ax, slice(0, -1))])
+        np.einsum('i...,i...->...', G, G, out=N)
+        np.sqrt(N, out=N)
+        E += weight * per_image(N).sum(axis=1)
+        N *= tau / weight
+        N += 1.
+        G *= tau
+        P -= G
+        P /= N
+        E /= frame_size
+
         if i == 0:
             E_init = E
             E_previous = E
         else:
-            if np.abs(E_previous - E) < eps * E_init:
-                break
-            else:
-                E_previous = E
+            converged = np.abs(E_previous - E) < eps * E_init
+            E_previous = E
+            if converged.any():
+                result[active[converged]] = O[converged]
+                if dual_result is not None:
+                    dual_result[:, active[converged]] = P[:, converged]
+                keep = ~converged
+                no_active = int(keep.sum())
+                p[:, :no_active] = P[:, keep]
+                active = active[keep]
+                source = source[keep]
+                E_init = E_init[keep]
+                E_previous = E_previous[keep]
         i += 1
-    return out
+    result[active] = work[:no_active]
+    if dual_result is not None:
+        dual_result[:, active] = p[:, :no_active]
+    return i, no_active
+
+
+@instrument.instrumented
+def denoise_tv(image, weight=50, eps=2.e-4, n_iter_max=200, dtype=np.float64, image_ndim=None,
+               block_bytes=2**18, dual=None, return_dual=False):
+    """
+    Total variation denoising (Chambolle's projection algorithm).
+
+    input: image       : one image, or a stack of them like (time, rows, cols)
+                         or (slice, time, rows, cols).
+           image_ndim  : the last image_ndim axes are an image, and every
+                         image of the stack is denoised on its own, e.g.
+                         image_ndim=2 for every frame of a stack. None (the
+                         default) denoises all of image as one image, a
+                         (time, rows, cols) stack with TV along time too.
+           weight      : the larger, the smoother the output.
+           eps         : an image is done when its energy changes by less than
+                         eps times its first energy in one iteration.
+           n_iter_max  : largest number of iterations.
+           dtype       : precision of the computation and of the output,
+                         np.float32 halves the memory of every pass.
+           block_bytes : images are iterated together in blocks of about this
+                         many bytes (at least one image). The work matrices
+                         are ~8 blocks, they have to stay in the cache: larger
+                         blocks were slower at every size tried.
+           dual        : starting point of the dual variable p, shape
+                         (image_ndim,) + image.shape, 0 by default. A p close
+                         to the solution (e.g. the one of a coarse level,
+                         upsampled) needs fewer iterations, see
+                         pyramid.coarse_to_fine_denoise_tv.
+           return_dual : also return the last p, as (output, p).
+
+    output: denoised image(s), same size as image.
+
+    The images of a block go through every iteration in one vectorized pass,
+    in work matrices allocated once for the whole stack. An image that has
+    converged is taken out of the pass, so the others go on without it.
+    Only small images share a block. On one core, against the old
+    denoise_tv called on every frame of a phantom study (benchmarks/),
+    image_ndim=2 takes, in float64 (float32):
+        59 x 512 x 512 : 3.0 s (1.2 s) instead of 4.9 s
+        59 x 256 x 256 : 0.63 s (0.30 s) instead of 0.80 s
+        500 x 32 x 32  : 0.12 s instead of 0.38 s
+    with the same output (to 1e-12). The step is 1/4 whatever the number of
+    axes, as it always was.
+    """
+    image = np.asarray(image, dtype=dtype)
+    ndim = image.ndim if image_ndim is None else min(image_ndim, image.ndim)
+    frame_shape = image.shape[image.ndim - ndim:]
+    frames = image.reshape((-1,) + frame_shape)
+    block_size = int(max(1, min(len(frames), block_bytes // max(1, frames[0].nbytes))))
+
+    result = np.empty_like(frames)
+    if dual is not None:
+        dual = np.asarray(dual, dtype=dtype).reshape((ndim, -1) + frame_shape)
+    dual_result = np.empty((ndim,) + frames.shape, dtype=dtype) if return_dual else None
+    buffers = (np.empty((ndim, block_size) + frame_shape, dtype=dtype),
+               np.empty((ndim, block_size) + frame_shape, dtype=dtype),
+               np.empty((block_size,) + frame_shape, dtype=dtype),
+               np.empty((block_size,) + frame_shape, dtype=dtype))
+    no_iterations, no_unconverged = 0, 0
+    for start in range(0, len(frames), block_size):
+        block = slice(start, start + block_size)
+        iterations, unconverged = _denoise_tv_block(frames[block], result[block], buffers, weight,
+                                                    eps, n_iter_max, 1. / 4.,
+                                                    None if dual is None else dual[:, block],
+                                                    None if dual_result is None else dual_result[:, block])
+        no_iterations = max(no_iterations, iterations)
+        no_unconverged += unconverged
+    if instrument.enabled:
+        instrument.record(images=len(frames), iterations=no_iterations, not_converged=no_unconverged)
+    if return_dual:
+        return result.reshape(image.shape), dual_result.reshape((ndim,) + image.shape)
+    return result.reshape(image.shape)
     
 """
 ############################################################ Hu
@@ -434,12 +944,17 @@ def color2gray(image):
 	return gray
 
 def show_gray_image(image):
+	import matplotlib.pyplot as plt  ## display the image
 	plt.imshow(image, cmap = plt.get_cmap('gray'))
 	plt.show()
 
 
 def gradient(image):
-	gx, gy = np.gradient(image)
+	"""
+	gradients along the rows and columns of an image, or of every
+	image of a stack (..., rows, cols).
+	"""
+	gx, gy = np.gradient(image, axis=(-2, -1))
 	return gx, gy
 
 
@@ -452,94 +967,202 @@ def div0( a, b ):
 
 
 def smoothing(image, SigmaX, SigmaY):
-	return sp.ndimage.filters.gaussian_filter(image, [SigmaX, SigmaY], mode='constant')
+	import scipy.ndimage
+	return scipy.ndimage.gaussian_filter(image, [SigmaX, SigmaY], mode='constant')
 
 
 def l1_norm_for_matrix(Matrix):
 	return abs(Matrix).sum(axis=0).max()
 
 def L1TV_cost(image, approximation,Lambda):
+	"""
+	approximation can be a stack of approximations (no_lambdas, rows, cols)
+	with Lambda of shape (no_lambdas, 1, 1), then the output is one cost per lambda.
+	"""
 	smoothingAppX, smoothingAppY = gradient(approximation)
-	smoothingAppCost = np.power(np.power(smoothingAppX,2) + np.power(smoothingAppY,2),0.5)
-	smoothingAppCost = sum(sum(smoothingAppCost))
-	approximationCost = sum(sum(abs(approximation-image)))
-	return smoothingAppCost + Lambda*approximationCost
+	smoothingAppCost = np.sqrt(smoothingAppX**2 + smoothingAppY**2).sum(axis=(-2, -1))
+	approximationCost = np.abs(approximation-image).sum(axis=(-2, -1))
+	return smoothingAppCost + np.squeeze(Lambda)*approximationCost
 
 
 def L1TV_gradient(image, approximation, Lambda):
+	"""
+	approximation can be a stack of approximations (no_lambdas, rows, cols)
+	with Lambda of shape (no_lambdas, 1, 1).
+	"""
 	smoothingAppX, smoothingAppY = gradient(approximation)
-	smoothingAppCost = np.power(np.power(smoothingAppX,2) + np.power(smoothingAppY,2),0.5)
+	smoothingAppCost = np.sqrt(smoothingAppX**2 + smoothingAppY**2)
 	smoothingAppX = div0(smoothingAppX, smoothingAppCost)
 	smoothingAppY = div0(smoothingAppY, smoothingAppCost)
 	smoothingAppXX, smoothingAppXY = gradient(smoothingAppX)
 	smoothingAppYX, smoothingAppYY = gradient(smoothingAppY)
 	smoothingGradient = smoothingAppXX + smoothingAppYY
-	if np.array_equal(approximation, image):
-		approximationgGradient = np.zeros(np.shape(approximation))
-	else:
-		approximationgGradient = approximation - image
-		approximationgGradient = np.sign(approximationgGradient)
+	# sign is 0 where approximation == image.
+	approximationgGradient = np.sign(approximation - image)
 	return -smoothingGradient + Lambda*approximationgGradient
 
 
-def someName(inputImage, sigma_x, sigma_y, Lambdas, maxIteration, epsilon):
+@instrument.instrumented
+def L1TV_solve(inputImage, Lambdas, sigma_x, sigma_y, maxIteration, epsilon,
+               tolerance=None, history=False, dtype=np.float64):
+    """
+    Input: inputImage   : gray scale image matrix.
+           Lambdas      : list of the lambdas (weight of |u - inputImage|) we want.
+           sigma_x      : the starting point of the descent is inputImage smoothed
+           sigma_y        by a gaussian of these widths.
+           maxIteration : largest number of gradient steps.
+           epsilon      : step size.
+           tolerance    : a lambda stops when a step changes its L1TV_cost by
+                          less than tolerance * cost. None: always maxIteration steps.
+                          (The step itself does not go to 0, the gradient of the
+                          L1 term is a sign, so the cost is what settles.)
+           history      : also return the cost and the error of every step.
+           dtype        : precision of the computation and of the output.
+
+    Output: u, a 3D matrix (no_lambdas, rows, cols), u[k] is the L1-TV
+            approximation for Lambdas[k].
+            With history=True: (u, history), history is a dictionary of
+              'cost'       : L1TV_cost of every step, (no_lambdas, maxIteration + 1)
+              'error'      : L1 norm of every step,   (no_lambdas, maxIteration + 1)
+              'iterations' : number of steps done for each lambda.
+            Steps after a lambda has stopped are NaN.
+
+    All lambdas are solved together, as one stack of images, so each step
+    is one vectorized pass for all of them. A lambda that has stopped is
+    taken out of the stack.
+    """
+    inputImage = np.asarray(inputImage, dtype=dtype)
+    no_lambdas = len(Lambdas)
+    # the starting point is the same for all lambdas.
+    u = np.repeat(smoothing(inputImage, sigma_x, sigma_y)[np.newaxis], no_lambdas, axis=0)
+    Lambda = np.asarray(Lambdas, dtype=dtype).reshape(-1, 1, 1)
+    iterations = np.zeros(no_lambdas, dtype=int)
+    result = np.empty_like(u)
+    active = np.arange(no_lambdas)
+    if history:
+        L1TVCost = np.full((no_lambdas, 1 + maxIteration), np.nan)
+        Error = np.full((no_lambdas, 1 + maxIteration), np.nan)
+        Error[:, 0] = np.abs(u - inputImage).sum(axis=(1, 2))
+    if history or tolerance is not None:
+        cost = L1TV_cost(inputImage, u, Lambda)
+        if history:
+            L1TVCost[:, 0] = cost
+
+    i = 0
+    while i < maxIteration and len(active) > 0:
+        i = i + 1
+        step = epsilon * L1TV_gradient(inputImage, u, Lambda)
+        u = u - step
+        iterations[active] = i
+        if not history and tolerance is None:
+            continue
+        previous_cost, cost = cost, L1TV_cost(inputImage, u, Lambda)
+        if history:
+            Error[active, i] = np.abs(step).sum(axis=(1, 2))
+            L1TVCost[active, i] = cost
+        if tolerance is not None:
+            stopped = np.abs(previous_cost - cost) < tolerance * np.abs(previous_cost)
+            if stopped.any():
+                result[active[stopped]] = u[stopped]
+                keep = ~stopped
+                u, Lambda, active, cost = u[keep], Lambda[keep], active[keep], cost[keep]
+    result[active] = u
+    if instrument.enabled:
+        instrument.record(lambdas=no_lambdas, iterations=int(iterations.max()) if no_lambdas else 0)
+        if tolerance is not None:
+            instrument.record(not_converged=len(active))
+    if history:
+        return result, {'cost': L1TVCost, 'error': Error, 'iterations': iterations}
+    return result
+
+
+def someName(inputImage, sigma_x, sigma_y, Lambdas, maxIteration, epsilon, dtype=np.float64):
     """
     Input: inputImage is a gray scale image matrix.
            sigma_x
            sigma_x
            Lambdas
-    Output: 
-    """
-    # Set initial value for L1TV
-    uList = []
-    # uDict = {}
-    for Lambda in Lambdas: 
-        u = smoothing(inputImage, sigma_x, sigma_y)
-        
-        L1TVCost = [0] * (1+maxIteration)
-        L1TVCost[0] = L1TV_cost(inputImage, u, Lambda)
-        
-        Error = [0] * (1+maxIteration)
-        Error[0] = sum(sum(abs(u - inputImage)))
-        i = 0
-        while i<maxIteration:
-            i = i+1
-            updateGradient = L1TV_gradient(inputImage, u, Lambda)
-            uTempt = u - epsilon * updateGradient
-            Error[i] = sum(sum(abs(u - uTempt)))
-            L1TVCost[i] = L1TV_cost(inputImage, uTempt, Lambda)
-            u = uTempt
-        # uDict['lambda-' + str(Lambda)] = u
-        uList.append(u)
-    return uList
+           dtype is the precision of the computation and of the output.
+    Output: list of the L1-TV approximations, one for each lambda,
+            after maxIteration steps. See L1TV_solve.
+    """
+    return list(L1TV_solve(inputImage, Lambdas, sigma_x, sigma_y, maxIteration, epsilon,
+                           dtype=dtype))
 
 ###########################################
 ######### Matrix Neighbor
 ###########################################
+@instrument.instrumented
+def extract_neighborhoods(array, centers, radius, time_radius=None, fill=np.nan):
+	"""
+	input: array       : image (rows, cols) or stack of images (time, rows, cols).
+	       centers     : coordinates of the centers, (no_centers, 2) matrix of
+	                     (row, col), or (no_centers, 3) of (time, row, col) for a stack.
+	       radius      : the windows are (2 radius + 1) x (2 radius + 1) pixels.
+	       time_radius : for a stack, the windows also take the frames at most
+	                     time_radius before and after the center. None: only
+	                     the frame of the center.
+	       fill        : value of the entries that are outside of array
+	                     (NaN makes an integer array float).
+
+	output: (no_centers, 2 radius + 1, 2 radius + 1) matrix, or
+	        (no_centers, 2 time_radius + 1, 2 radius + 1, 2 radius + 1) with time_radius,
+	        output[k] is the window around centers[k].
+
+	All windows are read in one fancy indexing of array. Indices outside of
+	array are clipped for the read and then replaced by fill, so nothing of
+	the size of array is padded or copied.
+	"""
+	array = np.asarray(array)
+	centers = np.asarray(centers, dtype=np.intp)
+	if centers.ndim == 1:
+		centers = centers[np.newaxis]
+	if centers.shape[1] != array.ndim or array.ndim not in (2, 3):
+		raise ValueError("centers have to be (row, col) of an image or (time, row, col) of a stack.")
+	if time_radius is not None and array.ndim != 3:
+		raise ValueError("time_radius needs a stack (time, rows, cols).")
+
+	steps = np.arange(-radius, radius + 1)
+	# one index matrix per axis, broadcast to (no_centers, [times,] rows, cols).
+	if time_radius is None:
+		windows = [steps[:, np.newaxis], steps[np.newaxis, :]]
+		if array.ndim == 3:
+			windows = [np.zeros((1, 1), dtype=np.intp)] + windows
+	else:
+		time_steps = np.arange(-time_radius, time_radius + 1)
+		windows = [time_steps[:, np.newaxis, np.newaxis],
+		           steps[np.newaxis, :, np.newaxis], steps[np.newaxis, np.newaxis, :]]
+	extra = (np.newaxis,) * windows[-1].ndim
+	indices = [centers[(slice(None), axis) + extra] + window[np.newaxis]
+	           for axis, window in enumerate(windows)]
+	inside = np.ones(np.broadcast(*indices).shape, dtype=bool)
+	for axis, index in enumerate(indices):
+		inside &= (index >= 0) & (index < array.shape[axis])
+	neighborhoods = array[tuple(np.clip(index, 0, size - 1)
+	                            for index, size in zip(indices, array.shape))]
+	neighborhoods = neighborhoods.astype(np.result_type(array.dtype, fill), copy=False)
+	neighborhoods[~inside] = fill
+	return neighborhoods
+
+
 def matrix_neighbors(Matrix, CenterRow, CenterCol, Radius):
-	m,n = np.shape(Matrix)
-	# create a mask 
-	mask = np.zeros([2*Radius+1, 2*Radius+1])
-	mask[mask == 0] = np.NaN
-	for i in range(-Radius, Radius + 1):
-		for j in range(-Radius, Radius + 1):
-			if (CenterRow + i >= 0) & (CenterRow + i <= m+1) & (CenterCol + j >= 0) & (CenterCol + j <= n+1):
-				mask[i+Radius, j+Radius] = Matrix[i+CenterRow, j+CenterCol]
-			else:
-				pass
-	return mask
+	"""
+	(2 Radius + 1) x (2 Radius + 1) window of Matrix around (CenterRow, CenterCol),
+	NaN outside of Matrix. See extract_neighborhoods for many centers at once.
+	"""
+	return extract_neighborhoods(Matrix, [(CenterRow, CenterCol)], Radius)[0]
 
 ###########################################
 ######### Label Probability
 ###########################################
 def L2(Array1, Array2):
 	Diff = Array1 - Array2
-	L2 = math.sqrt(sum(np.power(Diff,2)))
+	L2 = np.sqrt(np.sum(np.power(Diff,2), axis=0))
 	return L2
 
 def L1(Array1, Array2):
 	Diff = abs(Array1 - Array2)
-	return sum(Diff)
+	return np.sum(Diff, axis=0)
 
 def label_probability(Array1, Array2, Distance = 'L1'):
 	# Array1: each column is a pixel
@@ -559,17 +1182,88 @@ def label_criterion(Probability, threshold):
 	else:
 		return 100
 
-def final_label(testData, Tumor, Healthy, Vessel, threshold):
-    Tumor_Probability = label_probability(testData, Tumor)
-    Healthy_Probability = label_probability(testData, Healthy)
-    Vessel_Probability = label_probability(testData, Vessel)
-    Sum_Probability = Tumor_Probability + Healthy_Probability + Vessel_Probability
-    Final_Tumor_Probability = Tumor_Probability/Sum_Probability
-    Final_Healthy_Probability = Healthy_Probability/Sum_Probability
-    Final_Vessel_Probability = Vessel_Probability/Sum_Probability
+@instrument.instrumented
+def label_pixels(test_data, references, threshold=0.4, distance='L1', chunk_size=16384,
+                 feature_axis=0, return_probabilities=False):
+    """
+    Labels every pixel with the class whose reference it is nearest to.
+
+    input: test_data    : the pixels, each one a vector of features along
+                          feature_axis: (no_features, no_pixels) like final_label
+                          (each column is a pixel), or a whole study
+                          (slice, time, rows, cols) with feature_axis=1, the
+                          features of a pixel being its values at all times.
+                          A memory-mapped volume is only read chunk by chunk.
+           references   : one reference vector (no_features,) per class,
+                          as a list or a (no_classes, no_features) matrix.
+           threshold    : a pixel gets the most probable class only if its
+                          probability is larger than the second one by at
+                          least threshold, otherwise it is labeled 100 (unsure).
+           distance     : 'L1', 'L2' or 'cosine' (see distance.pairwise_distances).
+           chunk_size   : number of pixels done at once.
+           return_probabilities : also return the probabilities of the classes.
+
+    output: labels, uint8 matrix with the shape of test_data without feature_axis,
+            0, 1, ... the class (order of references), or 100 (unsure).
+            With return_probabilities: (labels, probabilities), probabilities has
+            one more axis in front, one entry per class.
+
+    The probability of class k is exp(-d_k) / sum_j exp(-d_j). It is computed
+    as exp(-(d_k - min_j d_j)) / sum_j exp(-(d_j - min_j d_j)) (log-sum-exp),
+    so it does not become 0 / 0 when all distances are large.
+    """
+    if distance not in ('L1', 'L2', 'cosine'):
+        raise ValueError("distance has to be 'L1', 'L2' or 'cosine'.")
+    test_data = np.asarray(test_data) if not hasattr(test_data, 'shape') else test_data
+    references = np.array([np.ravel(reference) for reference in references], dtype=np.float64)
+    no_classes, no_features = references.shape
+    if no_classes > 100:
+        raise ValueError("at most 100 classes, 100 is the label of unsure pixels.")
+    if test_data.shape[feature_axis] != no_features:
+        raise ValueError("test_data has %d features along axis %d, the references %d."
+                         % (test_data.shape[feature_axis], feature_axis, no_features))
+    feature_axis = feature_axis % test_data.ndim
+    pixel_shape = test_data.shape[:feature_axis] + test_data.shape[feature_axis + 1:]
+    no_pixels = int(np.prod(pixel_shape))
+
+    labels = np.empty(no_pixels, dtype=np.uint8)
+    if return_probabilities:
+        probabilities = np.empty((no_classes, no_pixels), dtype=np.float64)
+    for start in range(0, no_pixels, chunk_size):
+        stop = min(start + chunk_size, no_pixels)
+        index = list(np.unravel_index(np.arange(start, stop), pixel_shape))
+        index.insert(feature_axis, slice(None))
+        pixels = np.asarray(test_data[tuple(index)], dtype=np.float64)
+        # the pixels come first, unless the features are (before them).
+        if feature_axis == 0:
+            pixels = pixels.T
+
+        distances = ds.pairwise_distances(pixels, references, distance, chunk_size)
+
+        chunk_probabilities = np.exp(distances.min(axis=1)[:, np.newaxis] - distances)
+        chunk_probabilities /= chunk_probabilities.sum(axis=1)[:, np.newaxis]
+        if no_classes > 1:
+            two_largest = np.partition(chunk_probabilities, no_classes - 2, axis=1)[:, -2:]
+            margin = two_largest[:, 1] - two_largest[:, 0]
+        else:
+            margin = np.ones(stop - start)
+        labels[start:stop] = np.where(margin >= threshold,
+                                      np.argmax(chunk_probabilities, axis=1), 100)
+        if return_probabilities:
+            probabilities[:, start:stop] = chunk_probabilities.T
 
-    Final_Label = [label_criterion([Final_Tumor_Probability[i], Final_Healthy_Probability[i], Final_Vessel_Probability[i]], 0.4) for i in range(len(Final_Tumor_Probability))]
-    return Final_Label
+    if return_probabilities:
+        return labels.reshape(pixel_shape), probabilities.reshape((no_classes,) + pixel_shape)
+    return labels.reshape(pixel_shape)
+
+
+def final_label(testData, Tumor, Healthy, Vessel, threshold):
+    """
+    Label of every column of testData: 0 Tumor, 1 Healthy, 2 Vessel, 100 unsure
+    (the two most probable classes are less than threshold apart).
+    See label_pixels for any number of classes and whole volumes.
+    """
+    return label_pixels(testData, [Tumor, Healthy, Vessel], threshold).tolist()
 
 
 ###########################################
@@ -590,14 +1284,20 @@ def final_label(testData, Tumor, Healthy, Vessel, threshold):
 ############################################################ Laramie
 """
 def sub(A,B):
-    return [x1 - x2 for (x1, x2) in zip(A, B)]
+    return np.subtract(A, B).tolist()
 
 def euclidean_distance(A,B):
-    return (math.sqrt(np.dot(sub(A,B),sub(A,B))))
+    difference = np.subtract(A, B, dtype=np.float64)
+    return math.sqrt(np.dot(difference, difference))
 
-from scipy.spatial import distance_matrix
 def distanceMatrix(array1, array2, num):
-    return distance_matrix(array1, array2, num)
+    """
+    matrix of the num-norm distances between the rows of array1 and of array2,
+    computed in blocks of rows (see distance.pairwise_distances, which can
+    also write it into a memmap).
+    """
+    metric = {1: 'L1', 2: 'L2'}.get(num, num)
+    return ds.pairwise_distances(np.atleast_2d(array1), np.atleast_2d(array2), metric)
 
 
 
@@ -0,0 +1,163 @@
+"""
+Distances between sets of vectors (one vector per row), in blocks of rows.
+
+pairwise_distances never holds more than chunk_size rows of the distance
+matrix besides its output, and the output can be on the disk:
+
+    out = np.lib.format.open_memmap('distances.npy', mode='w+',
+                                    dtype=np.float32, shape=(len(A), len(B)))
+    pairwise_distances(A, B, 'L1', out=out)
+
+nearest_neighbors answers k-nearest-neighbor queries without the distance
+matrix at all, through a KD-tree (scipy.spatial.cKDTree) or through blocks
+of pairwise_distances. scipy is imported when first used.
+"""
+
+import numpy as np  ##linear algebra
+import imageanalysis.instrument as instrument
+
+metrics = ('L1', 'L2', 'sqeuclidean', 'cosine')
+
+
+def _block_distances(A, B, metric, B_squared=None):
+    """distances of every row of A to every row of B, (len(A), len(B))."""
+    if metric in ('L2', 'sqeuclidean'):
+        # |a - b|^2 = |a|^2 - 2 a.b + |b|^2, the product is one matrix multiplication.
+        if B_squared is None:
+            B_squared = np.einsum('ij,ij->i', B, B)
+        distances = np.dot(A, B.T)
+        distances *= -2
+        distances += np.einsum('ij,ij->i', A, A)[:, np.newaxis]
+        distances += B_squared[np.newaxis, :]
+        np.maximum(distances, 0, out=distances)
+        if metric == 'L2':
+            np.sqrt(distances, out=distances)
+        return distances
+    if metric == 'cosine':
+        A_norm = np.sqrt(np.einsum('ij,ij->i', A, A))
+        B_norm = np.sqrt(np.einsum('ij,ij->i', B, B))
+        similarity = np.dot(A, B.T)
+        norms = np.outer(A_norm, B_norm)
+        # a zero vector is as far from everything as an orthogonal one.
+        similarity = np.divide(similarity, norms, out=np.zeros_like(similarity), where=norms > 0)
+        return 1 - similarity
+    from scipy.spatial.distance import cdist
+    if metric == 'L1':
+        return cdist(A, B, 'cityblock')
+    if metric == np.inf:
+        return cdist(A, B, 'chebyshev')
+    return cdist(A, B, 'minkowski', p=metric)
+
+
+@instrument.instrumented
+def pairwise_distances(A, B=None, metric='L2', chunk_size=1024, out=None, dtype=np.float64):
+    """
+    input: A, B       : matrices (no_vectors, no_features), B is A by default.
+           metric     : 'L1', 'L2', 'sqeuclidean' (squared L2), 'cosine'
+                        (1 - cosine of the angle), or a number p >= 1 for the
+                        Minkowski p-norm (np.inf for the largest difference).
+           chunk_size : rows of A done at once, the memory is a few
+                        chunk_size x len(B) matrices.
+           out        : matrix (len(A), len(B)) to write into, e.g. a memmap.
+           dtype      : dtype of the output when out is not given.
+
+    output: D, D[i, j] is the distance between A[i] and B[j].
+
+    L2 goes through |a|^2 - 2 a.b + |b|^2, so it is one matrix multiplication
+    per chunk, but the distance of two nearly equal vectors is only accurate
+    to about 1e-8 of their norm.
+    """
+    # a string is checked first: 'l2' >= 1 would raise a TypeError, not say what is wrong.
+    if isinstance(metric, str):
+        if metric not in metrics:
+            raise ValueError("metric has to be one of %s, or a number p >= 1." % (metrics,))
+    elif not (np.isscalar(metric) and metric >= 1):
+        raise ValueError("metric has to be one of %s, or a number p >= 1." % (metrics,))
+    A = np.asarray(A, dtype=np.float64)
+    B = A if B is None else np.asarray(B, dtype=np.float64)
+    if A.ndim != 2 or B.ndim != 2 or A.shape[1] != B.shape[1]:
+        raise ValueError("A and B have to be (no_vectors, no_features) with the same no_features.")
+    if out is None:
+        out = np.empty((len(A), len(B)), dtype=dtype)
+    elif out.shape != (len(A), len(B)):
+        raise ValueError("out has to be of shape %r." % ((len(A), len(B)),))
+    B_squared = np.einsum('ij,ij->i', B, B) if metric in ('L2', 'sqeuclidean') else None
+    for start in range(0, len(A), chunk_size):
+        stop = min(start + chunk_size, len(A))
+        out[start:stop] = _block_distances(A[start:stop], B, metric, B_squared)
+    return out
+
+
+@instrument.instrumented
+def nearest_neighbors(data, queries=None, k=1, metric='L2', method='auto', chunk_size=1024):
+    """
+    The k vectors of data nearest to every query.
+
+    input: data    : matrix (no_vectors, no_features) searched in.
+           queries : matrix (no_queries, no_features), data itself by default
+                     (then every vector is its own nearest neighbor).
+           k       : number of neighbors.
+           metric  : 'L1', 'L2' or 'cosine'.
+           method  : 'tree' : KD-tree of data (scipy.spatial.cKDTree), fast for
+                              a few features, e.g. coordinates or small patches.
+                     'brute': blocks of pairwise_distances, better for many
+                              features (a KD-tree gets no better than that).
+                     'auto' : 'tree' up to 16 features.
+           chunk_size : queries done at once by 'brute'.
+
+    output: (distances, indices), both (no_queries, k), nearest first.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    queries = data if queries is None else np.asarray(queries, dtype=np.float64)
+    if metric not in ('L1', 'L2', 'cosine'):
+        raise ValueError("metric has to be 'L1', 'L2' or 'cosine'.")
+    if not 1 <= k <= len(data):
+        raise ValueError("k has to be between 1 and the number of vectors of data.")
+    if method == 'auto':
+        method = 'tree' if data.shape[1] <= 16 else 'brute'
+
+    if method == 'tree':
+        from scipy.spatial import cKDTree
+        if metric == 'cosine':
+            # on unit vectors |a - b|^2 = 2 (1 - cos), so the order is the same.
+            data, queries = _cosine_points(data, queries)
+        distances, indices = cKDTree(data).query(queries, k=k, p=1 if metric == 'L1' else 2)
+        distances, indices = distances.reshape(len(queries), k), indices.reshape(len(queries), k)
+        if metric == 'cosine':
+            distances = distances ** 2 / 2
+        return distances, indices
+    if method != 'brute':
+        raise ValueError("method has to be 'auto', 'tree' or 'brute'.")
+
+    distances = np.empty((len(queries), k))
+    indices = np.empty((len(queries), k), dtype=np.intp)
+    for start in range(0, len(queries), chunk_size):
+        stop = min(start + chunk_size, len(queries))
+        block = pairwise_distances(queries[start:stop], data, metric)
+        nearest = np.argpartition(block, k - 1, axis=1)[:, :k]
+        nearest_distances = np.take_along_axis(block, nearest, axis=1)
+        order = np.argsort(nearest_distances, axis=1, kind='stable')
+        indices[start:stop] = np.take_along_axis(nearest, order, axis=1)
+        distances[start:stop] = np.take_along_axis(nearest_distances, order, axis=1)
+    return distances, indices
+
+
+def _unit_rows(matrix):
+    norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))[:, np.newaxis]
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def _cosine_points(data, queries):
+    """
+    Points whose squared L2 distances are 2 (cosine distance) of the rows.
+    A zero vector is at cosine distance 1 of everything (as in
+    pairwise_distances), so the zero rows of data get one more axis and
+    those of queries another one: they are then at sqrt(2) of every other
+    point, like orthogonal unit vectors, and not at 1 like the origin.
+    """
+    data, queries = _unit_rows(data), _unit_rows(queries)
+    zero_data, zero_queries = ~data.any(axis=1), ~queries.any(axis=1)
+    if zero_data.any() or zero_queries.any():
+        data = np.column_stack([data, zero_data, np.zeros(len(data))])
+        queries = np.column_stack([queries, np.zeros(len(queries)), zero_queries])
+    return data, queries
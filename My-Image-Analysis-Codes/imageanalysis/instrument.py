@@ -0,0 +1,379 @@
+"""
+Where the time (and the memory) of a run goes.
+
+The heavy functions of the package are wrapped by @instrumented, and the
+stages of a Pipeline are spans. Nothing is recorded unless a profile is
+on, and then every call records its time, its calls to other instrumented
+functions, the bytes of the matrices it returns (returned_bytes, not what
+it allocates on the way: that is the peak memory below) and what the iterative
+solvers report (iterations of denoise_tv, L1TV_solve, random_walker, and
+how many of their images / lambdas converged):
+
+    with instrument.profile(report='profile.json', trace='trace.json') as run:
+        out = pipe.run(volume)
+    print(run.summary())
+
+or, without changing the code, for a whole program:
+
+    IMAGEANALYSIS_PROFILE=profile.json IMAGEANALYSIS_TRACE=trace.json python driver.py
+
+The report is a JSON file of totals per function and per stage, the trace
+a Chrome trace file (chrome://tracing or https://ui.perfetto.dev) of every
+call on a time line. profile(memory=True), or IMAGEANALYSIS_PROFILE_MEMORY=1,
+also records the peak memory of every call through tracemalloc (which
+numpy reports its matrices to), at the price of slower allocations:
+peak_bytes, the most memory the call held above what was in use when it
+started, work matrices included.
+
+Off, an instrumented function costs one test of a global more than the
+function itself. Only the calling process is recorded: the work done in
+the processes of Pipeline.run(workers > 1) shows up as the time the
+calling process waited for it.
+"""
+
+import atexit
+import contextlib
+import functools
+import os
+import threading
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# the profile being recorded, None when off. enabled is the same, for
+# functions that have something to record(): `if instrument.enabled:`.
+_current = None
+enabled = False
+
+
+class _Span(object):
+    """one call, while it runs."""
+
+    def __init__(self, profile, name, category):
+        self.profile = profile
+        self.name = name
+        self.category = category
+        self.values = {}
+        self.returned_bytes = 0
+        self.child_seconds = 0.
+        self.start_bytes = 0
+        self.peak_bytes = 0
+
+    def __enter__(self):
+        self.profile._enter(self)
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.profile._exit(self)
+        return False
+
+
+class _NoSpan(object):
+    """what span() gives when no profile is on."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        return False
+
+_no_span = _NoSpan()
+
+
+def _nbytes(result):
+    if isinstance(result, (tuple, list)):
+        return sum(_nbytes(item) for item in result)
+    return int(getattr(result, 'nbytes', 0))
+
+
+class Profile(object):
+    """
+    Everything recorded while a profile is on (see profile).
+
+    input: memory     : also record the peak memory of the calls (tracemalloc).
+           max_events : calls kept for the trace; the totals of the report
+                        count all of them.
+    """
+
+    def __init__(self, memory=False, max_events=10**6):
+        self.memory = memory
+        self.max_events = max_events
+        self.functions = {}
+        self.events = []
+        self.dropped_events = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._start = _clock()
+        self._stop = None
+        self._tracing = False
+        # bytes traced before tracemalloc was restarted, see _reset_peak.
+        self._traced_offset = 0
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _traced_memory(self):
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        return current + self._traced_offset, peak + self._traced_offset
+
+    def _reset_peak(self):
+        import tracemalloc
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+            return
+        # python < 3.9: only a restart clears the peak. What was traced is then
+        # counted as an offset (its frees are not seen any more, so the
+        # current memory can only be overestimated).
+        self._traced_offset += tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tracemalloc.start()
+
+    def _enter(self, span):
+        stack = self._stack()
+        if self.memory:
+            current, peak = self._traced_memory()
+            if stack:
+                # the peak so far belongs to the caller, the new call starts from now.
+                stack[-1].peak_bytes = max(stack[-1].peak_bytes, peak - stack[-1].start_bytes)
+            span.start_bytes = current
+            self._reset_peak()
+        stack.append(span)
+        span.start = _clock()
+
+    def _exit(self, span):
+        seconds = _clock() - span.start
+        stack = self._stack()
+        stack.pop()
+        if self.memory:
+            span.peak_bytes = max(span.peak_bytes, self._traced_memory()[1] - span.start_bytes)
+            if stack:
+                stack[-1].peak_bytes = max(stack[-1].peak_bytes,
+                                           span.start_bytes + span.peak_bytes - stack[-1].start_bytes)
+        if stack:
+            stack[-1].child_seconds += seconds
+        with self._lock:
+            totals = self.functions.get(span.name)
+            if totals is None:
+                totals = self.functions[span.name] = {
+                    'category': span.category, 'count': 0, 'total_seconds': 0.,
+                    'own_seconds': 0., 'min_seconds': seconds, 'max_seconds': seconds,
+                    'returned_bytes': 0, 'peak_bytes': 0, 'values': {}}
+            totals['count'] += 1
+            totals['total_seconds'] += seconds
+            totals['own_seconds'] += seconds - span.child_seconds
+            totals['min_seconds'] = min(totals['min_seconds'], seconds)
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+            totals['returned_bytes'] += span.returned_bytes
+            totals['peak_bytes'] = max(totals['peak_bytes'], span.peak_bytes)
+            for key, value in span.values.items():
+                summary = totals['values'].get(key)
+                if summary is None:
+                    summary = totals['values'][key] = {'count': 0, 'sum': 0, 'min': value,
+                                                       'max': value}
+                summary['count'] += 1
+                summary['sum'] += value
+                summary['min'] = min(summary['min'], value)
+                summary['max'] = max(summary['max'], value)
+            if len(self.events) < self.max_events:
+                arguments = dict(span.values)
+                if span.returned_bytes:
+                    arguments['returned_bytes'] = span.returned_bytes
+                if self.memory:
+                    arguments['peak_bytes'] = span.peak_bytes
+                self.events.append((span.name, span.category, span.start, seconds,
+                                    threading.current_thread().ident, arguments))
+            else:
+                self.dropped_events += 1
+
+    def record(self, **values):
+        """adds numbers (e.g. iterations=12) to the call being recorded."""
+        stack = self._stack()
+        if not stack:
+            return
+        for key, value in values.items():
+            value = float(value) if not isinstance(value, int) else value
+            # a value recorded several times in one call (e.g. one per block) adds up.
+            stack[-1].values[key] = stack[-1].values.get(key, 0) + value
+
+    def report(self):
+        """the totals, as a dictionary (what write_json writes)."""
+        stop = self._stop if self._stop is not None else _clock()
+        functions = {}
+        with self._lock:
+            names = sorted(self.functions, key=lambda name: -self.functions[name]['total_seconds'])
+            for name in names:
+                totals = dict(self.functions[name])
+                totals['mean_seconds'] = totals['total_seconds'] / totals['count']
+                totals['values'] = dict((key, dict(summary, mean=summary['sum'] / float(summary['count'])))
+                                        for key, summary in totals['values'].items())
+                if not self.memory:
+                    del totals['peak_bytes']
+                functions[name] = totals
+        report = {'wall_seconds': stop - self._start,
+                  'pid': os.getpid(),
+                  'memory': self.memory,
+                  'functions': functions,
+                  'dropped_events': self.dropped_events}
+        report['peak_rss_bytes'] = _peak_rss()
+        return report
+
+    def summary(self):
+        """the report as a table, the most expensive functions first."""
+        report = self.report()
+        lines = ["%-28s %8s %11s %11s %11s  %s" % ('function / stage', 'calls', 'total s',
+                                                   'own s', 'max s', 'recorded')]
+        for name, totals in report['functions'].items():
+            recorded = ", ".join("%s %.4g" % (key, summary['mean'])
+                                 for key, summary in sorted(totals['values'].items()))
+            lines.append("%-28s %8d %11.4f %11.4f %11.4f  %s" % (
+                name, totals['count'], totals['total_seconds'], totals['own_seconds'],
+                totals['max_seconds'], recorded))
+        lines.append("wall %.4f s, peak RSS %s" % (
+            report['wall_seconds'],
+            "%.1f MB" % (report['peak_rss_bytes'] / 2.**20) if report['peak_rss_bytes'] else "unknown"))
+        return "\n".join(lines)
+
+    def write_json(self, file_name):
+        import json
+        with open(file_name, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=1)
+
+    def write_trace(self, file_name):
+        """the calls in the Chrome trace event format (complete events, in microseconds)."""
+        import json
+        pid = os.getpid()
+        with self._lock:
+            events = [{'name': name, 'cat': category, 'ph': 'X',
+                       'ts': (start - self._start) * 1e6, 'dur': seconds * 1e6,
+                       'pid': pid, 'tid': thread, 'args': arguments}
+                      for name, category, start, seconds, thread, arguments in self.events]
+        with open(file_name, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+def _peak_rss():
+    """largest resident memory of the process in bytes, None where unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac.
+    return int(peak if sys.platform == 'darwin' else peak * 1024)
+
+
+def _start(run):
+    global _current, enabled
+    previous = _current
+    if run.memory:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            run._tracing = True
+    _current, enabled = run, True
+    return previous
+
+
+def _finish(run, previous, report=None, trace=None):
+    global _current, enabled
+    run._stop = _clock()
+    if run._tracing:
+        import tracemalloc
+        tracemalloc.stop()
+    _current, enabled = previous, previous is not None
+    if report:
+        run.write_json(report)
+    if trace:
+        run.write_trace(trace)
+
+
+@contextlib.contextmanager
+def profile(memory=False, report=None, trace=None, max_events=10**6):
+    """
+    Context manager that records everything done inside it:
+
+        with profile(memory=True, report='profile.json') as run:
+            ...
+        run.report()
+
+    input: memory     : also record the peak memory of every call (tracemalloc).
+           report     : JSON file the totals are written to at the end.
+           trace      : Chrome trace file the calls are written to at the end.
+           max_events : see Profile.
+    """
+    run = Profile(memory, max_events)
+    previous = _start(run)
+    try:
+        yield run
+    finally:
+        _finish(run, previous, report, trace)
+
+
+def span(name, category='stage'):
+    """
+    Context manager recording the code inside it as one call named name,
+    e.g. a stage of a pipeline. Does nothing when no profile is on.
+    """
+    if _current is None:
+        return _no_span
+    return _Span(_current, name, category)
+
+
+def record(**values):
+    """
+    Numbers about the current call, e.g. record(iterations=12, converged=3),
+    added up over the call and summarized over all calls in the report.
+    Does nothing when no profile is on.
+    """
+    if _current is not None:
+        _current.record(**values)
+
+
+def instrumented(function=None, name=None, category='function'):
+    """
+    Decorator: the calls of function are recorded when a profile is on,
+    under name (the name of function by default).
+    """
+    def decorate(function):
+        label = function.__name__ if name is None else name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _current is None:
+                return function(*args, **kwargs)
+            with _Span(_current, label, category) as call:
+                result = function(*args, **kwargs)
+                call.returned_bytes = _nbytes(result)
+            return result
+        return wrapper
+    if function is None:
+        return decorate
+    return decorate(function)
+
+
+def current():
+    """the Profile being recorded, None when off."""
+    return _current
+
+
+def _from_environment():
+    report = os.environ.get('IMAGEANALYSIS_PROFILE')
+    trace = os.environ.get('IMAGEANALYSIS_TRACE')
+    if not report and not trace:
+        return
+    run = Profile(memory=os.environ.get('IMAGEANALYSIS_PROFILE_MEMORY', '') not in ('', '0'))
+    previous = _start(run)
+    pid = os.getpid()
+
+    def finish():
+        # processes forked from this one must not write over its files.
+        if os.getpid() == pid:
+            _finish(run, previous, report, trace)
+    atexit.register(finish)
+
+_from_environment()
@@ -0,0 +1,263 @@
+"""
+On-disk cache of the results of expensive functions.
+
+A result is stored as a .npy file named after a hash of everything that
+determines it: the function (its name and its code), the bytes, dtype and
+shape of the input matrices and the values of the other parameters,
+defaults included. Calling again with the same inputs loads the file,
+memory-mapped, instead of computing:
+
+    cache = ResultCache('/tmp/results', max_bytes=2**30)
+    denoise_tv = cache.memoize(cr.denoise_tv)
+    denoised = denoise_tv(frames, weight=50)      # computed and stored
+    denoised = denoise_tv(frames, weight=50)      # read from the disk
+    cache.stats()
+
+or as a decorator, @memoize or @cache.memoize, on any function whose
+results are matrices (or tuples / lists of matrices). The files are removed,
+least recently used first, when they take more than max_bytes.
+
+The code hashed is the one of the function and of the functions and
+lambdas defined in it, not the one of the functions it calls: when those
+change, change the version given to memoize (any value, e.g.
+@memoize(version=2)) or clear the cache.
+Results loaded from the cache are read-only: copy them before changing them.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import numpy as np  ##linear algebra
+
+_hash = getattr(hashlib, 'blake2b', hashlib.sha1)
+
+
+def _update_key(key, value):
+    """feeds value to the hash key, matrices by their bytes."""
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        key.update(("array %s %r " % (value.dtype.str, value.shape)).encode())
+        key.update(memoryview(value.reshape(-1)).cast('B'))
+    elif isinstance(value, (list, tuple)):
+        key.update(("%s %d " % (type(value).__name__, len(value))).encode())
+        for item in value:
+            _update_key(key, item)
+    elif isinstance(value, dict):
+        key.update(("dict %d " % len(value)).encode())
+        for name in sorted(value, key=repr):
+            _update_key(key, name)
+            _update_key(key, value[name])
+    elif isinstance(value, (set, frozenset)):
+        # e.g. the constant of `x in {'a', 'b'}`, whose order changes from one run to the next.
+        key.update(("set %d " % len(value)).encode())
+        for item in sorted(value, key=repr):
+            _update_key(key, item)
+    else:
+        key.update((repr(value) + " ").encode())
+
+
+def _update_code_key(key, code):
+    """feeds a code object to the hash key, the ones defined in it included."""
+    key.update(code.co_code)
+    _update_key(key, code.co_names)
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            _update_code_key(key, constant)
+        else:
+            _update_key(key, constant)
+
+
+def _function_key(function, version=None):
+    """
+    the module, name and code of function (and version), so editing it
+    changes the key; the functions it calls are only named (see version).
+    """
+    # the code of an @instrumented function is the one it wraps.
+    function = inspect.unwrap(function)
+    key = _hash()
+    key.update(("%s.%s " % (function.__module__, getattr(function, '__qualname__',
+                                                          function.__name__))).encode())
+    if version is not None:
+        key.update(("version %r " % (version,)).encode())
+    code = getattr(function, '__code__', None)
+    if code is not None:
+        _update_code_key(key, code)
+    return key
+
+
+class ResultCache(object):
+    """
+    input: cache_dir : folder of the .npy files, $IMAGEANALYSIS_CACHE or
+                       ~/.imageanalysis_cache by default.
+           max_bytes : the least recently used results are removed when all
+                       of them take more than this.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=2**30):
+        if cache_dir is None:
+            cache_dir = os.environ.get('IMAGEANALYSIS_CACHE',
+                                       os.path.join(os.path.expanduser('~'), '.imageanalysis_cache'))
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, function, args, kwargs, version=None):
+        """hash of a call, the same for f(x) and f(x, weight=<its default>)."""
+        try:
+            bound = inspect.signature(function).bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+        except (TypeError, ValueError):
+            arguments = {'args': args, 'kwargs': kwargs}
+        key = _function_key(function, version)
+        _update_key(key, arguments)
+        return key.hexdigest()
+
+    def _paths(self, key):
+        return (os.path.join(self.cache_dir, key + '.json'),
+                lambda count: os.path.join(self.cache_dir, '%s.%d.npy' % (key, count)))
+
+    def load(self, key):
+        """the stored result of key (memory-mapped), or None."""
+        description_path, array_path = self._paths(key)
+        try:
+            with open(description_path) as description_file:
+                description = json.load(description_file)
+            arrays = [np.load(array_path(count), mmap_mode='r')
+                      for count in range(description['no_arrays'])]
+        except (IOError, OSError, ValueError):
+            return None
+        # touching the description marks the result as recently used.
+        os.utime(description_path, None)
+        if description['kind'] == 'array':
+            return arrays[0]
+        return tuple(arrays) if description['kind'] == 'tuple' else arrays
+
+    def store(self, key, result):
+        """stores result (matrix, tuple or list of matrices); False if it cannot be."""
+        if isinstance(result, np.ndarray):
+            kind, arrays = 'array', [result]
+        elif isinstance(result, (tuple, list)) and all(isinstance(item, np.ndarray)
+                                                        for item in result):
+            kind, arrays = type(result).__name__, list(result)
+        else:
+            return False
+        description_path, array_path = self._paths(key)
+        for count, array in enumerate(arrays):
+            self._write(array_path(count), 'wb', lambda array_file: np.save(array_file, array))
+        description = {'kind': kind, 'no_arrays': len(arrays),
+                       'nbytes': int(sum(array.nbytes for array in arrays))}
+        self._write(description_path, 'w',
+                    lambda description_file: json.dump(description, description_file))
+        self._evict()
+        return True
+
+    def _write(self, path, mode, write):
+        """
+        write(file) into path through a temporary file of its own, so a reader
+        never sees half a result, and processes storing the same key at the
+        same time do not write into each other's files.
+        """
+        handle, temporary_path = tempfile.mkstemp(suffix='.part', dir=self.cache_dir)
+        try:
+            with os.fdopen(handle, mode) as temporary_file:
+                write(temporary_file)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def _entries(self):
+        """(last use, bytes, key) of every stored result."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                with open(path) as description_file:
+                    nbytes = json.load(description_file)['nbytes']
+                entries.append((os.path.getmtime(path), nbytes, name[:-len('.json')]))
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+        return entries
+
+    def remove(self, key):
+        """removes the stored result of key, if there is one."""
+        description_path, array_path = self._paths(key)
+        try:
+            os.remove(description_path)
+        except OSError:
+            pass
+        count = 0
+        while os.path.exists(array_path(count)):
+            os.remove(array_path(count))
+            count += 1
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(nbytes for used, nbytes, key in entries)
+        for used, nbytes, key in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        for used, nbytes, key in self._entries():
+            self.remove(key)
+
+    def stats(self):
+        """hits, misses, evictions, number of stored results and their bytes."""
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(entries), 'bytes': sum(nbytes for used, nbytes, key in entries)}
+
+    def memoize(self, function, version=None):
+        """
+        function, with its results taken from / stored in this cache.
+        A new version (any value) stores new results, e.g. when a function
+        called by function has changed.
+        """
+        @functools.wraps(function)
+        def cached(*args, **kwargs):
+            key = self.key(function, args, kwargs, version)
+            result = self.load(key)
+            if result is not None:
+                self.hits += 1
+                return result
+            self.misses += 1
+            result = function(*args, **kwargs)
+            self.store(key, result)
+            return result
+        cached.cache = self
+        return cached
+
+
+_default_cache = []
+
+
+def memoize(function=None, cache=None, version=None):
+    """
+    Decorator: @memoize uses one cache shared by the whole program (see
+    ResultCache for its folder), @memoize(cache=ResultCache(...)) another one.
+    memoize(core.denoise_tv) works as well. version: see ResultCache.memoize.
+    """
+    def decorate(function):
+        if cache is not None:
+            return cache.memoize(function, version)
+        if not _default_cache:
+            _default_cache.append(ResultCache())
+        return _default_cache[0].memoize(function, version)
+    if function is None:
+        return decorate
+    return decorate(function)
@@ -0,0 +1,217 @@
+"""
+Processing pipelines over all the (slice, time) frames of a study.
+
+The stages are declared once, and the pipeline runs them on every unit of
+work, a window of consecutive times of one slice, in a pool of processes:
+
+    pipe = Pipeline([Stage(cr.extract_3D_submatrix_upper, upper_left=[128, 128], sub_size=256),
+                     Stage(cr.denoise_tv, weight=50, dtype=np.float32, image_ndim=2),
+                     Stage(cr.aggregate_3D, sub_matrix_dim=4)],
+                    window=8)
+    volume, metadata = IO.open_volume_cache(folder_path)
+    out = pipe.run(volume, workers=4)            # (slices, times, 64, 64)
+
+Loading is done by the source: a 4D matrix (slice, time, rows, cols) such
+as the memory-mapped volume of IO.open_volume_cache, or the table of
+IO.index_dcm_series, whose files are then read by the workers.
+The results go into one output matrix allocated at the start, which can be
+on the disk (out='result.npy'). At most max_in_flight units are being
+worked on or waiting to be written at any time, so the memory stays a few
+units however big the study is. workers=1 runs everything in the calling
+process, in order, for debugging.
+"""
+
+import collections
+import mmap
+import multiprocessing
+import numpy as np  ##linear algebra
+import imageanalysis.instrument as instrument
+from imageanalysis.stream import _source_grid
+
+
+class Stage(object):
+    """
+    One step of a pipeline: function(frames, **parameters).
+
+    input: function   : takes the frames of a unit (no_frames, ...) and returns
+                        the result for them, e.g. core.denoise_tv. It has to be
+                        a module-level function (it is sent to the processes).
+           name       : name of the stage, the name of function by default.
+           batch      : frames given to function at once. None: all the frames
+                        of the unit; 1: one frame (rows, cols) at a time, for
+                        functions of one image; k: stacks of k frames.
+                        The results of the batches are stacked back together.
+           parameters : keyword arguments of function.
+    """
+
+    def __init__(self, function, name=None, batch=None, **parameters):
+        self.function = function
+        self.name = function.__name__ if name is None else name
+        self.batch = batch
+        self.parameters = parameters
+
+    def __repr__(self):
+        return "Stage(%s)" % self.name
+
+    def __call__(self, frames):
+        with instrument.span('stage ' + self.name):
+            if self.batch is None:
+                return self.function(frames, **self.parameters)
+            if self.batch == 1:
+                return np.stack([self.function(frame, **self.parameters) for frame in frames])
+            return np.concatenate([self.function(frames[start:start + self.batch], **self.parameters)
+                                   for start in range(0, len(frames), self.batch)])
+
+
+def _portable(source):
+    """
+    What is sent to the processes for a source: a memory-mapped volume is
+    opened again by every process instead of being copied (only the whole
+    mapped file; a view of it would be sent as a copy).
+    """
+    if isinstance(source, np.memmap) and isinstance(source.base, mmap.mmap):
+        return ('memmap', source.filename, source.dtype, source.shape, source.offset)
+    return source
+
+
+def _opened(source):
+    if isinstance(source, tuple) and len(source) == 5 and source[0] == 'memmap':
+        kind, filename, dtype, shape, offset = source
+        return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset)
+    return source
+
+
+# state of a worker process, set once by _start_worker.
+_worker = {}
+
+
+def _start_worker(source, stages):
+    _worker['frames_of'] = _source_grid(_opened(source))[2]
+    _worker['stages'] = stages
+
+
+def _run_unit(unit):
+    return unit, _apply(_worker['stages'], _load(_worker['frames_of'], unit))
+
+
+def _load(frames_of, unit):
+    with instrument.span('load'):
+        return frames_of(*unit)
+
+
+def _apply(stages, frames):
+    result = frames
+    for stage in stages:
+        result = stage(result)
+    return np.asarray(result)
+
+
+class Pipeline(object):
+    """
+    input: stages : list of Stage, applied in order.
+           window : number of consecutive times of a unit of work. None: all
+                    the times of a slice are one unit, for stages that
+                    reduce the time axis (e.g. label_pixels over the curves
+                    of the pixels), then the output is (slice, ...).
+    """
+
+    def __init__(self, stages, window=1):
+        self.stages = list(stages)
+        self.window = window
+
+    def __repr__(self):
+        return "Pipeline(%s)" % " -> ".join(stage.name for stage in self.stages)
+
+    def units(self, source, slice_counts=None):
+        """the units of work (slice_count, start, stop) of a source, in order."""
+        no_slices, no_time_steps, frames_of = _source_grid(source)
+        window = no_time_steps if self.window is None else self.window
+        if slice_counts is None:
+            slice_counts = range(no_slices)
+        return [(slice_count, start, min(start + window, no_time_steps))
+                for slice_count in slice_counts for start in range(0, no_time_steps, window)]
+
+    @instrument.instrumented(name='Pipeline.run', category='pipeline')
+    def run(self, source, out=None, workers=1, max_in_flight=None, slice_counts=None):
+        """
+        input: source        : 4D matrix (slice, time, rows, cols) or table of
+                               IO.index_dcm_series.
+               out           : output matrix, a file name for a .npy file on the
+                               disk, or None to allocate it in memory. Its shape
+                               is (slice, time) + shape of the result of one frame,
+                               or (slice,) + shape of the result of one slice when
+                               window is None (slices in increasing order).
+               workers       : number of processes, None for one per core,
+                               1 to run in this process (for debugging).
+               max_in_flight : largest number of units sent to the processes and
+                               not written yet, 2 workers by default.
+               slice_counts  : positions of the slices to do, all by default.
+
+        output: out, with the results of all units.
+
+        The first unit is done here, to know the shape and dtype of the
+        results before out is allocated, so there has to be one: a source
+        without frames or an empty slice_counts raises a ValueError.
+        """
+        no_slices, no_time_steps, frames_of = _source_grid(source)
+        units = self.units(source, slice_counts)
+        slice_position = dict((slice_count, position) for position, slice_count
+                              in enumerate(sorted(set(unit[0] for unit in units))))
+
+        if not units:
+            raise ValueError("there is nothing to run: the source has no frames "
+                             "or slice_counts is empty.")
+        first = units[0]
+        first_result = _apply(self.stages, _load(frames_of, first))
+        per_frame = self.window is not None
+        if per_frame and len(first_result) != first[2] - first[1]:
+            raise ValueError("the stages have to keep one result per frame, "
+                             "use window=None for stages that reduce the time axis.")
+        result_shape = first_result.shape[1:] if per_frame else first_result.shape
+        shape = ((len(slice_position), no_time_steps) if per_frame
+                 else (len(slice_position),)) + result_shape
+        if out is None:
+            out = np.empty(shape, dtype=first_result.dtype)
+        elif isinstance(out, str):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=first_result.dtype, shape=shape)
+        elif out.shape != shape:
+            raise ValueError("out has to be of shape %r." % (shape,))
+
+        def write(unit, result):
+            slice_count, start, stop = unit
+            with instrument.span('write'):
+                if per_frame:
+                    out[slice_position[slice_count], start:stop] = result
+                else:
+                    out[slice_position[slice_count]] = result
+
+        def wait(pending_unit):
+            # time the calling process waits for the workers.
+            with instrument.span('wait for workers'):
+                return pending_unit.get()
+
+        write(first, first_result)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers <= 1 or len(units) == 1:
+            for unit in units[1:]:
+                write(unit, _apply(self.stages, _load(frames_of, unit)))
+            return out
+
+        if max_in_flight is None:
+            max_in_flight = 2 * workers
+        pool = multiprocessing.Pool(workers, _start_worker, (_portable(source), self.stages))
+        try:
+            # results are written in the order of the units; when max_in_flight
+            # are pending, the oldest is waited for before sending another.
+            pending = collections.deque()
+            for unit in units[1:]:
+                if len(pending) >= max_in_flight:
+                    write(*wait(pending.popleft()))
+                pending.append(pool.apply_async(_run_unit, (unit,)))
+            while pending:
+                write(*wait(pending.popleft()))
+        finally:
+            pool.close()
+            pool.join()
+        return out
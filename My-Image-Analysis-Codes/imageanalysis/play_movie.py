@@ -5,17 +5,25 @@ import matplotlib.image as mpimg
 from time import sleep
 import glob
 import os
+from imageanalysis.pyramid import ImagePyramid
 
-def play_movie(image_matrix, time_range=[0, 59], color_map = 'Greys', pause_time=0.01):
+def play_movie(image_matrix, time_range=[0, 59], color_map = 'Greys', pause_time=0.01, level=0):
     """
     This function takes a 3D matrix and plays it as a movie.
     start_time is the slice we want the movie to start. it has to be` between 0-57.
     end_time is the slice which we want to stop at. it has to be between 1-58.
+    level is the level of detail: the movie of level k of the pyramid has
+    frames 2^k times smaller in each direction (a quick preview).
+    image_matrix can also be an ImagePyramid, then its levels are reused.
     
     Yunfeng
     """
+    if isinstance(image_matrix, ImagePyramid):
+        image_matrix = image_matrix[level]
+    elif level > 0:
+        image_matrix = ImagePyramid(image_matrix)[level]
     count = 0
-    for time in xrange(time_range[0], time_range[1]):
+    for time in range(time_range[0], time_range[1]):
         plt.imshow(image_matrix[time, :, :], cmap= color_map)
         plt.pause(pause_time)
         count += 1
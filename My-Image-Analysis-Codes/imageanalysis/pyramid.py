@@ -0,0 +1,199 @@
+"""
+Multi-resolution pyramid of images, and coarse-to-fine versions of the
+segmentation and denoising functions of core.
+
+Level 0 is the image (or stack of images) itself, and every level is the
+previous one reduced by factor x factor blocks of pixels (core.block_reduce),
+so level k has 1 / factor^(2k) of the pixels. Only the last two axes (rows,
+cols) are reduced: a (time, rows, cols) or (slice, time, rows, cols) volume
+keeps all its frames at every level. Levels are computed the first time
+they are asked for, from the level below, and kept:
+
+    movie = ImagePyramid(volume[0])               # (time, rows, cols) of one slice
+    play_movie(movie, level=2)                    # 128 x 128 preview
+    frame = ImagePyramid(volume[0, 0])            # one frame
+    mask = coarse_to_fine_region_growing(volume[0, 0], (250, 300), pyramid=frame)
+
+The coarse-to-fine functions solve the problem on a coarse level, where it
+is cheap, and use the answer as a starting point on level 0, where only what
+the coarse answer could not decide is left to do.
+"""
+
+import numpy as np  ##linear algebra
+import imageanalysis.core as cr
+
+
+class ImagePyramid(object):
+    """
+    input: image  : image (rows, cols) or stack of images (..., rows, cols),
+                    a memory-mapped volume works as well (it is only read).
+           factor : size of the blocks reduced between two levels.
+           func   : reduction of the blocks, see core.block_reduce.
+           dtype  : dtype of the levels above 0.
+
+    pyramid[k] (or pyramid.level(k)) is level k, pyramid[0] is image itself.
+    When the size of a level is not a multiple of factor, the last blocks are
+    reduced over the pixels they have, so every pixel is in a block.
+    """
+
+    def __init__(self, image, factor=2, func='mean', dtype=np.float32):
+        self.factor = factor
+        self.func = func
+        self.dtype = dtype
+        self._levels = [image if hasattr(image, 'shape') else np.asarray(image)]
+
+    def __len__(self):
+        """number of levels, until the images are one pixel."""
+        size = max(self._levels[0].shape[-2:])
+        no_levels = 1
+        while size > 1:
+            size = -(-size // self.factor)
+            no_levels += 1
+        return no_levels
+
+    def __getitem__(self, k):
+        return self.level(k)
+
+    def level(self, k):
+        """level k, computed (with the levels below it) if not done yet."""
+        if k < 0 or k >= len(self):
+            raise IndexError("the pyramid has levels 0 to %d." % (len(self) - 1))
+        while len(self._levels) <= k:
+            self._levels.append(cr.block_reduce(self._levels[-1], (self.factor, self.factor),
+                                                self.func, edge='pad', dtype=self.dtype))
+        return self._levels[k]
+
+    def shape(self, k):
+        """shape of level k, without computing it."""
+        shape = self._levels[0].shape
+        rows, cols = shape[-2:]
+        for count in range(k):
+            rows, cols = -(-rows // self.factor), -(-cols // self.factor)
+        return shape[:-2] + (rows, cols)
+
+    def upsample(self, matrix, from_level, to_level=0):
+        """
+        matrix of level from_level (any matrix whose last two axes have the
+        size of that level) repeated to the size of level to_level: every
+        pixel becomes the factor^(from_level - to_level) square block it stands for.
+        """
+        scale = self.factor ** (from_level - to_level)
+        rows, cols = self.shape(to_level)[-2:]
+        matrix = np.repeat(np.repeat(matrix, scale, axis=-2), scale, axis=-1)
+        return matrix[..., :rows, :cols]
+
+    def coarse_coordinates(self, coordinates, k):
+        """
+        coordinates (..., row, col) of level 0 as coordinates of level k,
+        the leading axes (time, slice) do not change.
+        """
+        coordinates = np.array(coordinates, dtype=np.intp)
+        coordinates[..., -2:] //= self.factor ** k
+        return coordinates
+
+
+def _pyramid_of(image, pyramid, factor):
+    if pyramid is None:
+        return ImagePyramid(image, factor)
+    if pyramid[0].shape != np.shape(image):
+        raise ValueError("pyramid has to be built on image.")
+    return pyramid
+
+
+def _interior(mask, connectivity):
+    """pixels of mask whose neighbors are all in mask."""
+    padded = np.pad(mask, 1, mode='constant')
+    interior = mask.copy()
+    for offset in cr.neighbor_offsets(mask.ndim, connectivity):
+        interior &= padded[tuple(slice(1 + o, 1 + o + size)
+                                 for o, size in zip(offset, mask.shape))]
+    return interior
+
+
+def coarse_to_fine_region_growing(img, seed, threshold=20, connectivity=None, level=2,
+                                  pyramid=None, factor=2):
+    """
+    region_growing started from the region found on a coarse level.
+
+    input: img, seed, threshold, connectivity : as in core.region_growing.
+           level   : level of the pyramid the region is first grown on.
+           pyramid : ImagePyramid of img, if one is already there
+                     (its levels are then shared with other calls).
+           factor  : factor of the pyramid built when pyramid is None.
+
+    output: uint8 matrix of the size of img, 255 in the region.
+
+    The region of the coarse level, without its boundary pixels, is taken back
+    to level 0; its pixels within threshold of the coarse region mean are the
+    seeds of core.region_growing on img, which then only decides the
+    boundary. Structures thinner than a block of the coarse level can be
+    missed by the coarse region, use a lower level for them.
+    """
+    img = np.asarray(img)
+    pyramid = _pyramid_of(img, pyramid, factor)
+    seeds = cr._seed_coordinates(seed, img.shape)
+    if level == 0:
+        return cr.region_growing(img, seeds, threshold, connectivity)
+
+    coarse_seeds = np.unique(pyramid.coarse_coordinates(seeds, level), axis=0)
+    coarse = pyramid[level]
+    coarse_region = cr.region_growing(coarse, coarse_seeds, threshold, connectivity) > 0
+    coarse_mean = coarse[coarse_region].mean()
+
+    fine_seeds = pyramid.upsample(_interior(coarse_region, connectivity), level)
+    fine_seeds &= np.abs(img - coarse_mean) < threshold
+    fine_seeds[tuple(seeds.T)] = True
+    return cr.region_growing(img, fine_seeds, threshold, connectivity)
+
+
+def coarse_to_fine_denoise_tv(image, weight=50, eps=2.e-4, n_iter_max=200, dtype=np.float64,
+                              level=1, pyramid=None, factor=2):
+    """
+    core.denoise_tv of every image (rows, cols) of image, started from the
+    solution of a coarse level.
+
+    The coarse level is denoised with weight / factor^(2 level), and its dual
+    variable p, rescaled to weight (p is as large as the weight at the
+    solution) and upsampled, is where the iterations on level 0 start. p holds
+    the edges of the image, which the coarse level finds for a fraction of the
+    cost, and they are what takes Chambolle's iterations longest to settle.
+    On our studies, level 1 was best: after 50 iterations on level 0 the
+    mean distance to the converged image was 5 times smaller than with p = 0;
+    levels 2 and 3 gain less.
+    """
+    image = np.asarray(image)
+    pyramid = _pyramid_of(image, pyramid, factor)
+    if level == 0:
+        return cr.denoise_tv(image, weight, eps, n_iter_max, dtype, image_ndim=2)
+    scale = float(pyramid.factor ** (2 * level))
+    denoised, dual = cr.denoise_tv(pyramid[level], weight / scale, eps, n_iter_max, dtype,
+                                   image_ndim=2, return_dual=True)
+    return cr.denoise_tv(image, weight, eps, n_iter_max, dtype, image_ndim=2,
+                         dual=pyramid.upsample(dual * scale, level))
+
+
+def coarse_to_fine_non_local_mean(image, constant=10, dtype=np.float64, patch_radius=1,
+                                  search_radius=7, fine_search_radius=2, mode='gaussian',
+                                  h=None, level=1, pyramid=None, factor=2):
+    """
+    core.non_local_mean of an image, with a small search window on level 0
+    guided by a coarse level.
+
+    The coarse level is denoised with the full search_radius (which there
+    covers factor^level times more of the image), upsampled, and used as the
+    guide of non_local_mean on image with fine_search_radius: the patches are
+    compared on the guide, which has much less noise, so far fewer
+    candidates are needed. The work on level 0 goes down by
+    ((2 search_radius + 1) / (2 fine_search_radius + 1))^2, 9 with the defaults.
+    """
+    image = np.asarray(image)
+    pyramid = _pyramid_of(image, pyramid, factor)
+    if h is None and mode == 'gaussian':
+        h = cr.estimate_noise(image)
+    if level == 0:
+        return cr.non_local_mean(image, constant, dtype, patch_radius, search_radius, mode, h)
+    coarse = cr.non_local_mean(pyramid[level], constant, dtype, patch_radius, search_radius,
+                               mode, None if h is None else h / pyramid.factor ** level)
+    guide = pyramid.upsample(coarse, level)
+    return cr.non_local_mean(image, constant, dtype, patch_radius, fine_search_radius, mode,
+                             h, guide=guide)
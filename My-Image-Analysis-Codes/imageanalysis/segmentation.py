@@ -0,0 +1,226 @@
+"""
+Graph-based segmentation on the full-resolution grid of pixels.
+
+The pixels of a frame (rows, cols), or of a volume (slice or time, rows,
+cols), are the nodes of a grid graph whose edges join neighboring pixels,
+weighted by how similar their intensities are. random_walker gives every
+pixel the label of the seeds a random walk started from it most probably
+reaches first (Grady, Random Walks for Image Segmentation, 2006): those
+probabilities solve a sparse linear system with the graph Laplacian,
+which is solved by preconditioned conjugate gradients.
+
+Seeds can come from anywhere that labels pixels, e.g. label_pixels:
+
+    labels = cr.label_pixels(volume[slice_count], [Tumor, Healthy, Vessel], feature_axis=0)
+    segmented = random_walker(volume[slice_count, time_count], labels, unlabeled=100)
+"""
+
+import numpy as np  ##linear algebra
+import imageanalysis.core as cr
+import imageanalysis.instrument as instrument
+
+
+def grid_edges(shape, connectivity=None):
+    """
+    Edges of the grid graph of a matrix of the given shape, every edge once,
+    as (first, second) arrays of flat (np.ravel_multi_index) pixel numbers.
+    connectivity is the one of core.neighbor_offsets.
+    """
+    nodes = np.arange(int(np.prod(shape))).reshape(shape)
+    first, second = [], []
+    for offset in cr.neighbor_offsets(len(shape), connectivity):
+        if offset < (0,) * len(shape):
+            continue
+        source = tuple(slice(max(0, -o), size - max(0, o)) for o, size in zip(offset, shape))
+        target = tuple(slice(max(0, o), size - max(0, -o)) for o, size in zip(offset, shape))
+        first.append(nodes[source].ravel())
+        second.append(nodes[target].ravel())
+    return np.concatenate(first), np.concatenate(second)
+
+
+def edge_weights(image, first, second, beta=1.):
+    """
+    exp(-beta d^2 / mean(d^2)) for the intensity differences d of the edges:
+    1 inside flat regions, close to 0 across the edges of the image. A tiny
+    floor keeps the graph connected.
+    """
+    values = np.asarray(image, dtype=np.float64).ravel()
+    difference = (values[first] - values[second]) ** 2
+    scale = max(difference.mean(), np.finfo(np.float64).tiny)
+    return np.maximum(np.exp(-beta * difference / scale), 1e-10)
+
+
+def grid_graph(shape, connectivity=None, image=None, beta=1., format='csr'):
+    """
+    Sparse adjacency matrix of the grid graph, built for all edges at once.
+
+    input: shape        : shape of the grid, (nrows, ncols) for a frame,
+                          (time or slice, nrows, ncols) for a volume.
+           connectivity : 4 or 8 in 2D, 6 or 26 in 3D.
+           image        : matrix of the given shape; edges are then weighted
+                          by the intensity difference of their pixels
+                          (see edge_weights). Unweighted (1) without it.
+           beta         : see edge_weights.
+           format       : 'csr' or 'coo' (scipy.sparse).
+
+    output: symmetric (no_nodes, no_nodes) sparse matrix, node
+            np.ravel_multi_index(pixel, shape) for every pixel. A 512 x 512
+            frame has about 1 million edges, 8-connected, which is ~25 MB in csr.
+    """
+    import scipy.sparse as sp
+    shape = tuple(shape)
+    no_nodes = int(np.prod(shape))
+    first, second = grid_edges(shape, connectivity)
+    if image is None:
+        weights = np.ones(len(first))
+    else:
+        if np.shape(image) != shape:
+            raise ValueError("image has to be of shape %r" % (shape,))
+        weights = edge_weights(image, first, second, beta)
+    Adj = sp.coo_matrix((np.concatenate([weights, weights]),
+                         (np.concatenate([first, second]), np.concatenate([second, first]))),
+                        shape=(no_nodes, no_nodes))
+    return Adj.tocsr() if format == 'csr' else Adj
+
+
+def _conjugate_gradient(A, B, tol, maxiter, X=None):
+    """
+    Solves A X = B for all columns of B together (A symmetric positive
+    definite, sparse), with the diagonal of A as preconditioner, starting
+    from X if given. Returns (X, number of iterations).
+    """
+    inverse_diagonal = 1. / A.diagonal()[:, np.newaxis]
+    X = B * inverse_diagonal if X is None else X.copy()
+    R = B - A.dot(X)
+    Z = R * inverse_diagonal
+    P = Z.copy()
+    rz = np.einsum('ij,ij->j', R, Z)
+    b_norm = np.maximum(np.sqrt(np.einsum('ij,ij->j', B, B)), np.finfo(np.float64).tiny)
+    iteration = 0
+    while iteration < maxiter:
+        if np.all(np.sqrt(np.einsum('ij,ij->j', R, R)) <= tol * b_norm):
+            break
+        AP = A.dot(P)
+        alpha = rz / np.maximum(np.einsum('ij,ij->j', P, AP), np.finfo(np.float64).tiny)
+        X += alpha * P
+        R -= alpha * AP
+        Z = R * inverse_diagonal
+        rz_new = np.einsum('ij,ij->j', R, Z)
+        P *= rz_new / np.maximum(rz, np.finfo(np.float64).tiny)
+        P += Z
+        rz = rz_new
+        iteration += 1
+    return X, iteration
+
+
+def _probabilities(pyramid, level, seed_coordinates, seed_columns, no_labels, beta,
+                   connectivity, tol, maxiter, coarse_levels):
+    """
+    Probabilities (no_labels, no_pixels) of level `level` of the pyramid,
+    started from the ones of the next level while coarse_levels > 0.
+    seed_coordinates are the ones of level 0, seed_columns their label numbers.
+    """
+    import scipy.sparse as sp
+    image = pyramid[level]
+    shape = image.shape
+    # on a coarse level, a block with seeds of several labels keeps one of them.
+    seed_pixels = np.ravel_multi_index(tuple(pyramid.coarse_coordinates(seed_coordinates, level).T),
+                                       shape)
+    label_column = np.full(image.size, -1, dtype=np.intp)
+    label_column[seed_pixels] = seed_columns
+    unknown = label_column < 0
+    no_unknown = int(unknown.sum())
+    probabilities = np.zeros((no_labels, image.size))
+    probabilities[label_column[~unknown], np.nonzero(~unknown)[0]] = 1
+    if no_unknown == 0:
+        return probabilities
+
+    first, second = grid_edges(shape, connectivity)
+    weights = edge_weights(image, first, second, beta)
+    # numbers of the unlabeled pixels among themselves.
+    number = np.full(image.size, -1, dtype=np.intp)
+    number[unknown] = np.arange(no_unknown)
+    degree = np.bincount(first, weights, image.size) + np.bincount(second, weights, image.size)
+    both = unknown[first] & unknown[second]
+    rows = np.concatenate([number[first[both]], number[second[both]], np.arange(no_unknown)])
+    cols = np.concatenate([number[second[both]], number[first[both]], np.arange(no_unknown)])
+    values = np.concatenate([-weights[both], -weights[both], degree[unknown]])
+    laplacian = sp.csr_matrix((values, (rows, cols)), shape=(no_unknown, no_unknown))
+
+    # right hand side: weights of the edges from unlabeled pixels to each label.
+    # the probabilities add up to 1, so the last label is not solved for.
+    rhs = np.zeros((no_unknown, no_labels))
+    for inside, outside in ((first, second), (second, first)):
+        to_seed = unknown[inside] & ~unknown[outside]
+        np.add.at(rhs, (number[inside[to_seed]], label_column[outside[to_seed]]),
+                  weights[to_seed])
+    rhs = rhs[:, :no_labels - 1]
+
+    start = None
+    if coarse_levels > 0 and level + 1 < len(pyramid) and min(pyramid.shape(level + 1)[-2:]) >= 16:
+        coarse = _probabilities(pyramid, level + 1, seed_coordinates, seed_columns, no_labels,
+                                beta, connectivity, tol, maxiter, coarse_levels - 1)
+        coarse = coarse.reshape((no_labels,) + pyramid.shape(level + 1))
+        upsampled = pyramid.upsample(coarse[:no_labels - 1], level + 1, level)
+        start = np.ascontiguousarray(upsampled.reshape(no_labels - 1, -1)[:, unknown].T)
+    if no_labels > 1:
+        solution, no_iterations = _conjugate_gradient(laplacian, rhs, tol, maxiter, start)
+        probabilities[:no_labels - 1, unknown] = solution.T
+        if instrument.enabled:
+            instrument.record(**{'cg_iterations_level_%d' % level: no_iterations})
+    probabilities[no_labels - 1, unknown] = 1 - probabilities[:no_labels - 1, unknown].sum(axis=0)
+    return probabilities
+
+
+@instrument.instrumented
+def random_walker(image, seeds, unlabeled=-1, beta=1., connectivity=None, tol=1.e-2,
+                  maxiter=1000, coarse_levels=3, return_probabilities=False):
+    """
+    input: image         : frame (rows, cols), or volume (slice or time, rows, cols)
+                           segmented as one graph (the walks go through time too).
+           seeds         : integer matrix of the size of image, the label of the
+                           seed pixels, and unlabeled for the pixels to segment.
+                           Any labels work, e.g. 0, 1, 2 of label_pixels.
+           unlabeled     : value of the pixels to segment (100 for the output
+                           of label_pixels, where 100 means unsure).
+           beta          : the larger, the harder it is to cross an edge of
+                           the image (see edge_weights).
+           connectivity  : 4 or 8 in 2D, 6 or 26 in 3D.
+           tol           : relative residual the conjugate gradients stop at.
+                           Only the largest probability matters for the labels,
+                           so it does not need to be small.
+           maxiter       : largest number of conjugate gradient iterations.
+           coarse_levels : the problem is first solved on this many coarser
+                           levels of an ImagePyramid (rows and cols halved each
+                           time, 16 pixels at least), and each solution is the
+                           starting point of the next finer one.
+           return_probabilities : also return the probabilities.
+
+    output: matrix of the size of image, the label of every pixel.
+            With return_probabilities: (labels, probabilities), probabilities
+            is (no_labels,) + image.shape, in the order of np.unique of the labels.
+
+    The probabilities x of the unlabeled pixels solve L_U x = -B m, where L_U
+    is the Laplacian of the graph restricted to them, B the weights of the
+    edges to the seeds and m the labels of the seeds (one column per label).
+    All labels are solved in the same conjugate gradient iterations. Most of
+    the work of conjugate gradients is moving information across the image,
+    which the coarse levels do for a fraction of the cost.
+    """
+    from imageanalysis.pyramid import ImagePyramid
+    image = np.asarray(image)
+    seeds = np.asarray(seeds)
+    if seeds.shape != image.shape:
+        raise ValueError("seeds have to be the size of image.")
+    seed_coordinates = np.argwhere(seeds != unlabeled)
+    if len(seed_coordinates) == 0:
+        raise ValueError("there are no seeds.")
+    labels, seed_columns = np.unique(seeds[tuple(seed_coordinates.T)], return_inverse=True)
+
+    pyramid = ImagePyramid(image, dtype=np.float64)
+    probabilities = _probabilities(pyramid, 0, seed_coordinates, seed_columns.ravel(),
+                                   len(labels), beta, connectivity, tol, maxiter, coarse_levels)
+    segmented = labels[np.argmax(probabilities, axis=0)].reshape(image.shape)
+    if return_probabilities:
+        return segmented, probabilities.reshape((len(labels),) + image.shape)
+    return segmented
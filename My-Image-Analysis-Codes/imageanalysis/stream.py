@@ -0,0 +1,168 @@
+"""
+Frame by frame processing of whole studies.
+
+A stream is any iterable of (slice_count, time_count, frames) tuples, where
+frames is one image (rows, cols) or a window of consecutive times
+(window, rows, cols) starting at time_count. iter_frames and iter_time_windows
+make streams out of a study, the stream_* functions turn a stream into the
+stream of results, and write_stream puts the results into an output matrix
+(which can be on the disk, see np.lib.format.open_memmap).
+Nothing is kept besides the frames currently in use, so memory stays at a
+few frames however long the study is:
+
+    volume, metadata = IO.open_volume_cache(folder_path)
+    out = np.lib.format.open_memmap('denoised.npy', mode='w+',
+                                    dtype=np.float32, shape=volume.shape)
+    st.write_stream(st.stream_denoise_tv(st.iter_frames(volume), weight=50), out)
+"""
+
+import numpy as np  ##linear algebra
+import imageanalysis.IO as IO
+import imageanalysis.core as cr
+
+
+def _source_grid(source):
+    """
+    Returns (no_slices, no_time_steps, frames_of) for a source, where
+    frames_of(slice_count, start, stop) gives frames [start, stop) of a slice.
+
+    source is either a 4D matrix (slice, time, rows, cols), e.g. the
+    volume of IO.open_volume_cache, or the table of IO.index_dcm_series,
+    whose pixels are then decoded only when frames_of asks for them.
+    """
+    if getattr(source, 'dtype', None) is not None and source.dtype.names is not None:
+        slice_locations = sorted(np.unique(source['SliceLocation']).tolist(), reverse=True)
+        selections = [IO.select_frames(source, depth) for depth in slice_locations]
+        no_time_steps = min(len(selection) for selection in selections)
+
+        def frames_of(slice_count, start, stop):
+            return IO.load_frames(selections[slice_count][start:stop])
+        return len(slice_locations), no_time_steps, frames_of
+
+    if np.ndim(source) != 4:
+        raise ValueError("source has to be a 4D matrix (slice, time, rows, cols) "
+                         "or the output of IO.index_dcm_series.")
+
+    def frames_of(slice_count, start, stop):
+        return source[slice_count, start:stop]
+    return source.shape[0], source.shape[1], frames_of
+
+
+def iter_frames(source, slice_counts=None):
+    """
+    Yields (slice_count, time_count, frame) for every image of source,
+    slice after slice and time after time.
+
+    input: source       : 4D matrix or table of IO.index_dcm_series.
+           slice_counts : positions of the slices we want, all by default.
+    """
+    no_slices, no_time_steps, frames_of = _source_grid(source)
+    if slice_counts is None:
+        slice_counts = range(no_slices)
+    for slice_count in slice_counts:
+        for time_count in range(no_time_steps):
+            yield slice_count, time_count, frames_of(slice_count, time_count, time_count + 1)[0]
+
+
+def iter_time_windows(source, window, step=None, slice_counts=None):
+    """
+    Yields (slice_count, time_start, frames) where frames holds the images
+    of times time_start, ..., time_start + window - 1 of one slice.
+    The last window of a slice can be shorter.
+
+    input: window : number of times in a window.
+           step   : time between the starts of two windows, window by default
+                    (windows do not overlap).
+    """
+    if step is None:
+        step = window
+    no_slices, no_time_steps, frames_of = _source_grid(source)
+    if slice_counts is None:
+        slice_counts = range(no_slices)
+    for slice_count in slice_counts:
+        for time_start in range(0, no_time_steps, step):
+            yield slice_count, time_start, frames_of(slice_count, time_start,
+                                                     min(time_start + window, no_time_steps))
+
+
+def stream_map(function, stream):
+    """
+    Applies function to the frames of every element of the stream and
+    yields (slice_count, time_count, function(frames)).
+    """
+    for slice_count, time_count, frames in stream:
+        yield slice_count, time_count, function(frames)
+
+
+def write_stream(stream, out):
+    """
+    Writes every result of the stream into out as soon as it arrives,
+    out[slice_count, time_count] for one image, and
+    out[slice_count, time_count:time_count + window] for a window.
+    Returns out.
+    """
+    for slice_count, time_count, result in stream:
+        result = np.asarray(result)
+        if result.ndim == out.ndim - 2:
+            out[slice_count, time_count] = result
+        else:
+            out[slice_count, time_count:time_count + len(result)] = result
+    return out
+
+
+def stream_denoise_tv(stream, **kwargs):
+    """
+    denoise_tv of every image of the stream, keyword arguments are
+    passed on to denoise_tv (image_ndim=3 denoises every window as one).
+    """
+    kwargs.setdefault('image_ndim', 2)
+
+    def denoise(frames):
+        return cr.denoise_tv(frames, **kwargs)
+    return stream_map(denoise, stream)
+
+
+def stream_aggregate(stream, sub_matrix_dim):
+    """
+    aggregate_2D of every image (or aggregate_3D of every window) of the stream.
+    """
+    def aggregate(frames):
+        if np.ndim(frames) == 2:
+            return cr.aggregate_2D(np.asarray(frames), sub_matrix_dim)
+        return cr.aggregate_3D(np.asarray(frames), sub_matrix_dim)
+    return stream_map(aggregate, stream)
+
+
+def stream_rgb2gray(stream):
+    """
+    rgb2gray of every image (rows, cols, 3) or window of the stream.
+    """
+    return stream_map(cr.rgb2gray, stream)
+
+
+def stream_histogram(stream, bins=100, value_range=None):
+    """
+    Histogram of all the pixels of the stream, counted one element at a time.
+
+    input: bins        : number of bins.
+           value_range : (lower, upper) limits of the bins. The bins have to be
+                         fixed before the first frame is seen, so it is needed
+                         unless the frames are integers, then the limits of
+                         their dtype are used.
+
+    output: (counts, bin_edges) like np.histogram.
+    """
+    counts = np.zeros(bins, dtype=np.int64)
+    bin_edges = None
+    for slice_count, time_count, frames in stream:
+        frames = np.asarray(frames)
+        if bin_edges is None:
+            if value_range is None:
+                if not np.issubdtype(frames.dtype, np.integer):
+                    raise ValueError("value_range is needed for non-integer frames.")
+                value_range = (np.iinfo(frames.dtype).min, np.iinfo(frames.dtype).max)
+            bin_edges = np.linspace(value_range[0], value_range[1], bins + 1)
+        counts += np.histogram(frames, bins=bin_edges)[0]
+    if bin_edges is None:
+        raise ValueError("The stream is empty!")
+    return counts, bin_edges
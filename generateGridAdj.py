@@ -1,36 +1,90 @@
 import numpy as np
 
+##
+## Grid graphs of frames and volumes, built by imageanalysis.segmentation
+## (the code random_walker uses). Import it with My-Image-Analysis-Codes on
+## the path, e.g. from the top folder of the repository:
+##     PYTHONPATH=My-Image-Analysis-Codes python -c "from generateGridAdj import grid_graph"
+## (benchmarks/run_benchmarks.py puts both folders on sys.path).
+##
+## Nodes of the grid graph are the pixels, numbered along the rows:
+## pixel (row, col) of an nrows x ncols grid is node row * ncols + col
+## (np.ravel_multi_index of the pixel in the grid shape, in general).
+##
+import imageanalysis.core as cr
+import imageanalysis.segmentation as segmentation
+from imageanalysis.segmentation import grid_edges
+
+__all__ = ['grid_offsets', 'grid_edges', 'edge_weights', 'grid_graph', 'generateGridAdj']
+
+
+def grid_offsets(ndim, connectivity=None):
+    """
+    Offsets to the neighbors of a node, each edge once (only the offsets
+    that come after (0, ..., 0) in lexicographic order), of
+    core.neighbor_offsets(ndim, connectivity).
+    """
+    return [offset for offset in cr.neighbor_offsets(ndim, connectivity)
+            if offset > (0,) * ndim]
+
+
+def _beta(image, first, second, sigma):
+    """the beta of segmentation.edge_weights that gives the weights of sigma."""
+    if sigma is None:
+        return 0.5
+    values = np.asarray(image, dtype=np.float64).ravel()
+    mean_squared = np.mean((values[first] - values[second]) ** 2)
+    return mean_squared / (2. * max(sigma, np.finfo(np.float64).tiny) ** 2)
+
+
+def edge_weights(image, first, second, sigma=None):
+    """
+    Weights exp(-(image[first] - image[second])^2 / (2 sigma^2)) of edges
+    between pixels of an image: 1 for equal intensities, close to 0 across
+    edges of the image. sigma is the standard deviation of the
+    intensity differences over all edges by default. The weights are at
+    least 1e-10, so the graph stays connected (segmentation.edge_weights
+    with beta = mean(d^2) / (2 sigma^2)).
+    """
+    return segmentation.edge_weights(image, first, second, _beta(image, first, second, sigma))
+
+
+def grid_graph(shape, connectivity=None, image=None, sigma=None, format='csr'):
+    """
+    Sparse adjacency matrix of the grid graph, built for all edges at once
+    (segmentation.grid_graph).
+
+    input: shape        : shape of the grid, (nrows, ncols) for a frame,
+                          (time or slice, nrows, ncols) for a volume.
+           connectivity : 4 or 8 in 2D, 6 or 26 in 3D.
+           image        : matrix of the given shape; edges are then weighted
+                          by the intensity difference of their pixels
+                          (see edge_weights). Unweighted (1) without it.
+           sigma        : see edge_weights.
+           format       : 'csr' or 'coo' (scipy.sparse).
+
+    Output: symmetric (no_nodes, no_nodes) sparse matrix. A 512 x 512 frame
+            has about 1 million edges, 8-connected, which is ~25 MB in csr.
+    """
+    beta = 0.5
+    if image is not None and sigma is not None and np.shape(image) == tuple(shape):
+        first, second = grid_edges(tuple(shape), connectivity)
+        beta = _beta(image, first, second, sigma)
+    return segmentation.grid_graph(shape, connectivity, image, beta, format)
+
+
 ##
 ## nrows (and ncols) are number of rows (and cols)in the grid graph
 ##
-def generateGridAdj(nrows, ncols):
-    Adj = np.zeros((nrows * ncols,nrows * ncols))
-    
-    
-    for i in range(ncols):
-        for j in range(nrows):
-            k = np.ravel_multi_index((i,j), dims=(ncols, nrows), order='F')
-            if i > 0:
-                ii = i-1
-                jj = j
-                kk = np.ravel_multi_index((ii,jj), dims=(ncols, nrows), order='F')
-                Adj[k,kk] = 1
-                        
-            if i<ncols-1:
-                ii=i+1
-                jj=j
-                kk = np.ravel_multi_index((ii,jj), dims=(ncols, nrows), order='F')
-                Adj[k,kk] = 1
-            
-            if j>0:
-                ii=i
-                jj=j-1
-                kk = np.ravel_multi_index((ii,jj), dims=(ncols, nrows), order='F')
-                Adj[k,kk] = 1
-            if j<nrows-1:
-                ii=i
-                jj=j+1
-                kk = np.ravel_multi_index((ii,jj), dims=(ncols, nrows), order='F')
-                Adj[k,kk] = 1
-        
-    return Adj
\ No newline at end of file
+def generateGridAdj(nrows, ncols, sparse=False, connectivity=4):
+    """
+    4-connected (or 8) adjacency matrix of an nrows x ncols grid, dense by
+    default like it always was; sparse=True gives the csr matrix of
+    grid_graph, for grids the dense matrix does not fit in memory
+    (512 x 512 would be 550 GB dense). Volumes and weighted graphs:
+    grid_graph.
+    """
+    Adj = grid_graph((nrows, ncols), connectivity)
+    if sparse:
+        return Adj
+    return Adj.toarray()